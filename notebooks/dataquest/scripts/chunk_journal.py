@@ -0,0 +1,285 @@
+# Row level checkpointing for `locserv_process_chunks.py`.
+#
+# The query function is called once for all rows of a chunk not done yet, and
+# reports result rows as they arrive. They are appended to a journal file in
+# small batches. If a worker crashes, rows already in the journal are skipped
+# when the chunk is processed again, unless their result is missing (NaN),
+# which means that the query failed. Once all rows are done, the journal is
+# promoted to the result file, and a "XXX.done" marker is written next to the
+# "XXX.started" marker of the chunk. Both steps write to a temporary file
+# first, which is then renamed, so they are atomic.
+#
+# :func:`merge_result_chunks` concatenates the results of all chunks into a
+# single Parquet file, reading one chunk at a time.
+from pathlib import Path
+from typing import Callable, Optional, Protocol, Sequence
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+DEFAULT_CHECKPOINT_EVERY = 10
+
+
+class RowQueryFunction(Protocol):
+    def __call__(
+        self,
+        df: pd.DataFrame,
+        on_rows: Optional[Callable[[Sequence[int], Sequence], None]] = None,
+    ) -> pd.DataFrame:
+        """
+        Maps dataframe to copy with additional output column. If `on_rows` is
+        given, `on_rows(positions, values)` is called as soon as results are
+        available, in any order, where `positions` are row positions in `df`,
+        and `values` the output values for these rows. Each row is reported
+        at most once.
+
+        :param df: Input dataframe
+        :param on_rows: See above
+        :return: Copy of `df` with output column
+        """
+        ...
+
+
+def _replace_atomic(fname: Path, write_func: Callable[[Path], None]):
+    tmp_fname = fname.with_name(fname.name + ".tmp")
+    write_func(tmp_fname)
+    os.replace(tmp_fname, fname)
+
+
+def done_marker(chunk_fname: Path, chunk_num: int) -> Path:
+    return Path(str(chunk_fname) + f"{chunk_num}.done")
+
+
+def result_path(result_fname: str, chunk_num: int) -> Path:
+    return Path(result_fname + f"{chunk_num}.csv")
+
+
+class ChunkJournal:
+    """
+    Journal of results for chunk `chunk_num`, stored in
+    `result_fname + f"{chunk_num}.journal.csv"`.
+    """
+    def __init__(self, result_fname: str, chunk_num: int):
+        self.chunk_num = chunk_num
+        self._result_fname = result_fname
+        self._fname = Path(result_fname + f"{chunk_num}.journal.csv")
+
+    def _repair(self):
+        # A crash may have left a partial last line. It is cut off, so that
+        # further appends start on a new line
+        with open(self._fname, "r+b") as fp:
+            size = fp.seek(0, os.SEEK_END)
+            pos = size
+            while pos > 0:
+                step = min(pos, 4096)
+                fp.seek(pos - step)
+                block = fp.read(step)
+                index = block.rfind(b"\n")
+                if index >= 0:
+                    pos = pos - step + index + 1
+                    break
+                pos -= step
+            if pos < size:
+                fp.truncate(pos)
+
+    def load(self) -> Optional[pd.DataFrame]:
+        """
+        :return: Rows in journal, or `None` if there is no journal
+        """
+        if not self._fname.exists():
+            return None
+        self._repair()
+        if self._fname.stat().st_size == 0:
+            return None
+        return pd.read_csv(self._fname)
+
+    def append(self, rows_df: pd.DataFrame):
+        """
+        Appends rows to the journal, and flushes them to disk.
+
+        :param rows_df: Result rows
+        """
+        write_header = not self._fname.exists() or self._fname.stat().st_size == 0
+        with open(self._fname, "a", newline="") as fp:
+            rows_df.to_csv(fp, header=write_header, index=False)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def promote(self, chunk_fname: Path, columns: list[str]):
+        """
+        Writes the result file from the journal, then the "XXX.done" marker,
+        and removes the journal.
+
+        :param chunk_fname: Prefix of chunk filenames
+        :param columns: Columns of result file
+        """
+        journal_df = self.load()
+        if journal_df is None:
+            journal_df = pd.DataFrame(columns=columns)
+        result_df = journal_df.drop_duplicates(subset="unique_key", keep="last")
+        _replace_atomic(
+            result_path(self._result_fname, self.chunk_num),
+            lambda fname: result_df[columns].to_csv(fname, index=False),
+        )
+        _replace_atomic(
+            done_marker(chunk_fname, self.chunk_num),
+            lambda fname: fname.write_text(f"{self.chunk_num}\n"),
+        )
+        self._fname.unlink(missing_ok=True)
+
+
+class _JournalWriter:
+    # Buffers positions and values of result rows, and appends them to the
+    # journal in batches. The dataframe of rows is only built per batch
+    def __init__(
+        self,
+        journal: ChunkJournal,
+        todo_df: pd.DataFrame,
+        output_column: str,
+        checkpoint_every: int,
+    ):
+        self._journal = journal
+        self._todo_df = todo_df
+        self._output_column = output_column
+        self._checkpoint_every = checkpoint_every
+        self._positions = []
+        self._values = []
+        self.reported = np.zeros(todo_df.shape[0], dtype=bool)
+
+    def add(self, positions: Sequence[int], values: Sequence):
+        self._positions.extend(positions)
+        self._values.extend(values)
+        if len(self._positions) >= self._checkpoint_every:
+            self.flush()
+
+    def flush(self):
+        if self._positions:
+            rows_df = self._todo_df.iloc[self._positions].copy()
+            rows_df[self._output_column] = self._values
+            self._journal.append(rows_df)
+            self.reported[self._positions] = True
+            self._positions = []
+            self._values = []
+
+
+def process_chunk_with_journal(
+    chunk_df: pd.DataFrame,
+    chunk_num: int,
+    chunk_fname: Path,
+    result_fname: str,
+    query_func: RowQueryFunction,
+    checkpoint_every: int = DEFAULT_CHECKPOINT_EVERY,
+    output_column: str = "address",
+) -> int:
+    """
+    Processes rows of `chunk_df` not already done in the journal, calling
+    `query_func` once for all of them. Result rows reported by `query_func`
+    via `on_rows` are appended to the journal in batches of `checkpoint_every`
+    rows, and rows not reported are appended once `query_func` returns. If
+    `query_func` raises an exception, rows reported so far are appended
+    before it is passed on. Finally, the journal is promoted (see
+    :meth:`ChunkJournal.promote`).
+
+    Rows in the journal with missing output (NaN) count as failed. They are
+    processed again if the chunk is processed again before it is promoted.
+
+    :param chunk_df: Chunk dataframe, with columns "unique_key", "location"
+    :param chunk_num: Chunk number
+    :param chunk_fname: Prefix of chunk filenames
+    :param result_fname: Prefix of result filenames
+    :param query_func: Maps dataframe to copy with additional column
+        `output_column`, see :class:`RowQueryFunction`
+    :param checkpoint_every: Number of rows per append to the journal
+    :param output_column: Name of column added by `query_func`
+    :return: Number of rows skipped, since they were done in the journal
+    """
+    journal = ChunkJournal(result_fname, chunk_num)
+    journal_df = journal.load()
+    if journal_df is not None:
+        done_df = journal_df[journal_df[output_column].notnull()]
+        done_keys = set(done_df["unique_key"].astype(chunk_df["unique_key"].dtype))
+        todo_df = chunk_df[~chunk_df["unique_key"].isin(done_keys)]
+    else:
+        todo_df = chunk_df
+    num_skipped = chunk_df.shape[0] - todo_df.shape[0]
+    if todo_df.shape[0] > 0:
+        writer = _JournalWriter(journal, todo_df, output_column, checkpoint_every)
+        try:
+            result_df = query_func(todo_df, on_rows=writer.add)
+        finally:
+            writer.flush()
+        not_reported = ~writer.reported
+        if not_reported.any():
+            journal.append(result_df[not_reported])
+    journal.promote(chunk_fname, columns=list(chunk_df.columns) + [output_column])
+    return num_skipped
+
+
+def reset_unfinished_chunks(chunk_fname: Path) -> list[int]:
+    """
+    Removes "XXX.started" markers of chunks without "XXX.done" marker, so they
+    are claimed again (journals are kept, so finished rows are not queried
+    again). Only call this when no workers are running.
+
+    :param chunk_fname: Prefix of chunk filenames
+    :return: Numbers of chunks reset
+    """
+    prefix_len = len(chunk_fname.name)
+    reset_nums = []
+    for path in chunk_fname.parent.glob(chunk_fname.name + "*.started"):
+        chunk_num = int(path.stem[prefix_len:])
+        if not done_marker(chunk_fname, chunk_num).exists():
+            path.unlink()
+            reset_nums.append(chunk_num)
+    return sorted(reset_nums)
+
+
+def merge_result_chunks(
+    result_fname: str, num_chunks: int, output_fname: Path | str
+) -> int:
+    """
+    Concatenates result files of chunks `0, ..., num_chunks - 1` into Parquet
+    file `output_fname`. Only one chunk is held in memory at any time. Chunks
+    without result file are skipped.
+
+    :param result_fname: Prefix of result filenames
+    :param num_chunks: Total number of chunks
+    :param output_fname: Parquet file to write
+    :return: Number of rows written
+    """
+    schema = pa.schema(
+        [
+            ("unique_key", pa.int64()),
+            ("location", pa.string()),
+            ("address", pa.string()),
+        ]
+    )
+    num_rows = 0
+    output_fname = Path(output_fname)
+
+    def write_func(fname: Path):
+        nonlocal num_rows
+        with pq.ParquetWriter(fname, schema) as writer:
+            for chunk_num in range(num_chunks):
+                path = result_path(result_fname, chunk_num)
+                if not path.exists():
+                    print(f"Result for chunk {chunk_num} missing, skipped")
+                    continue
+                result_df = pd.read_csv(
+                    path,
+                    usecols=schema.names,
+                    dtype={"location": str, "address": str},
+                )
+                writer.write_table(
+                    pa.Table.from_pandas(
+                        result_df[schema.names], schema=schema, preserve_index=False
+                    )
+                )
+                num_rows += result_df.shape[0]
+
+    _replace_atomic(output_fname, write_func)
+    return num_rows
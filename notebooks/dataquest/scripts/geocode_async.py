@@ -0,0 +1,338 @@
+# Concurrent reverse geocoding with `asyncio`, used by
+# `locserv_process_chunks.py` as alternative to the serial `RateLimiter` loop
+# there.
+#
+# Requests are sent by up to `max_concurrency` tasks at the same time, while a
+# token bucket limits the request rate to what the backend permits. The token
+# bucket is shared by all calls in a process (see :func:`get_token_bucket`),
+# so the rate limit holds across calls, also if they overlap. Failed
+# requests are retried with exponential backoff. Backends implement
+# :class:`GeocoderBackend`. Blocking clients (`geopy`, `urllib`) are run in a
+# thread pool of the backend (see :class:`ThreadedGeocoderBackend`), so no
+# async HTTP library is needed.
+#
+# For testing, :func:`start_mock_server` runs a local HTTP server which
+# answers Nominatim style reverse queries, to be used with
+# :class:`NominatimHTTPBackend`.
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Sequence
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import urlencode, urlparse, parse_qs
+from urllib.request import Request, urlopen
+import asyncio
+import json
+import random
+import time
+
+import numpy as np
+import pandas as pd
+
+
+DEFAULT_MAX_CONCURRENCY = 16
+
+DEFAULT_MAX_RETRIES = 3
+
+DEFAULT_BACKOFF_SECONDS = 1.0
+
+
+def parse_location(loc: str) -> tuple[float, float]:
+    """
+    :param loc: String of form "(<latitude>, <longitude>)"
+    :return: Tuple (latitude, longitude)
+    """
+    latitude, longitude = loc.strip()[1:-1].split(",")
+    return float(latitude), float(longitude)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: On average, at most `rate` acquisitions per
+    second, with bursts of up to `capacity`.
+
+    Tokens are reserved under a thread lock, and the caller then sleeps until
+    its token is due. This does not depend on a particular event loop, so the
+    same object can be used by several `asyncio.run` calls (also from several
+    threads).
+    """
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        assert rate > 0, f"rate = {rate} must be positive"
+        self.rate = rate
+        self.capacity = max(capacity if capacity is not None else rate, 1.0)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = Lock()
+
+    def _reserve(self) -> float:
+        # Returns delay until reserved token is available. Tokens become
+        # negative if reserved in advance
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            self._tokens -= 1
+            return max(-self._tokens / self.rate, 0.0)
+
+    async def acquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+_token_buckets = dict()
+
+_token_buckets_lock = Lock()
+
+
+def get_token_bucket(rate: float, capacity: Optional[float] = None) -> TokenBucket:
+    """
+    :param rate: See :class:`TokenBucket`
+    :param capacity: See :class:`TokenBucket`
+    :return: Token bucket shared by all callers in this process with the same
+        arguments
+    """
+    key = (rate, capacity)
+    with _token_buckets_lock:
+        bucket = _token_buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, capacity)
+            _token_buckets[key] = bucket
+        return bucket
+
+
+class GeocoderBackend(ABC):
+    """
+    Interface for reverse geocoding backends.
+    """
+    @abstractmethod
+    async def reverse(self, latitude: float, longitude: float) -> Optional[str]:
+        """
+        :param latitude: Latitude
+        :param longitude: Longitude
+        :return: Address, or `None` if not found
+        """
+        pass
+
+    async def close(self):
+        pass
+
+
+class ThreadedGeocoderBackend(GeocoderBackend):
+    """
+    Base class for backends wrapping a blocking client. Calls of
+    :meth:`_reverse_blocking` run in a thread pool with `max_workers` threads,
+    which should be at least the `max_concurrency` used with the backend.
+    The default executor of `asyncio` is not used, since it is limited to a
+    few threads.
+    """
+    def __init__(self, max_workers: int = DEFAULT_MAX_CONCURRENCY):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    @abstractmethod
+    def _reverse_blocking(self, latitude: float, longitude: float) -> Optional[str]:
+        pass
+
+    async def reverse(self, latitude: float, longitude: float) -> Optional[str]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, self._reverse_blocking, latitude, longitude
+        )
+
+    async def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class GeopyBackend(ThreadedGeocoderBackend):
+    """
+    Wraps a (blocking) `geopy` geocoder, such as `Nominatim`.
+    """
+    def __init__(self, geolocator, max_workers: int = DEFAULT_MAX_CONCURRENCY):
+        super().__init__(max_workers)
+        self._geolocator = geolocator
+
+    def _reverse_blocking(self, latitude: float, longitude: float) -> Optional[str]:
+        result = self._geolocator.reverse(f"{latitude}, {longitude}")
+        return result.address if result is not None else None
+
+
+class NominatimHTTPBackend(ThreadedGeocoderBackend):
+    """
+    Queries the `/reverse` endpoint of a Nominatim compatible server (e.g.,
+    self-hosted, or the mock server of :func:`start_mock_server`) directly.
+    """
+    def __init__(
+        self,
+        base_url: str,
+        user_agent: str,
+        timeout: float = 10,
+        max_workers: int = DEFAULT_MAX_CONCURRENCY,
+    ):
+        super().__init__(max_workers)
+        self._base_url = base_url.rstrip("/")
+        self._user_agent = user_agent
+        self._timeout = timeout
+
+    def _reverse_blocking(self, latitude: float, longitude: float) -> Optional[str]:
+        query = urlencode(dict(lat=latitude, lon=longitude, format="jsonv2"))
+        request = Request(
+            f"{self._base_url}/reverse?{query}",
+            headers={"User-Agent": self._user_agent},
+        )
+        with urlopen(request, timeout=self._timeout) as response:
+            result = json.loads(response.read())
+        return result.get("display_name")
+
+
+async def reverse_geocode_locations(
+    locations: list[str],
+    backend: GeocoderBackend,
+    rate: float,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    backoff_seconds: float = DEFAULT_BACKOFF_SECONDS,
+    progress=None,
+    bucket: Optional[TokenBucket] = None,
+    on_result: Optional[Callable[[int, Optional[str]], None]] = None,
+) -> list[Optional[str]]:
+    """
+    Queries addresses for all `locations`, with at most `max_concurrency`
+    requests in flight, and at most `rate` requests per second. A failed
+    request is retried up to `max_retries` times, waiting
+    `backoff_seconds * 2^k` (with jitter) before retry `k`. If all attempts
+    fail, or the location cannot be parsed, the result is `None`.
+
+    :param locations: Strings of form "(<latitude>, <longitude>)"
+    :param backend: Geocoding backend
+    :param rate: Maximum number of requests per second
+    :param max_concurrency: Maximum number of requests in flight
+    :param max_retries: Maximum number of retries per location
+    :param backoff_seconds: Initial backoff delay
+    :param progress: Optional, `progress.update(1)` is called for every
+        location done (e.g., `tqdm` object)
+    :param bucket: Rate limiter. Defaults to `get_token_bucket(rate)`, which
+        is shared by all calls with the same `rate`
+    :param on_result: Optional, `on_result(pos, address)` is called once the
+        address for `locations[pos]` is done, in the thread running the event
+        loop
+    :return: Addresses, in the same order as `locations`
+    """
+    if bucket is None:
+        bucket = get_token_bucket(rate)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def query_with_retries(loc: str) -> Optional[str]:
+        try:
+            latitude, longitude = parse_location(loc)
+        except (AttributeError, ValueError) as ex:
+            # Not a string, or not of the expected form
+            print(f"Failed to parse {loc!r}: {ex}")
+            return None
+        async with semaphore:
+            for attempt in range(max_retries + 1):
+                await bucket.acquire()
+                try:
+                    return await backend.reverse(latitude, longitude)
+                except Exception as ex:
+                    if attempt == max_retries:
+                        print(f"Failed to query {loc}: {ex}")
+                        return None
+                    delay = backoff_seconds * 2 ** attempt
+                    await asyncio.sleep(delay * (0.5 + random.random()))
+
+    async def query(pos: int, loc: str) -> Optional[str]:
+        result = await query_with_retries(loc)
+        if progress is not None:
+            progress.update(1)
+        if on_result is not None:
+            on_result(pos, result)
+        return result
+
+    return await asyncio.gather(
+        *(query(pos, loc) for pos, loc in enumerate(locations))
+    )
+
+
+def query_address_from_location_async(
+    chunk_df: pd.DataFrame,
+    backend: GeocoderBackend,
+    rate: float,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    progress=None,
+    on_rows: Optional[Callable[[Sequence[int], Sequence], None]] = None,
+) -> pd.DataFrame:
+    """
+    Variant of `query_address_from_location` in `locserv_process_chunks.py`,
+    using :func:`reverse_geocode_locations`. The rate limit is shared with
+    all other calls in this process.
+
+    :param chunk_df: Input dataframe, with columns "unique_key" and "location"
+    :param backend: Geocoding backend
+    :param rate: Maximum number of requests per second
+    :param max_concurrency: Maximum number of requests in flight
+    :param max_retries: Maximum number of retries per location
+    :param progress: See :func:`reverse_geocode_locations`
+    :param on_rows: Optional. Called as `on_rows([pos], [address])` for
+        every row once it has been queried
+    :return: Copy of `chunk_df` with additional column "address", as queried
+    """
+    on_result = None
+    if on_rows is not None:
+        def on_result(pos: int, address: Optional[str]):
+            on_rows([pos], [address if address is not None else np.nan])
+
+    addresses = asyncio.run(
+        reverse_geocode_locations(
+            list(chunk_df["location"]),
+            backend=backend,
+            rate=rate,
+            max_concurrency=max_concurrency,
+            max_retries=max_retries,
+            progress=progress,
+            on_result=on_result,
+        )
+    )
+    result_df = chunk_df.copy()
+    result_df["address"] = [
+        address if address is not None else np.nan for address in addresses
+    ]
+    return result_df
+
+
+class _MockGeocoderHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path != "/reverse" or "lat" not in params or "lon" not in params:
+            self.send_error(404)
+            return
+        latitude, longitude = params["lat"][0], params["lon"][0]
+        body = json.dumps(
+            {"display_name": f"Mock address at {latitude}, {longitude}"}
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Keep quiet
+
+
+def start_mock_server(port: int = 0) -> ThreadingHTTPServer:
+    """
+    Starts a mock geocoding server in a background thread, which answers
+    `/reverse?lat=...&lon=...` with a made-up address. Call `shutdown` on the
+    returned object to stop it.
+
+    :param port: Port to listen on. Defaults to a free port
+    :return: Server object, its URL is
+        `f"http://127.0.0.1:{server.server_port}"`
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), _MockGeocoderHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
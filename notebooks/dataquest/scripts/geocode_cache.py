@@ -0,0 +1,228 @@
+# Persistent cache for reverse geocoding results, used by
+# `locserv_process_chunks.py`.
+#
+# Locations are quantized to `precision` decimal digits (5 digits are about
+# 1 metre), and addresses are stored in a SQLite database keyed by the
+# quantized coordinates. Rows of a chunk are deduplicated by quantized
+# location before querying, so that every distinct location not in the cache
+# is queried once, and results are broadcast back to all rows.
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Optional, Sequence
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+
+DEFAULT_PRECISION = 5
+
+
+def parse_locations(locations: pd.Series) -> np.ndarray:
+    """
+    Vectorized parsing of location strings.
+
+    :param locations: Strings of form "(<latitude>, <longitude>)"
+    :return: Array of shape `(n, 2)`, columns are latitude, longitude
+    """
+    parts = locations.str.strip().str[1:-1].str.split(",", n=1, expand=True)
+    return parts.astype(float).to_numpy()
+
+
+def quantize_locations(locations: pd.Series, precision: int) -> pd.DataFrame:
+    """
+    :param locations: Strings of form "(<latitude>, <longitude>)"
+    :param precision: Number of decimal digits to keep
+    :return: Dataframe with integer columns "lat_q", "lon_q" (coordinates
+        times `10 ** precision`, rounded), same index as `locations`
+    """
+    coords = np.round(parse_locations(locations) * 10 ** precision)
+    return pd.DataFrame(
+        coords.astype(np.int64), columns=["lat_q", "lon_q"], index=locations.index
+    )
+
+
+@dataclass
+class CacheStatistics:
+    num_rows: int = 0
+    num_unique: int = 0
+    num_hits: int = 0
+    num_queried: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.num_hits / self.num_unique if self.num_unique > 0 else 0.0
+
+    def update(self, other: "CacheStatistics"):
+        self.num_rows += other.num_rows
+        self.num_unique += other.num_unique
+        self.num_hits += other.num_hits
+        self.num_queried += other.num_queried
+
+    def __str__(self) -> str:
+        return (
+            f"rows: {self.num_rows}, unique locations: {self.num_unique}, "
+            f"cache hits: {self.num_hits} ({100 * self.hit_rate:.1f}%), "
+            f"queried: {self.num_queried}"
+        )
+
+
+class GeocodeCache:
+    """
+    Persistent cache of addresses, keyed by quantized coordinates. Every
+    process must create its own object.
+    """
+    def __init__(self, db_fname: Path, precision: int = DEFAULT_PRECISION):
+        self.precision = precision
+        self._conn = sqlite3.connect(str(db_fname), timeout=120)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS addresses ("
+            "precision INTEGER NOT NULL, "
+            "lat_q INTEGER NOT NULL, "
+            "lon_q INTEGER NOT NULL, "
+            "address TEXT NOT NULL, "
+            "PRIMARY KEY (precision, lat_q, lon_q))"
+        )
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+    def lookup(self, keys: pd.DataFrame) -> pd.Series:
+        """
+        :param keys: Dataframe with columns "lat_q", "lon_q" (distinct rows)
+        :return: Addresses (NaN if not in cache), same index as `keys`
+        """
+        self._conn.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS lookup_keys "
+            "(pos INTEGER, lat_q INTEGER, lon_q INTEGER)"
+        )
+        self._conn.execute("DELETE FROM lookup_keys")
+        self._conn.executemany(
+            "INSERT INTO lookup_keys VALUES (?, ?, ?)",
+            zip(
+                range(keys.shape[0]),
+                keys["lat_q"].tolist(),
+                keys["lon_q"].tolist(),
+            ),
+        )
+        rows = self._conn.execute(
+            "SELECT k.pos, a.address FROM lookup_keys k JOIN addresses a "
+            "ON a.precision = ? AND a.lat_q = k.lat_q AND a.lon_q = k.lon_q",
+            (self.precision,),
+        ).fetchall()
+        self._conn.commit()
+        result = np.full(keys.shape[0], np.nan, dtype=object)
+        for pos, address in rows:
+            result[pos] = address
+        return pd.Series(result, index=keys.index)
+
+    def store(self, keys: pd.DataFrame, addresses: list[Optional[str]]):
+        """
+        Stores addresses for quantized locations. Entries with address `None`
+        or NaN (not found, or query failed) are not stored.
+
+        :param keys: Dataframe with columns "lat_q", "lon_q"
+        :param addresses: Addresses, same length as `keys`
+        """
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO addresses VALUES (?, ?, ?, ?)",
+                (
+                    (self.precision, lat_q, lon_q, address)
+                    for lat_q, lon_q, address in zip(
+                        keys["lat_q"].tolist(), keys["lon_q"].tolist(), addresses
+                    )
+                    if isinstance(address, str)
+                ),
+            )
+
+
+def query_addresses_cached(
+    chunk_df: pd.DataFrame,
+    query_func: Callable[..., pd.DataFrame],
+    cache: GeocodeCache,
+    on_rows: Optional[Callable[[Sequence[int], Sequence], None]] = None,
+) -> tuple[pd.DataFrame, CacheStatistics]:
+    """
+    Variant of `query_address_from_location` in `locserv_process_chunks.py`,
+    using `cache`. Rows of `chunk_df` are deduplicated by quantized location.
+    Only distinct locations not found in `cache` are passed to `query_func`,
+    and their results are stored in `cache`.
+
+    Rows found in `cache` are reported to `on_rows` right away. Results
+    reported by `query_func` are reported to `on_rows` for all rows with the
+    same quantized location as they arrive. They are stored in `cache` once
+    `query_func` returns (or fails).
+
+    :param chunk_df: Input dataframe, with columns "unique_key" and "location"
+    :param query_func: Maps dataframe with column "location" to copy with
+        additional column "address" (e.g., `query_address_from_location`).
+        Called as `query_func(df, on_rows=...)`, see `RowQueryFunction` in
+        `chunk_journal.py`
+    :param cache: Geocoding cache
+    :param on_rows: Optional. Called as `on_rows(positions, addresses)` as
+        soon as results are available, where `positions` are row positions
+        in `chunk_df`
+    :return: Tuple `(result_df, stats)`, where `result_df` is a copy of
+        `chunk_df` with additional column "address"
+    """
+    quantized = quantize_locations(chunk_df["location"], cache.precision)
+    # Distinct locations are numbered in order of first appearance
+    group_ids = quantized.groupby(["lat_q", "lon_q"], sort=False).ngroup()
+    group_ids = group_ids.to_numpy()
+    first_rows = (~quantized.duplicated()).to_numpy()
+    unique_keys = quantized[first_rows].reset_index(drop=True)
+    addresses = cache.lookup(unique_keys).to_numpy(copy=True)
+    missing = pd.isnull(addresses)
+    stats = CacheStatistics(
+        num_rows=chunk_df.shape[0],
+        num_unique=unique_keys.shape[0],
+        num_hits=int((~missing).sum()),
+        num_queried=int(missing.sum()),
+    )
+    if on_rows is not None and stats.num_hits > 0:
+        rows = np.flatnonzero(~missing[group_ids])
+        on_rows(rows, addresses[group_ids[rows]])
+    if stats.num_queried > 0:
+        # Rows of distinct location `i` are `rows_by_id[starts[i]:starts[i + 1]]`
+        rows_by_id = np.argsort(group_ids, kind="stable")
+        starts = np.concatenate(
+            ([0], np.cumsum(np.bincount(group_ids, minlength=stats.num_unique)))
+        )
+        missing_ids = np.flatnonzero(missing)
+        reported = np.zeros(stats.num_unique, dtype=bool)
+
+        def on_unique_rows(positions, values):
+            # Positions are relative to the distinct locations not in `cache`
+            ids = missing_ids[np.asarray(positions, dtype=int)]
+            addresses[ids] = values
+            reported[ids] = True
+            if on_rows is not None:
+                rows = np.concatenate(
+                    [rows_by_id[starts[i]:starts[i + 1]] for i in ids]
+                )
+                on_rows(rows, addresses[group_ids[rows]])
+
+        unique_locations = pd.DataFrame(
+            {"location": chunk_df["location"].to_numpy()[first_rows]}
+        )
+        try:
+            queried_df = query_func(
+                unique_locations[missing], on_rows=on_unique_rows
+            )
+            not_reported = np.flatnonzero(~reported[missing_ids])
+            if not_reported.size > 0:
+                on_unique_rows(
+                    not_reported,
+                    queried_df["address"].to_numpy()[not_reported],
+                )
+        finally:
+            ids = np.flatnonzero(reported)
+            if ids.size > 0:
+                cache.store(unique_keys.iloc[ids], addresses[ids].tolist())
+    # Broadcast results back to all rows
+    result_df = chunk_df.copy()
+    result_df["address"] = addresses[group_ids]
+    return result_df, stats
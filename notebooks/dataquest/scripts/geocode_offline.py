@@ -0,0 +1,106 @@
+# Offline reverse geocoding from a reference table of known addresses (e.g.,
+# address points or street centroids), used by `locserv_process_chunks.py`.
+#
+# A ball tree with haversine metric is built over the reference coordinates.
+# All locations of a chunk are resolved with a single vectorized nearest
+# neighbour query. Locations whose nearest reference point is further away
+# than a distance threshold are passed on to a remote geocoder.
+from pathlib import Path
+from typing import Callable, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import BallTree
+
+from geocode_cache import parse_locations
+
+
+EARTH_RADIUS_METRES = 6371008.8
+
+DEFAULT_MAX_DISTANCE_METRES = 25.0
+
+
+class OfflineGeocoder:
+    """
+    Nearest neighbour lookup of addresses. `reference_df` must have columns
+    "latitude", "longitude" (in degrees), and "address".
+    """
+    def __init__(self, reference_df: pd.DataFrame):
+        reference_df = reference_df.dropna(
+            subset=["latitude", "longitude", "address"]
+        )
+        self._addresses = reference_df["address"].to_numpy()
+        coords = reference_df[["latitude", "longitude"]].to_numpy(dtype=float)
+        self._tree = BallTree(np.radians(coords), metric="haversine")
+
+    @staticmethod
+    def from_csv(fname: Path | str) -> "OfflineGeocoder":
+        """
+        :param fname: CSV file with columns "latitude", "longitude", "address"
+        :return: New :class:`OfflineGeocoder` object
+        """
+        return OfflineGeocoder(
+            pd.read_csv(fname, usecols=["latitude", "longitude", "address"])
+        )
+
+    def query(self, locations: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+        """
+        :param locations: Strings of form "(<latitude>, <longitude>)"
+        :return: Tuple `(addresses, distances)`, nearest reference address and
+            distance to it (in metres) for each location
+        """
+        coords = np.radians(parse_locations(locations))
+        distances, indices = self._tree.query(coords, k=1)
+        return self._addresses[indices[:, 0]], distances[:, 0] * EARTH_RADIUS_METRES
+
+
+def query_addresses_offline(
+    chunk_df: pd.DataFrame,
+    geocoder: OfflineGeocoder,
+    max_distance: float = DEFAULT_MAX_DISTANCE_METRES,
+    query_func: Optional[Callable[..., pd.DataFrame]] = None,
+    on_rows: Optional[Callable[[Sequence[int], Sequence], None]] = None,
+) -> pd.DataFrame:
+    """
+    Variant of `query_address_from_location` in `locserv_process_chunks.py`.
+    Addresses are looked up with `geocoder`. Rows whose nearest reference
+    address is further than `max_distance` metres away are passed to
+    `query_func` (remote geocoder), or obtain NaN if this is not given.
+    Rows resolved offline are reported to `on_rows` right away, the others
+    are reported by `query_func`.
+
+    :param chunk_df: Input dataframe, with columns "unique_key" and "location"
+    :param geocoder: Offline geocoder
+    :param max_distance: Distance threshold (in metres)
+    :param query_func: Maps dataframe with column "location" to copy with
+        additional column "address" (optional). Called as
+        `query_func(df, on_rows=...)`, see `RowQueryFunction` in
+        `chunk_journal.py`
+    :param on_rows: Optional. Called as `on_rows(positions, addresses)` as
+        soon as results are available, where `positions` are row positions
+        in `chunk_df`
+    :return: Copy of `chunk_df` with additional column "address"
+    """
+    addresses, distances = geocoder.query(chunk_df["location"])
+    addresses = addresses.astype(object)
+    misses = distances > max_distance
+    addresses[misses] = np.nan
+    result_df = chunk_df.copy()
+    result_df["address"] = addresses
+    if query_func is not None and np.any(misses):
+        inner_on_rows = None
+        if on_rows is not None:
+            hits = np.flatnonzero(~misses)
+            if hits.size > 0:
+                on_rows(hits, addresses[hits])
+            # Positions reported by `query_func` are relative to the misses
+            miss_positions = np.flatnonzero(misses)
+
+            def inner_on_rows(positions, values):
+                on_rows(miss_positions[np.asarray(positions, dtype=int)], values)
+
+        addresses[misses] = query_func(
+            chunk_df[misses], on_rows=inner_on_rows
+        )["address"].to_numpy()
+        result_df["address"] = addresses
+    return result_df
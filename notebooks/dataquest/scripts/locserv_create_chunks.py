@@ -10,13 +10,26 @@ from argparse import ArgumentParser
 import pandas as pd
 import numpy as np
 
+from script_utils.chunked import CHUNK_FORMATS, write_chunk
+from script_utils.chunked import mapreduce
 
-def create_chunks(full_df: pd.DataFrame, chunk_size: int):
-    bool_location = full_df["location"].notnull()
-    bool_borough = full_df["borough"].isnull()
-    bool_off = full_df["off_street"].isnull()
+
+# Columns needed to select rows, and columns written to chunks
+INPUT_COLUMNS = ["unique_key", "location", "borough", "off_street"]
+
+CHUNK_COLUMNS = ["unique_key", "location"]
+
+
+def select_rows(df: pd.DataFrame) -> pd.DataFrame:
+    bool_location = df["location"].notnull()
+    bool_borough = df["borough"].isnull()
+    bool_off = df["off_street"].isnull()
     row_ind = bool_location & (bool_borough | bool_off)
-    selected_df = full_df.loc[row_ind, ["unique_key", "location"]]
+    return df.loc[row_ind, CHUNK_COLUMNS]
+
+
+def create_chunks(full_df: pd.DataFrame, chunk_size: int):
+    selected_df = select_rows(full_df)
     num_rows = selected_df.shape[0]
     print(f"Writing {int(np.ceil(num_rows / chunk_size))} chunks...")
     chunks = []
@@ -26,6 +39,49 @@ def create_chunks(full_df: pd.DataFrame, chunk_size: int):
     return chunks
 
 
+def create_chunks_streaming(
+    input_fname: str,
+    chunk_fname: str,
+    chunk_size: int,
+    chunk_format: str = "parquet",
+    num_workers: int = 4,
+    read_chunksize: int = 100000,
+) -> list[dict]:
+    """
+    Streaming variant of :func:`create_chunks`, which also writes the chunks.
+    The input CSV file is read in pieces of ``read_chunksize`` rows, only
+    with columns ``INPUT_COLUMNS``, and rows are selected for each piece as it
+    arrives. Chunks are written by
+    :func:`script_utils.chunked.mapreduce.create_chunks`, which also writes a
+    manifest to ``chunk_fname + "manifest.json"``, recording filename, row
+    range (in the selected rows), and checksum of every chunk. Peak memory
+    depends on ``read_chunksize``, ``chunk_size``, and ``num_workers``, but
+    not on the size of the input file.
+
+    :param input_fname: Input CSV file
+    :param chunk_fname: Prefix of chunk filenames
+    :param chunk_size: Number of rows per chunk
+    :param chunk_format: Format of chunk files, see ``CHUNK_FORMATS``
+    :param num_workers: Number of threads writing chunks
+    :param read_chunksize: Number of rows read from input file at a time
+    :return: Manifest entries, one per chunk
+    """
+    assert chunk_format in CHUNK_FORMATS, \
+        f"chunk_format = '{chunk_format}' not supported, must be in {CHUNK_FORMATS}"
+    return mapreduce.create_chunks(
+        (
+            select_rows(piece_df)
+            for piece_df in pd.read_csv(
+                input_fname, usecols=INPUT_COLUMNS, chunksize=read_chunksize
+            )
+        ),
+        chunk_fname,
+        chunk_size,
+        chunk_format,
+        num_workers,
+    )
+
+
 if __name__ == "__main__":
     parser = ArgumentParser()
     default_path = Path.home() / "datasets" / "tabular_practice"
@@ -40,12 +96,32 @@ if __name__ == "__main__":
         default=str(default_path / "chunks" / "nypd_mvc_2018_location_chunk"),
     )
     parser.add_argument("--chunk_size", type=int, default=600)
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Read input in pieces and write chunks in parallel, with bounded "
+             "memory. Also writes a manifest",
+    )
+    parser.add_argument(
+        "--chunk_format", type=str, choices=CHUNK_FORMATS, default="parquet"
+    )
+    parser.add_argument("--num_workers", type=int, default=4)
     args = parser.parse_args()
 
-    full_df = pd.read_csv(args.input_fname)
-    chunks = create_chunks(full_df, chunk_size=args.chunk_size)
+    if args.streaming:
+        manifest = create_chunks_streaming(
+            input_fname=args.input_fname,
+            chunk_fname=args.chunk_fname,
+            chunk_size=args.chunk_size,
+            chunk_format=args.chunk_format,
+            num_workers=args.num_workers,
+        )
+        print(f"Wrote {len(manifest)} chunks")
+    else:
+        full_df = pd.read_csv(args.input_fname)
+        chunks = create_chunks(full_df, chunk_size=args.chunk_size)
 
-    Path(args.chunk_fname).parent.mkdir(exist_ok=True)
-    for id, chunk in enumerate(chunks):
-        fname = args.chunk_fname + f"{id}.csv"
-        chunk.to_csv(fname, index=False)
+        Path(args.chunk_fname).parent.mkdir(exist_ok=True)
+        for id, chunk in enumerate(chunks):
+            fname = args.chunk_fname + f"{id}.{args.chunk_format}"
+            write_chunk(chunk, fname, args.chunk_format)
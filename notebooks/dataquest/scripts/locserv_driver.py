@@ -0,0 +1,302 @@
+# Runs the chunk pipeline of `locserv_process_chunks.py` with several worker
+# processes on one host, started from a single command.
+#
+# Chunks are claimed from the work queue in `script_utils.chunked.queue`,
+# results are checkpointed with the journal in `chunk_journal.py`. Workers report
+# throughput, latency, and errors via a shared queue, and the driver shows a
+# single combined progress bar. On Ctrl-C, workers finish their current row,
+# return their chunk to the queue, and stop. Running the driver again resumes:
+# rows in journals are skipped. Chunks of workers which crashed are handed out
+# again once their lease expires.
+#
+# Any per-row function can be used (`--row_func module:function`, called with
+# a row of the chunk dataframe as `pd.Series`). By default, the address is
+# queried from the location with `Nominatim`. Only the modules needed for the
+# chosen function are imported by the workers (`geopy` only for the default).
+from typing import Callable, Optional
+from pathlib import Path
+from argparse import ArgumentParser
+from dataclasses import dataclass
+import importlib
+import multiprocessing as mp
+import queue
+import signal
+import time
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from script_utils.chunked import number_of_chunks, read_chunk
+from script_utils.chunked.queue import (
+    ChunkQueue,
+    LeaseHeartbeat,
+    QUEUE_FNAME,
+    DEFAULT_LEASE_SECONDS,
+)
+from chunk_journal import process_chunk_with_journal, DEFAULT_CHECKPOINT_EVERY
+
+
+@dataclass(frozen=True)
+class WorkerConfig:
+    chunk_fname: Path
+    result_fname: str
+    chunk_format: str
+    num_chunks: int
+    row_func: Optional[str]  # "module:function", or `None` for geocoding
+    output_column: str
+    user_agent: Optional[str]
+    checkpoint_every: int
+    lease_seconds: float
+
+
+def load_row_func(config: WorkerConfig) -> Callable[[pd.Series], object]:
+    if config.row_func is not None:
+        module_name, func_name = config.row_func.split(":")
+        return getattr(importlib.import_module(module_name), func_name)
+    from geopy.geocoders import Nominatim
+    from geopy.extra.rate_limiter import RateLimiter
+
+    geolocator = Nominatim(user_agent=config.user_agent)
+    reverse = RateLimiter(geolocator.reverse, min_delay_seconds=1)
+
+    def geocode_row(row: pd.Series) -> object:
+        result = reverse(row["location"].strip()[1:-1])
+        return result.address if result is not None else np.nan
+
+    return geocode_row
+
+
+def run_worker(
+    worker_id: str,
+    config: WorkerConfig,
+    metrics_queue: mp.Queue,
+    stop_event: mp.Event,
+):
+    # Ctrl-C is handled by the driver, which sets `stop_event`
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    row_func = load_row_func(config)
+    db_fname = config.chunk_fname.parent / QUEUE_FNAME
+    chunk_queue = ChunkQueue(db_fname)
+
+    class Stopped(Exception):
+        pass
+
+    def query_func(df: pd.DataFrame, on_rows=None) -> pd.DataFrame:
+        # Called once per chunk. Metrics are sent every `checkpoint_every`
+        # rows, and `stop_event` is checked before every row
+        values = []
+        num_rows = 0
+        num_errors = 0
+        start = time.perf_counter()
+
+        def send_metrics():
+            nonlocal num_rows, num_errors, start
+            if num_rows > 0:
+                elapsed = time.perf_counter() - start
+                metrics_queue.put(("rows", worker_id, num_rows, elapsed, num_errors))
+                num_rows = 0
+                num_errors = 0
+                start = time.perf_counter()
+
+        try:
+            for pos, (_, row) in enumerate(df.iterrows()):
+                if stop_event.is_set():
+                    raise Stopped()
+                try:
+                    value = row_func(row)
+                except Exception as ex:
+                    value = np.nan
+                    num_errors += 1
+                    metrics_queue.put(("error", worker_id, repr(ex)))
+                values.append(value)
+                num_rows += 1
+                if on_rows is not None:
+                    on_rows([pos], [value])
+                if num_rows >= config.checkpoint_every:
+                    send_metrics()
+        finally:
+            send_metrics()
+        result_df = df.copy()
+        result_df[config.output_column] = values
+        return result_df
+
+    try:
+        while not stop_event.is_set():
+            chunk_num = chunk_queue.claim(
+                worker_id, lease_seconds=config.lease_seconds
+            )
+            if chunk_num is None:
+                break
+            fname = str(config.chunk_fname) + f"{chunk_num}.{config.chunk_format}"
+            try:
+                # Lease is renewed while the chunk is processed
+                with LeaseHeartbeat(
+                    db_fname, chunk_num, worker_id, config.lease_seconds
+                ):
+                    chunk_df = read_chunk(fname, config.chunk_format)
+                    num_skipped = process_chunk_with_journal(
+                        chunk_df,
+                        chunk_num=chunk_num,
+                        chunk_fname=config.chunk_fname,
+                        result_fname=config.result_fname,
+                        query_func=query_func,
+                        checkpoint_every=config.checkpoint_every,
+                        output_column=config.output_column,
+                    )
+            except Stopped:
+                chunk_queue.release(chunk_num, worker_id)
+                break
+            if num_skipped > 0:
+                # Rows done in an earlier run: Progress, but not throughput
+                metrics_queue.put(("skipped", worker_id, num_skipped))
+            chunk_queue.complete(chunk_num, worker_id)
+            metrics_queue.put(("chunk_done", worker_id, chunk_num))
+    finally:
+        chunk_queue.close()
+        metrics_queue.put(("exit", worker_id))
+
+
+def number_of_rows(
+    config: WorkerConfig, done_nums: list[int]
+) -> tuple[Optional[int], int]:
+    # Total number of rows, and number of rows in chunks `done_nums`, from
+    # the manifest. If there is none, the total is not known
+    manifest_fname = Path(str(config.chunk_fname) + "manifest.json")
+    if not manifest_fname.exists():
+        return None, 0
+    manifest = pd.read_json(manifest_fname)
+    sizes = manifest["end_row"] - manifest["start_row"]
+    return int(sizes.sum()), int(sizes[manifest["id"].isin(done_nums)].sum())
+
+
+def main(config: WorkerConfig, num_workers: int):
+    chunk_queue = ChunkQueue(config.chunk_fname.parent / QUEUE_FNAME)
+    chunk_queue.initialize(config.num_chunks)
+    done_nums = chunk_queue.done_chunks()
+    chunk_queue.close()
+    num_done_before = len(done_nums)
+
+    metrics_queue = mp.Queue()
+    stop_event = mp.Event()
+    workers = [
+        mp.Process(
+            target=run_worker,
+            args=(f"worker{i}-{time.time_ns()}", config, metrics_queue, stop_event),
+        )
+        for i in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    def request_stop(signum, frame):
+        print("\nStopping workers after their current row...")
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+
+    # Rows of chunks done in earlier runs count as progress from the start
+    total_rows, done_rows = number_of_rows(config, done_nums)
+    progress = tqdm(total=total_rows, initial=done_rows, unit="rows")
+    num_rows = 0
+    sum_latency = 0.0
+    num_errors = 0
+    num_chunks_done = num_done_before
+    last_error = None
+    num_running = num_workers
+    start = time.perf_counter()
+    while num_running > 0:
+        try:
+            message = metrics_queue.get(timeout=1)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                break
+            continue
+        kind = message[0]
+        if kind == "rows":
+            _, _, rows, elapsed, errors = message
+            num_rows += rows
+            sum_latency += elapsed
+            num_errors += errors
+            progress.update(rows)
+        elif kind == "skipped":
+            progress.update(message[2])
+        elif kind == "error":
+            last_error = message[2]
+        elif kind == "chunk_done":
+            num_chunks_done += 1
+        elif kind == "exit":
+            num_running -= 1
+        elapsed = time.perf_counter() - start
+        progress.set_postfix(
+            chunks=f"{num_chunks_done}/{config.num_chunks}",
+            rows_per_sec=f"{num_rows / max(elapsed, 1e-9):.1f}",
+            latency_ms=f"{1000 * sum_latency / max(num_rows, 1):.1f}",
+            errors=num_errors,
+        )
+    progress.close()
+    for worker in workers:
+        worker.join()
+    print(f"Chunks done: {num_chunks_done}/{config.num_chunks}, rows processed: "
+          f"{num_rows}, errors: {num_errors}")
+    if last_error is not None:
+        print(f"Last error: {last_error}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    default_path = Path.home() / "datasets" / "tabular_practice"
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument(
+        "--chunk_fname",
+        type=str,
+        default=str(default_path / "chunks" / "nypd_mvc_2018_location_chunk"),
+    )
+    parser.add_argument(
+        "--result_fname",
+        type=str,
+        default=str(default_path / "chunks" / "nypd_mvc_2018_location_address_chunk"),
+    )
+    parser.add_argument(
+        "--chunk_format",
+        type=str,
+        choices=("csv", "parquet", "feather"),
+        default="parquet",
+    )
+    parser.add_argument(
+        "--row_func",
+        type=str,
+        help="Per-row function 'module:function', called with row of chunk "
+             "dataframe. Default: Query address from location (needs "
+             "--user_agent)",
+    )
+    parser.add_argument("--output_column", type=str, default="address")
+    parser.add_argument("--user_agent", type=str)
+    parser.add_argument(
+        "--checkpoint_every", type=int, default=DEFAULT_CHECKPOINT_EVERY
+    )
+    parser.add_argument(
+        "--lease_seconds", type=float, default=DEFAULT_LEASE_SECONDS
+    )
+    args = parser.parse_args()
+    assert args.row_func is not None or args.user_agent is not None, \
+        "--user_agent is required if --row_func is not given"
+
+    chunk_fname = Path(args.chunk_fname)
+    # Number of chunks is determined once here, not by every worker
+    num_chunks = number_of_chunks(args.chunk_fname, args.chunk_format)
+    print(f"Total number of chunks: {num_chunks}")
+    main(
+        config=WorkerConfig(
+            chunk_fname=chunk_fname,
+            result_fname=args.result_fname,
+            chunk_format=args.chunk_format,
+            num_chunks=num_chunks,
+            row_func=args.row_func,
+            output_column=args.output_column,
+            user_agent=args.user_agent,
+            checkpoint_every=args.checkpoint_every,
+            lease_seconds=args.lease_seconds,
+        ),
+        num_workers=args.num_workers,
+    )
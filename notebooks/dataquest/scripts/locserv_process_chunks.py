@@ -9,7 +9,9 @@
 #
 # Still, this code is useful for chunking up work and processing in parallel
 # more generally.
-from typing import Optional, Tuple
+from typing import Callable, Optional, Sequence, Tuple
+import asyncio
+import sys
 from pathlib import Path
 from argparse import ArgumentParser
 from filelock import SoftFileLock
@@ -17,12 +19,47 @@ from geopy.geocoders import Nominatim
 from geopy.extra.rate_limiter import RateLimiter
 from tqdm import tqdm
 
+from script_utils.chunked import read_chunk
+from script_utils.chunked.queue import (
+    ChunkQueue,
+    LeaseHeartbeat,
+    QUEUE_FNAME,
+    DEFAULT_LEASE_SECONDS,
+    default_worker_id,
+)
+from geocode_async import (
+    GeopyBackend,
+    NominatimHTTPBackend,
+    query_address_from_location_async,
+    DEFAULT_MAX_CONCURRENCY,
+)
+from geocode_cache import (
+    GeocodeCache,
+    CacheStatistics,
+    query_addresses_cached,
+    DEFAULT_PRECISION,
+)
+from geocode_offline import (
+    OfflineGeocoder,
+    query_addresses_offline,
+    DEFAULT_MAX_DISTANCE_METRES,
+)
+from chunk_journal import (
+    process_chunk_with_journal,
+    reset_unfinished_chunks,
+    merge_result_chunks,
+    DEFAULT_CHECKPOINT_EVERY,
+)
+
 import pandas as pd
 import numpy as np
 
 
 def query_address_from_location(
-    chunk_df: pd.DataFrame, user_agent: str, use_tqdm: bool
+    chunk_df: pd.DataFrame,
+    user_agent: str,
+    use_tqdm: bool,
+    on_rows: Optional[Callable[[Sequence[int], Sequence], None]] = None,
 ) -> pd.DataFrame:
     """
     For all rows of `chunk_df`, with columns "unique_key" and "location", query
@@ -31,6 +68,8 @@ def query_address_from_location(
     :param chunk_df: Input dataframe
     :param user_agent: Name for querying `Nominatim`
     :param use_tqdm: Use `tqdm` for progress?
+    :param on_rows: Optional. Called as `on_rows([pos], [address])` for
+        every row once it has been queried
     :return: Copy of `chunk_df` with additional column "address", as queried
     """
     geolocator = Nominatim(user_agent=user_agent)
@@ -42,13 +81,20 @@ def query_address_from_location(
 
     # We use a rate limiter (as recommended in the GeoPy docs).
     query_func = RateLimiter(query_func_int, min_delay_seconds=1)
+    locations = chunk_df["location"]
+    if use_tqdm:
+        locations = tqdm(locations)  # Show progress
+    addresses = []
+    for pos, loc in enumerate(locations):
+        address = query_func(loc)
+        if address is None:
+            address = np.nan  # Query failed
+        addresses.append(address)
+        if on_rows is not None:
+            on_rows([pos], [address])
     # The result dataframe contains the unique key, location, and queried address
     result_df = chunk_df.copy()
-    if use_tqdm:
-        tqdm.pandas()  # Show progress
-        result_df["address"] = chunk_df["location"].progress_apply(query_func)
-    else:
-        result_df["address"] = chunk_df["location"].apply(query_func)
+    result_df["address"] = addresses
     return result_df
 
 
@@ -76,12 +122,14 @@ def determine_next_chunk(chunk_fname: Path, num_chunks: int) -> Optional[int]:
         return None
 
 
-def number_of_chunks(chunk_fname: Path) -> int:
-    return len(list(chunk_fname.parent.glob(chunk_fname.name + "*.csv")))
+def number_of_chunks(chunk_fname: Path, chunk_format: str = "parquet") -> int:
+    return len(
+        list(chunk_fname.parent.glob(chunk_fname.name + f"*.{chunk_format}"))
+    )
 
 
 def next_chunk_iterator(
-    chunk_fname: Path, num_chunks: int
+    chunk_fname: Path, num_chunks: int, chunk_format: str = "parquet"
 ) -> Tuple[pd.DataFrame, int]:
     """
     Generator function. Reads the next chunk to be processed.
@@ -92,6 +140,7 @@ def next_chunk_iterator(
 
     :param chunk_fname: Prefix of chunk filenames
     :param num_chunks: Total number of chunks
+    :param chunk_format: Format of chunk files ("csv", "parquet", "feather")
     :return: Dataframe for next chunk, or `None` if no chunk left
     """
     while True:
@@ -108,12 +157,57 @@ def next_chunk_iterator(
             with open(fname, "w") as fp:
                 fp.write(f"{next_chunk_num}\n")
         # Read and return chunk dataframe
-        fname = str(chunk_fname) + f"{next_chunk_num}.csv"
+        fname = str(chunk_fname) + f"{next_chunk_num}.{chunk_format}"
         print(f"Next chunk to process: {fname}")
-        chunk_df = pd.read_csv(fname)
+        chunk_df = read_chunk(fname, chunk_format)
         yield chunk_df, next_chunk_num
 
 
+def next_chunk_iterator_queue(
+    chunk_fname: Path,
+    num_chunks: int,
+    chunk_format: str = "parquet",
+    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+    worker_id: Optional[str] = None,
+) -> Tuple[pd.DataFrame, int]:
+    """
+    Generator function. Variant of :func:`next_chunk_iterator`, where chunks
+    are claimed from a :class:`ChunkQueue` in the chunk directory. The cost of
+    a claim does not depend on the number of chunks. A chunk is marked as done
+    once the caller asks for the next one. Until then, the lease on the chunk
+    is renewed in the background (see :class:`LeaseHeartbeat`). If the worker
+    crashes, the chunk is handed out again once its lease expires, after at
+    most `lease_seconds`.
+
+    :param chunk_fname: Prefix of chunk filenames
+    :param num_chunks: Total number of chunks
+    :param chunk_format: Format of chunk files ("csv", "parquet", "feather")
+    :param lease_seconds: Duration of lease on a chunk
+    :param worker_id: Identifies the worker. Defaults to host name and
+        process ID
+    :return: Dataframe for next chunk, or `None` if no chunk left
+    """
+    if worker_id is None:
+        worker_id = default_worker_id()
+    db_fname = chunk_fname.parent / QUEUE_FNAME
+    queue = ChunkQueue(db_fname)
+    try:
+        queue.initialize(num_chunks)
+        while True:
+            next_chunk_num = queue.claim(worker_id, lease_seconds=lease_seconds)
+            if next_chunk_num is None:
+                break  # Leave iterator loop
+            fname = str(chunk_fname) + f"{next_chunk_num}.{chunk_format}"
+            print(f"Next chunk to process: {fname}")
+            with LeaseHeartbeat(db_fname, next_chunk_num, worker_id, lease_seconds):
+                chunk_df = read_chunk(fname, chunk_format)
+                yield chunk_df, next_chunk_num
+            if not queue.complete(next_chunk_num, worker_id):
+                print(f"Lease on chunk {next_chunk_num} had expired")
+    finally:
+        queue.close()
+
+
 if __name__ == "__main__":
     parser = ArgumentParser()
     default_path = Path.home() / "datasets" / "tabular_practice"
@@ -129,17 +223,204 @@ if __name__ == "__main__":
         type=str,
         default=str(default_path / "chunks" / "nypd_mvc_2018_location_address_chunk"),
     )
+    parser.add_argument(
+        "--chunk_format",
+        type=str,
+        choices=("csv", "parquet", "feather"),
+        default="parquet",
+    )
+    parser.add_argument(
+        "--claim_backend",
+        type=str,
+        choices=("lock", "queue"),
+        default="lock",
+        help="lock: Claim chunks by writing '.started' files under a file "
+             "lock. queue: Claim chunks from a SQLite work queue, with leases "
+             "which expire after --lease_seconds",
+    )
+    parser.add_argument(
+        "--lease_seconds", type=float, default=DEFAULT_LEASE_SECONDS
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=("serial", "async"),
+        default="serial",
+        help="serial: One request per second. async: Concurrent requests, "
+             "limited by --rate and --max_concurrency",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=1.0,
+        help="Maximum number of requests per second (--engine async)",
+    )
+    parser.add_argument(
+        "--max_concurrency", type=int, default=DEFAULT_MAX_CONCURRENCY
+    )
+    parser.add_argument(
+        "--geocoder_url",
+        type=str,
+        help="Base URL of Nominatim compatible server (--engine async). If "
+             "not given, the public Nominatim service is used via geopy",
+    )
+    parser.add_argument(
+        "--geocode_cache",
+        type=str,
+        help="SQLite file for caching addresses by quantized location. If "
+             "given, rows of a chunk are deduplicated, and only locations not "
+             "in the cache are queried",
+    )
+    parser.add_argument(
+        "--cache_precision",
+        type=int,
+        default=DEFAULT_PRECISION,
+        help="Number of decimal digits locations are quantized to",
+    )
+    parser.add_argument(
+        "--reference_csv",
+        type=str,
+        help="CSV file with columns latitude, longitude, address. If given, "
+             "locations are resolved offline to the nearest reference "
+             "address, and only those further than --max_distance are queried",
+    )
+    parser.add_argument(
+        "--max_distance",
+        type=float,
+        default=DEFAULT_MAX_DISTANCE_METRES,
+        help="Distance threshold (in metres) for offline geocoding",
+    )
+    parser.add_argument(
+        "--checkpoint_every",
+        type=int,
+        default=DEFAULT_CHECKPOINT_EVERY,
+        help="Results are appended to a journal after this many rows. When a "
+             "chunk is processed again, rows in the journal are skipped",
+    )
+    parser.add_argument(
+        "--reset_unfinished",
+        action="store_true",
+        help="Before processing, remove '.started' markers of chunks which "
+             "are not done (e.g., after a crash). Only use if no other "
+             "workers are running",
+    )
+    parser.add_argument(
+        "--merge_fname",
+        type=str,
+        help="If given, chunks are not processed. Instead, all result chunks "
+             "are merged into this Parquet file",
+    )
     args = parser.parse_args()
 
+    if args.engine == "async":
+        if args.geocoder_url is not None:
+            backend = NominatimHTTPBackend(
+                args.geocoder_url,
+                user_agent=args.user_agent,
+                max_workers=args.max_concurrency,
+            )
+        else:
+            backend = GeopyBackend(
+                Nominatim(user_agent=args.user_agent),
+                max_workers=args.max_concurrency,
+            )
+
     chunk_fname = Path(args.chunk_fname)
-    num_chunks = number_of_chunks(chunk_fname)
+    num_chunks = number_of_chunks(chunk_fname, args.chunk_format)
     print(f"Total number of chunks: {num_chunks}")
+    if args.merge_fname is not None:
+        num_rows = merge_result_chunks(
+            args.result_fname, num_chunks, args.merge_fname
+        )
+        print(f"Merged {num_rows} rows into {args.merge_fname}")
+        sys.exit(0)
+    if args.reset_unfinished:
+        reset_nums = reset_unfinished_chunks(chunk_fname)
+        print(f"Reset unfinished chunks: {reset_nums}")
+    if args.claim_backend == "queue":
+        chunk_iterator = next_chunk_iterator_queue(
+            chunk_fname,
+            num_chunks,
+            args.chunk_format,
+            lease_seconds=args.lease_seconds,
+        )
+    else:
+        chunk_iterator = next_chunk_iterator(
+            chunk_fname, num_chunks, args.chunk_format
+        )
+    def remote_query_func(df: pd.DataFrame, on_rows=None) -> pd.DataFrame:
+        if args.engine == "async":
+            progress = tqdm(total=df.shape[0]) if args.use_tqdm else None
+            result_df = query_address_from_location_async(
+                df,
+                backend=backend,
+                rate=args.rate,
+                max_concurrency=args.max_concurrency,
+                progress=progress,
+                on_rows=on_rows,
+            )
+            if progress is not None:
+                progress.close()
+            return result_df
+        else:
+            return query_address_from_location(
+                df,
+                user_agent=args.user_agent,
+                use_tqdm=args.use_tqdm,
+                on_rows=on_rows,
+            )
+
+    if args.reference_csv is not None:
+        offline_geocoder = OfflineGeocoder.from_csv(args.reference_csv)
+
+        def query_func(df: pd.DataFrame, on_rows=None) -> pd.DataFrame:
+            return query_addresses_offline(
+                df,
+                geocoder=offline_geocoder,
+                max_distance=args.max_distance,
+                query_func=remote_query_func,
+                on_rows=on_rows,
+            )
+    else:
+        query_func = remote_query_func
+
+    if args.geocode_cache is not None:
+        cache = GeocodeCache(
+            Path(args.geocode_cache), precision=args.cache_precision
+        )
+    else:
+        cache = None
     # Iterate over chunks until no more are available
-    for chunk_df, next_chunk_num in next_chunk_iterator(chunk_fname, num_chunks):
-        result_df = query_address_from_location(
-            chunk_df, user_agent=args.user_agent, use_tqdm=args.use_tqdm,
+    for chunk_df, next_chunk_num in chunk_iterator:
+        chunk_stats = CacheStatistics()
+
+        def chunk_query_func(df: pd.DataFrame, on_rows=None) -> pd.DataFrame:
+            if cache is None:
+                return query_func(df, on_rows=on_rows)
+            result_df, stats = query_addresses_cached(
+                df, query_func, cache, on_rows=on_rows
+            )
+            chunk_stats.update(stats)
+            return result_df
+
+        # All rows of the chunk not done yet are queried in a single call.
+        # Results are written to a journal as they arrive, and promoted to
+        # the result file once the chunk is done
+        num_skipped = process_chunk_with_journal(
+            chunk_df,
+            chunk_num=next_chunk_num,
+            chunk_fname=chunk_fname,
+            result_fname=args.result_fname,
+            query_func=chunk_query_func,
+            checkpoint_every=args.checkpoint_every,
         )
-        fname = args.result_fname + f"{next_chunk_num}.csv"
-        result_df.to_csv(fname, index=False)
+        if num_skipped > 0:
+            print(f"Chunk {next_chunk_num}: {num_skipped} rows found in journal")
+        if cache is not None:
+            print(f"Chunk {next_chunk_num}: {chunk_stats}")
 
+    if cache is not None:
+        cache.close()
+    if args.engine == "async":
+        asyncio.run(backend.close())
     print("No more chunks available. Terminating.")
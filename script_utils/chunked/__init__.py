@@ -0,0 +1,31 @@
+from script_utils.chunked.formats import (
+    CHUNK_FORMATS,
+    chunk_path,
+    read_chunk,
+    write_chunk,
+)
+from script_utils.chunked.queue import ChunkQueue, LeaseHeartbeat, default_worker_id
+from script_utils.chunked.mapreduce import (
+    create_chunks,
+    number_of_chunks,
+    map_chunks,
+    map_worker,
+    reduce_chunks,
+    MapConfig,
+)
+
+__all__ = [
+    "CHUNK_FORMATS",
+    "chunk_path",
+    "read_chunk",
+    "write_chunk",
+    "ChunkQueue",
+    "LeaseHeartbeat",
+    "default_worker_id",
+    "create_chunks",
+    "number_of_chunks",
+    "map_chunks",
+    "map_worker",
+    "reduce_chunks",
+    "MapConfig",
+]
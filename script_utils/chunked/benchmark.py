@@ -0,0 +1,153 @@
+"""
+Benchmarks for the chunked map-reduce pipeline. Run as:
+
+    python -m script_utils.chunked.benchmark --num_rows 1000000 10000000
+
+For each size, a synthetic dataframe is split into chunks, a simple map is
+applied to all chunks, and results are concatenated into a single Parquet
+file. Afterwards, the work queue is benchmarked on its own, claiming and
+completing many chunks with many processes.
+"""
+import tempfile
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from script_utils.chunked.mapreduce import (
+    create_chunks,
+    map_chunks,
+    reduce_chunks,
+)
+from script_utils.chunked.queue import ChunkQueue, QUEUE_FNAME
+
+
+def synthetic_dataframe(num_rows: int, seed: int = 0) -> pd.DataFrame:
+    random_state = np.random.RandomState(seed)
+    return pd.DataFrame(
+        {
+            "id": np.arange(num_rows),
+            "latitude": random_state.uniform(-90, 90, size=num_rows),
+            "longitude": random_state.uniform(-180, 180, size=num_rows),
+            "category": random_state.randint(0, 100, size=num_rows),
+        }
+    )
+
+
+def synthetic_map(chunk_df: pd.DataFrame) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "id": chunk_df["id"],
+            "distance": np.hypot(chunk_df["latitude"], chunk_df["longitude"]),
+            "category": chunk_df["category"],
+        }
+    )
+
+
+def benchmark_pipeline(
+    num_rows: int,
+    chunk_size: int,
+    num_workers: int,
+    chunk_format: str,
+    executor_type: str,
+):
+    data_df = synthetic_dataframe(num_rows)
+    with tempfile.TemporaryDirectory() as tmp_path:
+        chunk_fname = str(Path(tmp_path) / "chunks" / "chunk")
+        result_fname = str(Path(tmp_path) / "results" / "result")
+        Path(result_fname).parent.mkdir()
+        timings = dict()
+        start = time.perf_counter()
+        manifest = create_chunks(
+            data_df,
+            chunk_fname=chunk_fname,
+            chunk_size=chunk_size,
+            chunk_format=chunk_format,
+            num_workers=num_workers,
+        )
+        timings["create"] = time.perf_counter() - start
+        start = time.perf_counter()
+        map_chunks(
+            chunk_fname=chunk_fname,
+            result_fname=result_fname,
+            map_func=synthetic_map,
+            chunk_format=chunk_format,
+            executor_type=executor_type,
+            num_workers=num_workers,
+        )
+        timings["map"] = time.perf_counter() - start
+        start = time.perf_counter()
+        num_output = reduce_chunks(
+            result_fname,
+            num_chunks=len(manifest),
+            output_fname=Path(tmp_path) / "output.parquet",
+        )
+        timings["reduce"] = time.perf_counter() - start
+    assert num_output == num_rows, (num_output, num_rows)
+    total = sum(timings.values())
+    parts = ", ".join(f"{name} {value:.2f}" for name, value in timings.items())
+    print(f"num_rows = {num_rows}, num_chunks = {len(manifest)}: "
+          f"{total:.2f} secs ({parts}), {num_rows / total:.0f} rows/sec")
+
+
+def _queue_worker(db_fname: str, worker_id: str) -> int:
+    queue = ChunkQueue(Path(db_fname))
+    num_claimed = 0
+    while (num := queue.claim(worker_id)) is not None:
+        queue.complete(num, worker_id)
+        num_claimed += 1
+    queue.close()
+    return num_claimed
+
+
+def benchmark_queue(num_chunks: int, num_workers: int):
+    with tempfile.TemporaryDirectory() as tmp_path:
+        db_fname = str(Path(tmp_path) / QUEUE_FNAME)
+        queue = ChunkQueue(Path(db_fname))
+        queue.initialize(num_chunks)
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            num_claimed = sum(
+                executor.map(
+                    _queue_worker,
+                    [db_fname] * num_workers,
+                    [f"worker{i}" for i in range(num_workers)],
+                )
+            )
+        elapsed = time.perf_counter() - start
+        print(f"Claimed {num_claimed} chunks with {num_workers} workers in "
+              f"{elapsed:.2f} secs ({num_claimed / elapsed:.0f} claims/sec)")
+        print(queue.counts())
+        queue.close()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--num_rows",
+        type=int,
+        nargs="+",
+        default=[1000000, 10000000],
+        help="Sizes of synthetic dataframes. Use 100000000 for the largest "
+             "benchmark (needs about 16 GB of memory)",
+    )
+    parser.add_argument("--chunk_size", type=int, default=500000)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--chunk_format", type=str, default="parquet")
+    parser.add_argument("--executor_type", type=str, default="process")
+    parser.add_argument("--queue_num_chunks", type=int, default=10000)
+    parser.add_argument("--queue_num_workers", type=int, default=32)
+    args = parser.parse_args()
+
+    for num_rows in args.num_rows:
+        benchmark_pipeline(
+            num_rows=num_rows,
+            chunk_size=args.chunk_size,
+            num_workers=args.num_workers,
+            chunk_format=args.chunk_format,
+            executor_type=args.executor_type,
+        )
+    benchmark_queue(args.queue_num_chunks, args.queue_num_workers)
@@ -0,0 +1,61 @@
+import hashlib
+from pathlib import Path
+
+import pandas as pd
+
+
+CHUNK_FORMATS = ("csv", "parquet", "feather")
+
+
+def chunk_path(prefix: str | Path, num: int, chunk_format: str) -> Path:
+    """
+    :param prefix: Prefix of chunk filenames
+    :param num: Chunk number
+    :param chunk_format: Format, see `CHUNK_FORMATS`
+    :return: Path of chunk file
+    """
+    return Path(str(prefix) + f"{num}.{chunk_format}")
+
+
+def read_chunk(path: str | Path, chunk_format: str) -> pd.DataFrame:
+    """
+    :param path: Path of chunk file
+    :param chunk_format: Format, see `CHUNK_FORMATS`
+    :return: Chunk dataframe
+    """
+    if chunk_format == "parquet":
+        return pd.read_parquet(path)
+    elif chunk_format == "feather":
+        return pd.read_feather(path)
+    else:
+        return pd.read_csv(path)
+
+
+def write_chunk(
+    chunk_df: pd.DataFrame, path: str | Path, chunk_format: str
+) -> str:
+    """
+    Writes chunk to file `path`. The file is written under a temporary name
+    first, and then renamed, so readers never see a partially written chunk.
+
+    :param chunk_df: Chunk dataframe
+    :param path: Path of chunk file
+    :param chunk_format: Format, see `CHUNK_FORMATS`
+    :return: SHA-256 checksum of file written
+    """
+    assert chunk_format in CHUNK_FORMATS, \
+        f"chunk_format = '{chunk_format}' not supported, must be in {CHUNK_FORMATS}"
+    path = Path(path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    if chunk_format == "csv":
+        chunk_df.to_csv(tmp_path, index=False)
+    elif chunk_format == "parquet":
+        chunk_df.to_parquet(tmp_path, index=False)
+    else:
+        chunk_df.reset_index(drop=True).to_feather(tmp_path)
+    digest = hashlib.sha256()
+    with open(tmp_path, "rb") as fp:
+        while block := fp.read(1 << 20):
+            digest.update(block)
+    tmp_path.replace(path)
+    return digest.hexdigest()
@@ -0,0 +1,301 @@
+import json
+import re
+import threading
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Iterable
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from script_utils.chunked.formats import (
+    chunk_path,
+    read_chunk,
+    write_chunk,
+)
+from script_utils.chunked.queue import (
+    ChunkQueue,
+    LeaseHeartbeat,
+    QUEUE_FNAME,
+    DEFAULT_LEASE_SECONDS,
+    default_worker_id,
+)
+
+
+MANIFEST_SUFFIX = "manifest.json"
+
+EXECUTOR_TYPES = ("process", "thread")
+
+
+def _make_executor(executor_type: str, num_workers: int):
+    assert executor_type in EXECUTOR_TYPES, \
+        f"executor_type = '{executor_type}' not supported, must be in {EXECUTOR_TYPES}"
+    if executor_type == "process":
+        return ProcessPoolExecutor(max_workers=num_workers)
+    else:
+        return ThreadPoolExecutor(max_workers=num_workers)
+
+
+def create_chunks(
+    data: pd.DataFrame | Iterable[pd.DataFrame],
+    chunk_fname: str,
+    chunk_size: int,
+    chunk_format: str = "parquet",
+    num_workers: int = 4,
+) -> list[dict]:
+    """
+    Splits `data` into chunks of `chunk_size` rows (the final one may be
+    smaller), which are written to files `chunk_fname + f"{num}.{format}"`.
+    `data` can be a dataframe, or an iterable of dataframes (e.g., from
+    `pd.read_csv(..., chunksize=...)`), which are consumed as they arrive.
+    Chunks are written by a pool of `num_workers` threads, and at most
+    `2 * num_workers` chunks are held in memory at any time.
+
+    A manifest is written to `chunk_fname + "manifest.json"`, recording
+    filename, row range, and checksum of every chunk.
+
+    :param data: Input dataframe, or iterable of dataframes
+    :param chunk_fname: Prefix of chunk filenames
+    :param chunk_size: Number of rows per chunk
+    :param chunk_format: Format of chunk files, see `CHUNK_FORMATS`
+    :param num_workers: Number of threads writing chunks
+    :return: Manifest entries, one per chunk
+    """
+    assert chunk_size > 0, f"chunk_size = {chunk_size} must be positive"
+    if isinstance(data, pd.DataFrame):
+        data = [data]
+    Path(chunk_fname).parent.mkdir(parents=True, exist_ok=True)
+    manifest = []
+    in_flight: list[tuple[dict, Future]] = []
+
+    def collect():
+        entry, future = in_flight.pop(0)
+        entry["checksum"] = future.result()
+        manifest.append(entry)
+
+    def submit(executor: ThreadPoolExecutor, chunk_df: pd.DataFrame):
+        num = len(manifest) + len(in_flight)
+        start = num * chunk_size
+        entry = dict(
+            id=num,
+            fname=str(chunk_path(chunk_fname, num, chunk_format)),
+            start_row=start,
+            end_row=start + chunk_df.shape[0],
+        )
+        future = executor.submit(write_chunk, chunk_df, entry["fname"], chunk_format)
+        in_flight.append((entry, future))
+        while len(in_flight) > 2 * num_workers:
+            collect()
+
+    buffer = []
+    num_buffered = 0
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for piece_df in data:
+            buffer.append(piece_df)
+            num_buffered += piece_df.shape[0]
+            if num_buffered >= chunk_size:
+                joined_df = pd.concat(buffer) if len(buffer) > 1 else buffer[0]
+                num_full = num_buffered // chunk_size
+                for start in range(0, num_full * chunk_size, chunk_size):
+                    submit(executor, joined_df.iloc[start:(start + chunk_size)])
+                buffer = [joined_df.iloc[(num_full * chunk_size):]]
+                num_buffered = buffer[0].shape[0]
+        if num_buffered > 0:
+            submit(executor, pd.concat(buffer))
+        while in_flight:
+            collect()
+    with open(chunk_fname + MANIFEST_SUFFIX, "w") as fp:
+        json.dump(manifest, fp, indent=1)
+    return manifest
+
+
+def number_of_chunks(chunk_fname: str, chunk_format: str) -> int:
+    """
+    :param chunk_fname: Prefix of chunk filenames
+    :param chunk_format: Format of chunk files
+    :return: Number of chunk files, named `chunk_fname + f"{num}.{format}"`
+    """
+    prefix = Path(chunk_fname)
+    # Glob patterns are not enough, "chunk*" also matches "chunk_b0.parquet"
+    pattern = re.compile(
+        re.escape(prefix.name) + r"\d+\." + re.escape(chunk_format)
+    )
+    return sum(
+        1 for path in prefix.parent.iterdir() if pattern.fullmatch(path.name)
+    )
+
+
+@dataclass(frozen=True)
+class MapConfig:
+    chunk_fname: str
+    result_fname: str
+    num_chunks: int
+    map_func: Callable[[pd.DataFrame], pd.DataFrame]
+    chunk_format: str = "parquet"
+    result_format: str = "parquet"
+    lease_seconds: float = DEFAULT_LEASE_SECONDS
+
+
+def map_worker(config: MapConfig, worker_id: str | None = None) -> list[int]:
+    """
+    Worker loop of :func:`map_chunks`. Claims chunks from the queue in the
+    chunk directory, until no more are left. For each chunk, `map_func` is
+    applied, and the result is written to
+    `result_fname + f"{num}.{result_format}"`. While this runs, the lease on
+    the chunk is renewed (see :class:`LeaseHeartbeat`). Can also be run in
+    processes started independently (e.g., on the same host from several
+    terminals).
+
+    :param config: Configuration
+    :param worker_id: Identifies the worker. Defaults to host name, process ID
+        and thread ID
+    :return: Numbers of chunks processed by this worker
+    """
+    if worker_id is None:
+        worker_id = f"{default_worker_id()}-{threading.get_ident()}"
+    db_fname = Path(config.chunk_fname).parent / QUEUE_FNAME
+    queue = ChunkQueue(db_fname)
+    done = []
+    try:
+        while True:
+            num = queue.claim(worker_id, lease_seconds=config.lease_seconds)
+            if num is None:
+                break
+            with LeaseHeartbeat(db_fname, num, worker_id, config.lease_seconds):
+                chunk_df = read_chunk(
+                    chunk_path(config.chunk_fname, num, config.chunk_format),
+                    config.chunk_format,
+                )
+                result_df = config.map_func(chunk_df)
+                write_chunk(
+                    result_df,
+                    chunk_path(config.result_fname, num, config.result_format),
+                    config.result_format,
+                )
+            if queue.complete(num, worker_id):
+                done.append(num)
+    finally:
+        queue.close()
+    return done
+
+
+def map_chunks(
+    chunk_fname: str,
+    result_fname: str,
+    map_func: Callable[[pd.DataFrame], pd.DataFrame],
+    chunk_format: str = "parquet",
+    result_format: str = "parquet",
+    executor_type: str = "process",
+    num_workers: int = 4,
+    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+) -> int:
+    """
+    Applies `map_func` to all chunks, using a pool of `num_workers` workers,
+    each running :func:`map_worker`. Chunks are claimed with leases (see
+    :class:`ChunkQueue`), so that several calls (e.g., from different
+    processes on the same host) can share the work, and chunks of crashed
+    workers are processed again once their lease expires. Chunks already
+    done in an earlier call are skipped.
+
+    With `executor_type="process"`, `map_func` must be picklable (e.g., a
+    function defined at module level).
+
+    :param chunk_fname: Prefix of chunk filenames
+    :param result_fname: Prefix of result filenames
+    :param map_func: Maps chunk dataframe to result dataframe
+    :param chunk_format: Format of chunk files, see `CHUNK_FORMATS`
+    :param result_format: Format of result files, see `CHUNK_FORMATS`
+    :param executor_type: "process" or "thread"
+    :param num_workers: Number of workers
+    :param lease_seconds: Duration of lease on a chunk
+    :return: Number of chunks processed in this call
+    """
+    num_chunks = number_of_chunks(chunk_fname, chunk_format)
+    queue = ChunkQueue(Path(chunk_fname).parent / QUEUE_FNAME)
+    queue.initialize(num_chunks)
+    queue.close()
+    config = MapConfig(
+        chunk_fname=chunk_fname,
+        result_fname=result_fname,
+        num_chunks=num_chunks,
+        map_func=map_func,
+        chunk_format=chunk_format,
+        result_format=result_format,
+        lease_seconds=lease_seconds,
+    )
+    with _make_executor(executor_type, num_workers) as executor:
+        futures = [
+            executor.submit(map_worker, config, f"{default_worker_id()}-{pos}")
+            for pos in range(num_workers)
+        ]
+        return sum(len(future.result()) for future in futures)
+
+
+def reduce_chunks(
+    result_fname: str,
+    num_chunks: int,
+    result_format: str = "parquet",
+    reduce_func: Callable[[Any, pd.DataFrame], Any] | None = None,
+    initial: Any = None,
+    output_fname: str | Path | None = None,
+) -> Any:
+    """
+    Reduce stage over result chunks `0, ..., num_chunks - 1`, reading one
+    chunk at a time.
+
+    If `output_fname` is given, result chunks are concatenated into this
+    Parquet file, and the number of rows is returned. The schema is taken from
+    the first chunk. Otherwise, `reduce_func(acc, chunk_df)` is folded over
+    the chunks, starting from `acc = initial`, and the final `acc` is
+    returned.
+
+    :param result_fname: Prefix of result filenames
+    :param num_chunks: Number of chunks
+    :param result_format: Format of result files, see `CHUNK_FORMATS`
+    :param reduce_func: See above
+    :param initial: See above
+    :param output_fname: See above
+    :return: See above
+    """
+    assert (reduce_func is None) != (output_fname is None), \
+        "Exactly one of reduce_func, output_fname must be given"
+    paths = [
+        chunk_path(result_fname, num, result_format) for num in range(num_chunks)
+    ]
+    if output_fname is None:
+        acc = initial
+        for path in paths:
+            acc = reduce_func(acc, read_chunk(path, result_format))
+        return acc
+
+    output_fname = Path(output_fname)
+    tmp_fname = output_fname.with_name(output_fname.name + ".tmp")
+    writer = None
+    num_rows = 0
+    try:
+        try:
+            for path in paths:
+                table = pa.Table.from_pandas(
+                    read_chunk(path, result_format), preserve_index=False
+                )
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp_fname, table.schema)
+                else:
+                    table = table.cast(writer.schema)
+                writer.write_table(table)
+                num_rows += table.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
+    except BaseException:
+        tmp_fname.unlink(missing_ok=True)
+        raise
+    if writer is not None:
+        tmp_fname.replace(output_fname)
+    return num_rows
@@ -0,0 +1,238 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+QUEUE_FNAME = "claims.sqlite"
+
+DEFAULT_LEASE_SECONDS = 1800.0
+
+PENDING = 0
+
+CLAIMED = 1
+
+DONE = 2
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class ChunkQueue:
+    """
+    Work queue for chunks `0, 1, ..., num_chunks - 1`, stored in SQLite
+    database `db_fname` (in WAL mode), with one row per chunk. A claim is a
+    single short write transaction, using an index to find the next free
+    chunk, so its cost does not depend on the number of chunks or workers.
+
+    Claims are leases: a worker must complete (or renew) its chunk before the
+    lease expires, otherwise the chunk can be claimed by other workers. This
+    way, chunks left behind by crashed workers are processed eventually.
+
+    Every process must create its own object.
+    """
+    def __init__(self, db_fname: Path, timeout: float = 120):
+        self._conn = sqlite3.connect(
+            str(db_fname), timeout=timeout, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "num INTEGER PRIMARY KEY, "
+            "state INTEGER NOT NULL, "
+            "owner TEXT, "
+            "lease_expires REAL)"
+        )
+        # One index for each query of `claim`, so that neither needs to sort
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS chunks_state_num ON chunks (state, num)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS chunks_state "
+            "ON chunks (state, lease_expires, num)"
+        )
+
+    def close(self):
+        self._conn.close()
+
+    def initialize(self, num_chunks: int):
+        """
+        Adds chunks `0, ..., num_chunks - 1` to the queue, unless already
+        present. Safe to be called by every worker.
+
+        :param num_chunks: Total number of chunks
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO chunks (num, state) VALUES (?, ?)",
+                ((num, PENDING) for num in range(num_chunks)),
+            )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def claim(
+        self,
+        worker_id: str,
+        lease_seconds: float = DEFAULT_LEASE_SECONDS,
+    ) -> int | None:
+        """
+        Claims the pending chunk with the smallest number. If there is none,
+        a chunk whose lease has expired is claimed.
+
+        :param worker_id: Identifies the worker
+        :param lease_seconds: Duration of lease
+        :return: Number of chunk claimed, or `None` if no chunk left
+        """
+        now = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._conn.execute(
+                "SELECT num FROM chunks WHERE state = ? ORDER BY num LIMIT 1",
+                (PENDING,),
+            ).fetchone()
+            if row is None:
+                row = self._conn.execute(
+                    "SELECT num FROM chunks WHERE state = ? AND lease_expires < ? "
+                    "ORDER BY lease_expires LIMIT 1",
+                    (CLAIMED, now),
+                ).fetchone()
+            if row is not None:
+                self._conn.execute(
+                    "UPDATE chunks SET state = ?, owner = ?, lease_expires = ? "
+                    "WHERE num = ?",
+                    (CLAIMED, worker_id, now + lease_seconds, row[0]),
+                )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return None if row is None else row[0]
+
+    def renew(
+        self,
+        num: int,
+        worker_id: str,
+        lease_seconds: float = DEFAULT_LEASE_SECONDS,
+    ) -> bool:
+        """
+        Extends lease on chunk `num`.
+
+        :param num: Chunk number
+        :param worker_id: Identifies the worker
+        :param lease_seconds: Duration of lease (from now)
+        :return: Was the lease still held by `worker_id`?
+        """
+        cursor = self._conn.execute(
+            "UPDATE chunks SET lease_expires = ? "
+            "WHERE num = ? AND state = ? AND owner = ?",
+            (time.time() + lease_seconds, num, CLAIMED, worker_id),
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, num: int, worker_id: str) -> bool:
+        """
+        Marks chunk `num` as done.
+
+        :param num: Chunk number
+        :param worker_id: Identifies the worker
+        :return: Was the lease still held by `worker_id`? If not, another
+            worker may have claimed the chunk in the meantime
+        """
+        cursor = self._conn.execute(
+            "UPDATE chunks SET state = ?, lease_expires = NULL "
+            "WHERE num = ? AND state = ? AND owner = ?",
+            (DONE, num, CLAIMED, worker_id),
+        )
+        return cursor.rowcount == 1
+
+    def release(self, num: int, worker_id: str) -> bool:
+        """
+        Returns chunk `num` to the queue, so it can be claimed again right
+        away (e.g., when a worker is stopped before it is done).
+
+        :param num: Chunk number
+        :param worker_id: Identifies the worker
+        :return: Was the lease still held by `worker_id`?
+        """
+        cursor = self._conn.execute(
+            "UPDATE chunks SET state = ?, owner = NULL, lease_expires = NULL "
+            "WHERE num = ? AND state = ? AND owner = ?",
+            (PENDING, num, CLAIMED, worker_id),
+        )
+        return cursor.rowcount == 1
+
+    def done_chunks(self) -> list[int]:
+        """
+        :return: Numbers of chunks done, in increasing order
+        """
+        rows = self._conn.execute(
+            "SELECT num FROM chunks WHERE state = ? ORDER BY num", (DONE,)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def counts(self) -> dict[str, int]:
+        """
+        :return: Number of chunks pending, claimed, done
+        """
+        rows = self._conn.execute(
+            "SELECT state, COUNT(*) FROM chunks GROUP BY state"
+        ).fetchall()
+        names = {PENDING: "pending", CLAIMED: "claimed", DONE: "done"}
+        result = {name: 0 for name in names.values()}
+        result.update({names[state]: count for state, count in rows})
+        return result
+
+
+class LeaseHeartbeat:
+    """
+    Context manager which renews the lease of `worker_id` on chunk `num`
+    every `lease_seconds / 3` seconds, from a background thread, until the
+    context is left. Use this while a chunk is processed, so that the lease
+    does not expire for chunks which take longer than `lease_seconds`, while
+    chunks of crashed workers are still handed out again after at most
+    `lease_seconds`.
+
+    The thread uses its own connection to `db_fname`. If the lease is found
+    to be lost (e.g., it expired before the first renewal), `lost` is set and
+    renewals stop.
+    """
+    def __init__(
+        self,
+        db_fname: Path,
+        num: int,
+        worker_id: str,
+        lease_seconds: float = DEFAULT_LEASE_SECONDS,
+    ):
+        self.num = num
+        self.lost = False
+        self._db_fname = db_fname
+        self._worker_id = worker_id
+        self._lease_seconds = lease_seconds
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        queue = ChunkQueue(self._db_fname)
+        try:
+            while not self._stop_event.wait(self._lease_seconds / 3):
+                if not queue.renew(self.num, self._worker_id, self._lease_seconds):
+                    self.lost = True
+                    break
+        finally:
+            queue.close()
+
+    def __enter__(self) -> "LeaseHeartbeat":
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop_event.set()
+        self._thread.join()
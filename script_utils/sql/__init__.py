@@ -1,11 +1,79 @@
-from script_utils.sql.engine import ConnectionConfig, get_database_engine
-from script_utils.sql.queries import run_sql_queries, run_sql_query
-from script_utils.sql.metadata import DatabaseMetaData
-
-__all__ = [
-    "ConnectionConfig",
-    "get_database_engine",
-    "run_sql_queries",
-    "run_sql_query",
-    "DatabaseMetaData",
-]
+# Attributes are loaded lazily on first access (see `__getattr__`), so that
+# importing the package does not pull in pandas, SQLAlchemy, or pyarrow. This
+# matters for short CLI jobs, which may only need `ConnectionConfig`. Use
+# `python -m script_utils.sql.import_benchmark` to check import times.
+from importlib import import_module
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from script_utils.sql.engine import (
+        ConnectionConfig,
+        get_database_engine,
+        dispose_engines,
+    )
+    from script_utils.sql.queries import (
+        run_sql_queries,
+        run_sql_query,
+        run_sql_queries_parallel,
+        iter_sql_queries_chunks,
+        iter_sql_query_chunks,
+    )
+    from script_utils.sql.metadata import DatabaseMetaData
+    from script_utils.sql.cache import QueryResultCache
+    from script_utils.sql.bulk import bulk_load
+    from script_utils.sql.compact import ResultCompactor, compact_column
+    from script_utils.sql.instrumentation import (
+        QueryRecord,
+        QuerySink,
+        CallbackSink,
+        HistogramSink,
+        SlowQueryLog,
+        QueryInstrumentation,
+    )
+    from script_utils.sql.arrow import (
+        iter_sql_query_record_batches,
+        run_sql_query_arrow,
+        export_query_to_parquet,
+    )
+
+# Maps attribute name to the submodule it is defined in
+_LAZY_ATTRIBUTES = {
+    "ConnectionConfig": "engine",
+    "get_database_engine": "engine",
+    "dispose_engines": "engine",
+    "run_sql_queries": "queries",
+    "run_sql_query": "queries",
+    "run_sql_queries_parallel": "queries",
+    "iter_sql_queries_chunks": "queries",
+    "iter_sql_query_chunks": "queries",
+    "DatabaseMetaData": "metadata",
+    "QueryResultCache": "cache",
+    "bulk_load": "bulk",
+    "ResultCompactor": "compact",
+    "compact_column": "compact",
+    "QueryRecord": "instrumentation",
+    "QuerySink": "instrumentation",
+    "CallbackSink": "instrumentation",
+    "HistogramSink": "instrumentation",
+    "SlowQueryLog": "instrumentation",
+    "QueryInstrumentation": "instrumentation",
+    "iter_sql_query_record_batches": "arrow",
+    "run_sql_query_arrow": "arrow",
+    "export_query_to_parquet": "arrow",
+}
+
+__all__ = list(_LAZY_ATTRIBUTES.keys())
+
+
+def __getattr__(name: str):
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(f"{__name__}.{module_name}"), name)
+    # Cache in module namespace, so `__getattr__` is not called again
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted(set(globals().keys()) | set(__all__))
@@ -0,0 +1,246 @@
+from pathlib import Path
+from typing import Iterator
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy.sql import text
+from sqlalchemy.engine import Engine
+
+from script_utils.sql.consts import SQL_DEFAULT_CHUNKSIZE
+
+
+# Arrow types for MySQL protocol field types, as reported in
+# `cursor.description` by MySQL drivers. String and binary columns share
+# field types, so these are left to inference from values
+_MYSQL_FIELD_TYPES = {
+    1: pa.int64(),  # TINY
+    2: pa.int64(),  # SHORT
+    3: pa.int64(),  # LONG
+    4: pa.float64(),  # FLOAT
+    5: pa.float64(),  # DOUBLE
+    7: pa.timestamp("us"),  # TIMESTAMP
+    8: pa.int64(),  # LONGLONG
+    9: pa.int64(),  # INT24
+    10: pa.date32(),  # DATE
+    11: pa.duration("us"),  # TIME
+    12: pa.timestamp("us"),  # DATETIME
+    13: pa.int64(),  # YEAR
+}
+
+_MYSQL_DECIMAL_FIELD_TYPES = (0, 246)  # DECIMAL, NEWDECIMAL
+
+
+def _decimal_type(precision: int, scale: int) -> pa.DataType:
+    if precision <= 38:
+        return pa.decimal128(precision, scale)
+    return pa.decimal256(min(precision, 76), scale)
+
+
+def _description_types(description) -> list[pa.DataType | None]:
+    # Type codes are dialect specific. Drivers other than MySQL (e.g.,
+    # `sqlite3`) report none, so all columns are left to inference
+    types = []
+    for column in description:
+        type_code = column[1]
+        data_type = None
+        if isinstance(type_code, int):
+            if type_code in _MYSQL_DECIMAL_FIELD_TYPES:
+                precision, scale = column[4], column[5]
+                if precision is not None and scale is not None:
+                    # Precision is reported as display length (including
+                    # sign and point), which is an upper bound
+                    data_type = _decimal_type(precision, scale)
+            else:
+                data_type = _MYSQL_FIELD_TYPES.get(type_code)
+        types.append(data_type)
+    return types
+
+
+def _infer_type(column: tuple) -> pa.DataType | None:
+    data_type = pa.array(column).type
+    if pa.types.is_null(data_type):
+        return None
+    if pa.types.is_decimal(data_type):
+        # Precision is inferred from the values, which may differ between
+        # batches
+        return _decimal_type(38, data_type.scale)
+    return data_type
+
+
+def _record_batch_from_rows(
+    rows: list[tuple], names: list[str], schema: pa.Schema
+) -> pa.RecordBatch:
+    # Transpose rows into columns, then build one Arrow array per column. Types
+    # are inferred from the values of this batch, then cast to the schema with
+    # `safe=True`, so that lossy conversions (e.g., 12.5 to an integer column
+    # whose type was inferred from an earlier batch) raise an error instead of
+    # truncating values
+    columns = list(zip(*rows)) if rows else [()] * len(names)
+    arrays = []
+    for column, field in zip(columns, schema):
+        try:
+            array = pa.array(column, safe=True)
+            if array.type != field.type:
+                array = array.cast(field.type, safe=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as ex:
+            raise ValueError(
+                f"Values of column {field.name} cannot be converted to "
+                f"{field.type}. Pass `schema` explicitly"
+            ) from ex
+        arrays.append(array)
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def iter_sql_query_record_batches(
+    query: str,
+    engine: Engine,
+    batch_size: int = SQL_DEFAULT_CHUNKSIZE,
+    params: dict | None = None,
+    schema: pa.Schema | None = None,
+) -> Iterator[pa.RecordBatch]:
+    """
+    Generator function. Runs SQL query `query` and returns the result table as
+    Arrow record batches of at most `batch_size` rows each. Rows are fetched
+    from the DBAPI cursor in batches (using a server-side cursor where the
+    dialect supports it, see :func:`iter_sql_queries_chunks`) and converted
+    to typed Arrow columns directly, without going through `pandas`.
+
+    All batches have the same schema. If `schema` is not given, it is
+    determined once, before the first batch is returned. Column types are
+    taken from the cursor description where the driver reports them (numeric,
+    decimal, date and time columns for MySQL), and are inferred from the
+    values otherwise. Inferred decimals get the maximum precision. Batches
+    are held back as long as a column without reported type has only NULL
+    values, so pass `schema` if such columns may be NULL for many rows.
+
+    Values of later batches which cannot be converted to the schema without
+    loss raise `ValueError`. For example, if the type of a column is inferred
+    as integer from the first batch (e.g., SQLite `NUMERIC` column), a later
+    value 12.5 is not truncated to 12. Pass `schema` for such columns.
+
+    :param query: SQL query
+    :param engine: Engine to open connections from
+    :param batch_size: Maximum number of rows per batch
+    :param params: Bind parameters for the query (optional)
+    :param schema: Arrow schema for result (optional)
+    :return: Record batches of result table
+    """
+    assert batch_size > 0, f"batch_size = {batch_size} must be positive"
+    with engine.connect().execution_options(
+        stream_results=True, max_row_buffer=batch_size
+    ) as db_conn:
+        result = db_conn.execute(text(query), params)
+        names = list(result.keys())
+        # We fetch from the DBAPI cursor, so that rows are plain tuples
+        cursor = result.cursor
+        types = None if schema is not None else _description_types(
+            cursor.description
+        )
+        held_back = []  # Batches fetched before `schema` is known
+        num_batches = 0
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if schema is None:
+                if rows:
+                    held_back.append(rows)
+                    columns = list(zip(*rows))
+                    types = [
+                        _infer_type(columns[pos]) if data_type is None
+                        else data_type
+                        for pos, data_type in enumerate(types)
+                    ]
+                    if any(data_type is None for data_type in types):
+                        continue
+                # Columns which are NULL throughout get the null type
+                schema = pa.schema(
+                    [
+                        (name, pa.null() if data_type is None else data_type)
+                        for name, data_type in zip(names, types)
+                    ]
+                )
+            elif rows:
+                held_back.append(rows)
+            for held_rows in held_back:
+                yield _record_batch_from_rows(held_rows, names, schema)
+                num_batches += 1
+            held_back = []
+            if not rows:
+                if num_batches == 0:
+                    # Empty result
+                    yield _record_batch_from_rows([], names, schema)
+                break
+        result.close()
+
+
+def run_sql_query_arrow(
+    query: str,
+    engine: Engine,
+    params: dict | None = None,
+    schema: pa.Schema | None = None,
+) -> pa.Table:
+    """
+    Variant of :func:`run_sql_query`, returning the result as Arrow table.
+    See :func:`iter_sql_query_record_batches`.
+
+    :param query: SQL query
+    :param engine: Engine to open connections from
+    :param params: Bind parameters for the query (optional)
+    :param schema: Arrow schema for result (optional)
+    :return: Result table
+    """
+    batches = list(
+        iter_sql_query_record_batches(
+            query, engine, params=params, schema=schema
+        )
+    )
+    return pa.Table.from_batches(batches)
+
+
+def export_query_to_parquet(
+    query: str,
+    engine: Engine,
+    path: Path | str,
+    batch_size: int = SQL_DEFAULT_CHUNKSIZE,
+    params: dict | None = None,
+    schema: pa.Schema | None = None,
+    compression: str = "snappy",
+) -> int:
+    """
+    Runs SQL query `query` and writes the result table to Parquet file `path`.
+    Record batches are written as they are fetched (see
+    :func:`iter_sql_query_record_batches`), so that only one batch is held in
+    memory at any time. The file is written under a temporary name and moved
+    to `path` once complete. It is removed if the export fails.
+
+    :param query: SQL query
+    :param engine: Engine to open connections from
+    :param path: Path of Parquet file to write
+    :param batch_size: Maximum number of rows per batch
+    :param params: Bind parameters for the query (optional)
+    :param schema: Arrow schema for result (optional)
+    :param compression: Parquet compression codec. Defaults to "snappy"
+    :return: Number of rows written
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    num_rows = 0
+    writer = None
+    try:
+        try:
+            for batch in iter_sql_query_record_batches(
+                query, engine, batch_size=batch_size, params=params, schema=schema
+            ):
+                if writer is None:
+                    writer = pq.ParquetWriter(
+                        tmp_path, batch.schema, compression=compression
+                    )
+                writer.write_batch(batch)
+                num_rows += batch.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    tmp_path.replace(path)
+    return num_rows
@@ -0,0 +1,103 @@
+"""
+Benchmark of the Arrow fetch path (see :func:`run_sql_query_arrow` and
+:func:`export_query_to_parquet`). Run as:
+
+    python -m script_utils.sql.arrow_benchmark --num_rows 100000 1000000
+
+A wide table is created in a temporary SQLite database (see
+:func:`create_wide_table`). It is then read with each of the following
+methods, each in a fresh process, so that peak RSS (resident set size) can be
+compared:
+
+* pandas: :func:`run_sql_query`
+* arrow: :func:`run_sql_query_arrow`
+* pandas_parquet: :func:`run_sql_query`, then `DataFrame.to_parquet`
+* arrow_parquet: :func:`export_query_to_parquet`
+"""
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, SUPPRESS
+from pathlib import Path
+
+from sqlalchemy import create_engine
+
+from script_utils.sql.arrow import run_sql_query_arrow, export_query_to_parquet
+from script_utils.sql.benchmark_utils import create_wide_table, peak_rss, QUERY
+from script_utils.sql.queries import run_sql_query
+
+
+METHODS = ("pandas", "arrow", "pandas_parquet", "arrow_parquet")
+
+
+def run_worker(url: str, method: str, parquet_path: str) -> dict:
+    engine = create_engine(url)
+    start = time.perf_counter()
+    if method == "pandas":
+        num_rows = run_sql_query(QUERY, engine).shape[0]
+    elif method == "arrow":
+        num_rows = run_sql_query_arrow(QUERY, engine).num_rows
+    elif method == "pandas_parquet":
+        result_df = run_sql_query(QUERY, engine)
+        result_df.to_parquet(parquet_path)
+        num_rows = result_df.shape[0]
+    else:
+        num_rows = export_query_to_parquet(QUERY, engine, parquet_path)
+    elapsed = time.perf_counter() - start
+    return dict(seconds=elapsed, peak_rss=peak_rss(), num_rows=num_rows)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--num_rows", type=int, nargs="+", default=[100000, 500000]
+    )
+    parser.add_argument("--num_groups", type=int, default=5)
+    # Internal: Run a single measurement in this process
+    parser.add_argument("--worker_url", type=str, help=SUPPRESS)
+    parser.add_argument("--worker_method", type=str, help=SUPPRESS)
+    parser.add_argument("--worker_parquet_path", type=str, help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker_url is not None:
+        print(
+            json.dumps(
+                run_worker(
+                    args.worker_url, args.worker_method, args.worker_parquet_path
+                )
+            )
+        )
+        sys.exit(0)
+
+    for num_rows in args.num_rows:
+        with tempfile.TemporaryDirectory() as tmp_path:
+            url = "sqlite:///" + str(Path(tmp_path) / "arrow_benchmark.db")
+            parquet_path = str(Path(tmp_path) / "result.parquet")
+            engine = create_engine(url)
+            create_wide_table(engine, num_rows, args.num_groups)
+            engine.dispose()
+            print(f"num_rows = {num_rows}, num_columns = {8 * args.num_groups + 1}")
+            for method in METHODS:
+                command = [
+                    sys.executable,
+                    "-m",
+                    "script_utils.sql.arrow_benchmark",
+                    "--worker_url",
+                    url,
+                    "--worker_method",
+                    method,
+                    "--worker_parquet_path",
+                    parquet_path,
+                ]
+                result = json.loads(
+                    subprocess.run(
+                        command, capture_output=True, text=True, check=True
+                    ).stdout
+                )
+                assert result["num_rows"] == num_rows
+                print(
+                    f"  {method:14s}: {result['seconds']:6.2f} secs, "
+                    f"peak RSS {result['peak_rss'] / 2 ** 20:8.1f} MB"
+                )
@@ -0,0 +1,94 @@
+"""
+Helpers shared by the benchmarks in this package (e.g., `chunks_benchmark`,
+`compact_benchmark`, `arrow_benchmark`): creating a wide test table, and
+measuring peak RSS (resident set size) of a worker process.
+"""
+import resource
+import sys
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Float,
+    Integer,
+    MetaData,
+    SmallInteger,
+    String,
+    Table,
+)
+
+
+TABLE_NAME = "wide_table"
+
+QUERY = f"SELECT * FROM {TABLE_NAME}"
+
+
+def create_wide_table(engine, num_rows: int, num_groups: int = 5, seed: int = 0):
+    """
+    Creates table with `8 * num_groups` columns and `num_rows` rows.
+    """
+    random_state = np.random.RandomState(seed)
+    columns = [Column("id", Integer, primary_key=True)]
+    data = {"id": np.arange(num_rows)}
+    base_time = pd.Timestamp("2020-01-01")
+    for group in range(num_groups):
+        columns.extend(
+            [
+                Column(f"small_int{group}", SmallInteger),
+                Column(f"int_with_nulls{group}", Integer),
+                Column(f"status{group}", String(16)),
+                Column(f"country{group}", String(32)),
+                Column(f"description{group}", String(64)),
+                Column(f"updated{group}", DateTime),
+                Column(f"amount{group}", Float),
+                Column(f"category_id{group}", Integer),
+            ]
+        )
+        int_with_nulls = random_state.randint(0, 1000, size=num_rows).astype(float)
+        int_with_nulls[random_state.rand(num_rows) < 0.1] = np.nan
+        data.update(
+            {
+                f"small_int{group}": random_state.randint(0, 100, size=num_rows),
+                f"int_with_nulls{group}": int_with_nulls,
+                f"status{group}": random_state.choice(
+                    ["active", "inactive", "pending"], size=num_rows
+                ),
+                f"country{group}": random_state.choice(
+                    [f"country{i}" for i in range(100)], size=num_rows
+                ),
+                f"description{group}": [
+                    f"description {i} {group}" for i in range(num_rows)
+                ],
+                f"updated{group}": base_time + pd.to_timedelta(
+                    random_state.randint(0, 10 ** 8, size=num_rows), unit="s"
+                ),
+                f"amount{group}": random_state.normal(size=num_rows),
+                f"category_id{group}": random_state.randint(0, 16, size=num_rows),
+            }
+        )
+    metadata = MetaData()
+    table = Table(TABLE_NAME, metadata, *columns)
+    metadata.create_all(engine)
+    pd.DataFrame(data).to_sql(
+        TABLE_NAME, engine, if_exists="append", index=False, chunksize=10000
+    )
+
+
+def peak_rss() -> int:
+    """
+    :return: Peak resident set size of this process, in bytes
+    """
+    # On Linux, `ru_maxrss` is inherited from the parent across `exec`, so
+    # it would report the peak of the benchmark driver. `VmHWM` is not
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # `ru_maxrss` is in kilobytes on Linux, in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
@@ -0,0 +1,338 @@
+import functools
+import os
+import tempfile
+from typing import Iterable, Iterator
+
+import pandas as pd
+from sqlalchemy import MetaData, Table, inspect, insert, text
+from sqlalchemy.engine import Connection, Engine
+
+from script_utils.sql.consts import SQL_DEFAULT_CHUNKSIZE
+
+
+BULK_LOAD_METHODS = ("auto", "executemany", "insertmanyvalues", "load_data")
+
+ON_CONFLICT_MODES = ("error", "ignore", "update")
+
+
+def _iter_batches(
+    data: pd.DataFrame | Iterable[pd.DataFrame], batch_size: int
+) -> Iterator[pd.DataFrame]:
+    if isinstance(data, pd.DataFrame):
+        data = [data]
+    for chunk_df in data:
+        for start in range(0, chunk_df.shape[0], batch_size):
+            yield chunk_df.iloc[start:(start + batch_size)]
+
+
+def _column_values(series: pd.Series, datetime_as_str: bool) -> list:
+    # Python scalars, which all DBAPI drivers accept. Missing values become
+    # `None` (SQL NULL)
+    missing = series.isna().to_numpy()
+    if pd.api.types.is_datetime64_any_dtype(series):
+        if datetime_as_str:
+            # Same format as SQLAlchemy uses for `DateTime` columns
+            values = series.dt.strftime("%Y-%m-%d %H:%M:%S.%f").to_numpy(dtype=object)
+        else:
+            values = series.dt.to_pydatetime()
+    else:
+        values = series.to_numpy(dtype=object)
+    if missing.any():
+        values = values.copy()
+        values[missing] = None
+    return values.tolist()
+
+
+def _batch_to_tuples(
+    batch_df: pd.DataFrame, datetime_as_str: bool = False
+) -> list[tuple]:
+    columns = [
+        _column_values(batch_df[name], datetime_as_str)
+        for name in batch_df.columns
+    ]
+    return list(zip(*columns))
+
+
+class _DriverInsert:
+    """
+    Insert statement compiled once, to be run with `exec_driver_sql`, which
+    passes rows to `cursor.executemany` of the DBAPI driver directly. This
+    avoids the per-row parameter processing of SQLAlchemy, which dominates
+    the cost otherwise. Values must be passed in a form the driver accepts,
+    see :func:`_batch_to_tuples`.
+    """
+    def __init__(self, statement, dialect, columns: list[str]):
+        compiled = statement.compile(dialect=dialect, column_keys=columns)
+        self.sql = str(compiled)
+        self._positional = compiled.positional
+        unescaped = {
+            escaped: name for name, escaped in compiled.escaped_bind_names.items()
+        }
+        if self._positional:
+            bind_names = compiled.positiontup
+        else:
+            bind_names = list(compiled.binds.keys())
+        column_pos = {name: pos for pos, name in enumerate(columns)}
+        self._bind_names = bind_names
+        self._order = [column_pos[unescaped.get(name, name)] for name in bind_names]
+
+    def parameters(self, rows: list[tuple]) -> list:
+        order = self._order
+        if self._positional:
+            if order == list(range(len(order))):
+                return rows
+            return [tuple(row[pos] for pos in order) for row in rows]
+        names = self._bind_names
+        return [
+            {name: row[pos] for name, pos in zip(names, order)} for row in rows
+        ]
+
+
+def _resolve_table(
+    table: str | Table, engine: Engine, create_from: pd.DataFrame | None
+) -> Table:
+    if isinstance(table, Table):
+        return table
+    if create_from is not None and not inspect(engine).has_table(table):
+        # Let pandas map dtypes to column types, but write no rows
+        create_from.head(0).to_sql(table, engine, index=False)
+    return Table(table, MetaData(), autoload_with=engine)
+
+
+def _insert_statement(
+    table: Table,
+    dialect_name: str,
+    on_conflict: str,
+    key_columns: list[str] | None,
+    columns: list[str],
+):
+    if on_conflict == "error":
+        return insert(table)
+    if key_columns is None:
+        key_columns = [column.name for column in table.primary_key.columns]
+    update_columns = [name for name in columns if name not in key_columns]
+    if dialect_name in ("sqlite", "postgresql"):
+        if dialect_name == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        statement = dialect_insert(table)
+        if on_conflict == "ignore" or not update_columns:
+            return statement.on_conflict_do_nothing(index_elements=key_columns)
+        return statement.on_conflict_do_update(
+            index_elements=key_columns,
+            set_={name: statement.excluded[name] for name in update_columns},
+        )
+    elif dialect_name in ("mysql", "mariadb"):
+        from sqlalchemy.dialects.mysql import insert as dialect_insert
+
+        statement = dialect_insert(table)
+        if on_conflict == "ignore" or not update_columns:
+            return statement.prefix_with("IGNORE")
+        return statement.on_duplicate_key_update(
+            {name: statement.inserted[name] for name in update_columns}
+        )
+    else:
+        raise NotImplementedError(
+            f"on_conflict = '{on_conflict}' not supported for dialect "
+            f"'{dialect_name}'"
+        )
+
+
+def _mysql_tsv_column(series: pd.Series) -> pd.Series:
+    # Text representation understood by `LOAD DATA` with default field and
+    # line options: tab separated, backslash escapes, `\N` for NULL
+    missing = series.isna()
+    if pd.api.types.is_bool_dtype(series):
+        values = series.astype(int).astype(str)
+    elif pd.api.types.is_datetime64_any_dtype(series):
+        values = series.dt.strftime("%Y-%m-%d %H:%M:%S.%f")
+    elif pd.api.types.is_numeric_dtype(series):
+        values = series.astype(str)
+    else:
+        values = (
+            series.astype(str)
+            .str.replace("\\", "\\\\", regex=False)
+            .str.replace("\t", "\\t", regex=False)
+            .str.replace("\n", "\\n", regex=False)
+            .str.replace("\r", "\\r", regex=False)
+            .str.replace("\0", "\\0", regex=False)
+        )
+    return values.where(~missing, "\\N").astype(object)
+
+
+def _write_mysql_tsv(batch_df: pd.DataFrame, fname: str):
+    columns = [_mysql_tsv_column(batch_df[name]) for name in batch_df.columns]
+    lines = functools.reduce(lambda a, b: a + "\t" + b, columns)
+    with open(fname, "w", encoding="utf-8", newline="\n") as fp:
+        for line in lines:
+            fp.write(line)
+            fp.write("\n")
+
+
+def _load_data_local_infile(
+    db_conn: Connection,
+    batch_df: pd.DataFrame,
+    table: Table,
+    on_conflict: str,
+    tmp_path: str,
+) -> None:
+    fname = os.path.join(tmp_path, "batch.tsv")
+    _write_mysql_tsv(batch_df, fname)
+    preparer = db_conn.dialect.identifier_preparer
+    modifier = {"error": "", "ignore": "IGNORE ", "update": "REPLACE "}[on_conflict]
+    column_list = ", ".join(preparer.quote(name) for name in batch_df.columns)
+    db_conn.execute(
+        text(
+            f"LOAD DATA LOCAL INFILE :fname {modifier}"
+            f"INTO TABLE {preparer.format_table(table)} "
+            f"CHARACTER SET utf8mb4 ({column_list})"
+        ),
+        dict(fname=fname),
+    )
+
+
+def bulk_load(
+    data: pd.DataFrame | Iterable[pd.DataFrame],
+    table: str | Table,
+    engine: Engine,
+    method: str = "auto",
+    batch_size: int = SQL_DEFAULT_CHUNKSIZE,
+    rows_per_transaction: int | None = None,
+    on_conflict: str = "error",
+    key_columns: list[str] | None = None,
+    create_table: bool = False,
+) -> int:
+    """
+    Inserts rows of `data` into table `table`. Faster than `DataFrame.to_sql`
+    for large tables, and `data` can be an iterable of dataframes (e.g.,
+    from :func:`iter_sql_query_chunks` or `pd.read_csv(..., chunksize=...)`),
+    so that only one chunk is held in memory at any time. Column names of
+    `data` must be column names of `table`. All chunks must have the same
+    columns, but they may come in a different order (chunks are reordered
+    like the first one). Otherwise, `ValueError` is raised.
+
+    Methods (`method`):
+
+    * "executemany": Rows are passed in batches of `batch_size` to
+      `cursor.executemany` of the DBAPI driver, with the `INSERT` statement
+      compiled only once. Fastest for SQLite, and for MySQL with
+      `mysqlclient`, which sends multi-row `INSERT` statements
+    * "insertmanyvalues": Rows are inserted in batches of `batch_size` with
+      SQLAlchemy `executemany`, which uses "insertmanyvalues" (multi-row
+      `INSERT` statements) where the dialect supports it. Slower, since
+      parameters are processed per row, but works for all dialects (e.g.,
+      PostgreSQL with `psycopg2`, whose `executemany` is slow)
+    * "load_data": MySQL only. Each batch is written to a temporary file and
+      loaded by `LOAD DATA LOCAL INFILE`, which is the fastest option. Needs
+      `local_infile` to be enabled on client (see
+      :class:`ConnectionConfig`) and server
+    * "auto": "load_data" for MySQL engines whose URL enables `local_infile`
+      (see :class:`ConnectionConfig`), "executemany" for SQLite and MySQL,
+      "insertmanyvalues" otherwise
+
+    `on_conflict` determines what happens with rows whose key is already in
+    the table: "error" (raise exception), "ignore" (keep existing row), or
+    "update" (upsert, overwrite existing row). Keys are given by
+    `key_columns`, defaulting to the primary key of `table` (MySQL always
+    uses all unique keys). For "load_data", "update" uses `REPLACE`, which
+    deletes and reinserts rows, so columns not in `data` are reset to their
+    defaults. Also, MySQL treats "error" like "ignore" for `LOAD DATA LOCAL`
+    (duplicates only raise warnings).
+
+    If `rows_per_transaction` is given, a transaction is committed once at
+    least this many rows have been inserted in it. If an error happens, rows
+    of earlier transactions remain in the table. Otherwise, all rows are
+    inserted in a single transaction.
+
+    :param data: Dataframe, or iterable of dataframes
+    :param table: Name of table, or :class:`Table` object
+    :param engine: Engine to open connection from
+    :param method: See above. Defaults to "auto"
+    :param batch_size: Number of rows sent to database at once
+    :param rows_per_transaction: See above (optional)
+    :param on_conflict: See above. Defaults to "error"
+    :param key_columns: See above (optional)
+    :param create_table: If `True` and `table` (name) does not exist, it is
+        created with column types determined by pandas from the first chunk
+    :return: Number of rows sent to the database (with `on_conflict="ignore"`,
+        some may not have been inserted)
+    """
+    assert method in BULK_LOAD_METHODS, \
+        f"method = '{method}' not supported, must be in {BULK_LOAD_METHODS}"
+    assert on_conflict in ON_CONFLICT_MODES, \
+        f"on_conflict = '{on_conflict}' not supported, must be in {ON_CONFLICT_MODES}"
+    assert batch_size > 0, f"batch_size = {batch_size} must be positive"
+    dialect_name = engine.dialect.name
+    if method == "auto":
+        local_infile = engine.url.query.get("local_infile") in ("1", "true")
+        if dialect_name in ("mysql", "mariadb") and local_infile:
+            method = "load_data"
+        elif dialect_name in ("sqlite", "mysql", "mariadb"):
+            method = "executemany"
+        else:
+            method = "insertmanyvalues"
+    elif method == "load_data":
+        assert dialect_name in ("mysql", "mariadb"), \
+            f"method = 'load_data' needs MySQL, but engine dialect is '{dialect_name}'"
+
+    num_rows = 0
+    num_rows_in_transaction = 0
+    columns = None
+    statement = None
+    driver_insert = None
+    table_obj = table if isinstance(table, Table) else None
+    with tempfile.TemporaryDirectory() as tmp_path, engine.connect() as db_conn:
+        for batch_df in _iter_batches(data, batch_size):
+            if batch_df.shape[0] == 0:
+                continue
+            # Statement is compiled for the columns of the first batch
+            if columns is None:
+                columns = list(batch_df.columns)
+            elif list(batch_df.columns) != columns:
+                if set(batch_df.columns) != set(columns):
+                    raise ValueError(
+                        f"Columns {list(batch_df.columns)} of chunk differ from "
+                        f"columns {columns} of first chunk"
+                    )
+                batch_df = batch_df[columns]
+            if table_obj is None:
+                table_obj = _resolve_table(
+                    table, engine, batch_df if create_table else None
+                )
+            if method == "load_data":
+                _load_data_local_infile(
+                    db_conn, batch_df, table_obj, on_conflict, tmp_path
+                )
+            else:
+                if statement is None:
+                    statement = _insert_statement(
+                        table_obj, dialect_name, on_conflict, key_columns, columns
+                    )
+                if method == "executemany":
+                    if driver_insert is None:
+                        driver_insert = _DriverInsert(
+                            statement, engine.dialect, columns
+                        )
+                    rows = _batch_to_tuples(
+                        batch_df, datetime_as_str=dialect_name == "sqlite"
+                    )
+                    db_conn.exec_driver_sql(
+                        driver_insert.sql, driver_insert.parameters(rows)
+                    )
+                else:
+                    rows = [
+                        dict(zip(columns, row))
+                        for row in _batch_to_tuples(batch_df)
+                    ]
+                    db_conn.execution_options(
+                        insertmanyvalues_page_size=batch_size
+                    ).execute(statement, rows)
+            num_rows += batch_df.shape[0]
+            num_rows_in_transaction += batch_df.shape[0]
+            if rows_per_transaction is not None \
+                    and num_rows_in_transaction >= rows_per_transaction:
+                db_conn.commit()
+                num_rows_in_transaction = 0
+        db_conn.commit()
+    return num_rows
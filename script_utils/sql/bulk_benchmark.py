@@ -0,0 +1,94 @@
+"""
+Benchmark of :func:`bulk_load` against `DataFrame.to_sql`. Run as:
+
+    python -m script_utils.sql.bulk_benchmark --num_rows 100000 1000000
+
+By default, a file-based SQLite database in a temporary directory is used.
+Pass `--url` to run against another database (e.g., a local MySQL server,
+with `?local_infile=1` appended to enable `LOAD DATA LOCAL INFILE`). Tables
+named `bulk_benchmark_*` are dropped and created there.
+"""
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from script_utils.sql.bulk import bulk_load
+
+
+TABLE_NAME = "bulk_benchmark"
+
+
+def synthetic_dataframe(num_rows: int, seed: int = 0) -> pd.DataFrame:
+    random_state = np.random.RandomState(seed)
+    return pd.DataFrame(
+        {
+            "id": np.arange(num_rows),
+            "value": random_state.normal(size=num_rows),
+            "category": random_state.randint(0, 100, size=num_rows),
+            "label": [f"label{i % 1000}" for i in range(num_rows)],
+        }
+    )
+
+
+def _recreate_table(engine, data_df: pd.DataFrame, table_name: str):
+    with engine.begin() as db_conn:
+        db_conn.execute(text(f"DROP TABLE IF EXISTS {table_name}"))
+    data_df.head(0).to_sql(table_name, engine, index=False)
+
+
+def run_benchmark(engine, num_rows: int, batch_size: int, methods: list[str]):
+    data_df = synthetic_dataframe(num_rows)
+    _recreate_table(engine, data_df, TABLE_NAME)
+    start = time.perf_counter()
+    data_df.to_sql(
+        TABLE_NAME, engine, index=False, if_exists="append", chunksize=batch_size
+    )
+    elapsed = time.perf_counter() - start
+    print(f"  {'to_sql':37s}: {elapsed:7.2f} secs, {num_rows / elapsed:10.0f} rows/sec")
+    for method in methods:
+        _recreate_table(engine, data_df, TABLE_NAME)
+        start = time.perf_counter()
+        bulk_load(data_df, TABLE_NAME, engine, method=method, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        name = f"bulk_load(method='{method}')"
+        print(f"  {name:37s}: {elapsed:7.2f} secs, {num_rows / elapsed:10.0f} rows/sec")
+    with engine.begin() as db_conn:
+        num_loaded = db_conn.execute(
+            text(f"SELECT COUNT(*) FROM {TABLE_NAME}")
+        ).scalar()
+        db_conn.execute(text(f"DROP TABLE {TABLE_NAME}"))
+    assert num_loaded == num_rows, (num_loaded, num_rows)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--num_rows", type=int, nargs="+", default=[100000, 1000000]
+    )
+    parser.add_argument("--batch_size", type=int, default=10000)
+    parser.add_argument(
+        "--url",
+        type=str,
+        help="SQLAlchemy URL of database. Defaults to temporary SQLite file",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_path:
+        url = args.url
+        if url is None:
+            url = "sqlite:///" + str(Path(tmp_path) / "bulk_benchmark.db")
+        engine = create_engine(url)
+        methods = ["executemany", "insertmanyvalues"]
+        if engine.dialect.name in ("mysql", "mariadb") \
+                and engine.url.query.get("local_infile") in ("1", "true"):
+            methods.append("load_data")
+        print(f"Database: {engine.url.render_as_string(hide_password=True)}")
+        for num_rows in args.num_rows:
+            print(f"num_rows = {num_rows}")
+            run_benchmark(engine, num_rows, args.batch_size, methods)
+        engine.dispose()
@@ -0,0 +1,262 @@
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Lock
+
+import pandas as pd
+from sqlalchemy.engine import Engine
+
+
+# Quoted string literals and identifiers, with doubled or backslash escaped
+# quotes inside
+_QUOTED_PATTERN = re.compile(
+    r"""('(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*"|`(?:[^`]|``)*`)""",
+    re.DOTALL,
+)
+
+
+def normalize_sql(query: str) -> str:
+    """
+    Normalizes SQL query text for use in cache keys: whitespace outside of
+    quoted literals is collapsed, and leading and trailing whitespace and
+    semicolons are removed. Quoted literals are not changed, and neither is
+    case, since it matters in string literals.
+
+    :param query: SQL query
+    :return: Normalized query
+    """
+    # `split` with a capturing group returns literals at odd positions
+    parts = _QUOTED_PATTERN.split(query)
+    normalized = "".join(
+        part if pos % 2 == 1 else re.sub(r"\s+", " ", part)
+        for pos, part in enumerate(parts)
+    )
+    return normalized.strip().rstrip(";").rstrip()
+
+
+def query_cache_key(
+    query: str, engine: Engine, params: dict | None = None
+) -> str:
+    """
+    :param query: SQL query
+    :param engine: Engine the query is run against
+    :param params: Bind parameters for the query (optional)
+    :return: Cache key for query result
+    """
+    if params is None:
+        params = dict()
+    parts = [
+        engine.url.render_as_string(hide_password=True),
+        normalize_sql(query),
+        repr(sorted(params.items())),
+    ]
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CacheStatistics:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    @property
+    def hits(self) -> int:
+        return self.memory_hits + self.disk_hits
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+
+@dataclass
+class _MemoryEntry:
+    result: pd.DataFrame
+    num_bytes: int
+    created: float
+
+
+class QueryResultCache:
+    """
+    Cache for query result tables, to be passed to :func:`run_sql_queries` or
+    :func:`run_sql_query`. Keys are computed by :func:`query_cache_key` from
+    normalized query text, bind parameters and engine URL.
+
+    There are two tiers. The in-memory tier is an LRU cache, limited by
+    `max_entries` entries and `max_bytes` total memory (as reported by
+    `DataFrame.memory_usage(deep=True)`). If `disk_path` is given, results are
+    also stored as Parquet files there (requires `pyarrow`), limited by
+    `max_disk_bytes` total file size, evicting the oldest files first. Entries
+    older than `ttl` seconds are not returned from either tier.
+
+    The cache does not know when tables change. Use :meth:`invalidate` or
+    :meth:`clear` after writes, or choose `ttl` accordingly.
+    """
+    def __init__(
+        self,
+        ttl: float | None = None,
+        max_entries: int | None = 128,
+        max_bytes: int | None = None,
+        disk_path: Path | str | None = None,
+        max_disk_bytes: int | None = None,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_path = None if disk_path is None else Path(disk_path)
+        self.max_disk_bytes = max_disk_bytes
+        self.stats = CacheStatistics()
+        self._entries: OrderedDict[str, _MemoryEntry] = OrderedDict()
+        self._total_bytes = 0
+        self._lock = Lock()
+        if self.disk_path is not None:
+            self.disk_path.mkdir(parents=True, exist_ok=True)
+
+    def _is_expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _disk_fname(self, key: str) -> Path:
+        return self.disk_path / f"{key}.parquet"
+
+    def get(
+        self, query: str, engine: Engine, params: dict | None = None
+    ) -> pd.DataFrame | None:
+        """
+        :param query: SQL query
+        :param engine: Engine the query is run against
+        :param params: Bind parameters for the query (optional)
+        :return: Cached result table, or `None` if not in cache
+        """
+        key = query_cache_key(query, engine, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not self._is_expired(entry.created):
+                    self._entries.move_to_end(key)
+                    self.stats.memory_hits += 1
+                    return entry.result
+                self._remove_from_memory(key)
+        result, created = self._get_from_disk(key)
+        with self._lock:
+            if result is not None:
+                self.stats.disk_hits += 1
+                # Keeps creation time of the file, so that `ttl` still applies
+                self._put_to_memory(key, result, created)
+            else:
+                self.stats.misses += 1
+        return result
+
+    def _get_from_disk(self, key: str) -> tuple[pd.DataFrame | None, float]:
+        if self.disk_path is None:
+            return None, 0.0
+        fname = self._disk_fname(key)
+        try:
+            created = fname.stat().st_mtime
+        except OSError:
+            return None, 0.0
+        if self._is_expired(created):
+            fname.unlink(missing_ok=True)
+            return None, 0.0
+        try:
+            return pd.read_parquet(fname), created
+        except OSError:
+            return None, 0.0
+        except Exception:
+            # Corrupt file (e.g., partially written by a crashed process)
+            fname.unlink(missing_ok=True)
+            return None, 0.0
+
+    def put(
+        self,
+        query: str,
+        engine: Engine,
+        result: pd.DataFrame,
+        params: dict | None = None,
+    ):
+        """
+        Stores result table `result` for a query. If it cannot be written as
+        Parquet (e.g., object columns with mixed types), it is stored in the
+        memory tier only.
+
+        :param query: SQL query
+        :param engine: Engine the query is run against
+        :param result: Result table
+        :param params: Bind parameters for the query (optional)
+        """
+        key = query_cache_key(query, engine, params)
+        with self._lock:
+            self._put_to_memory(key, result, time.time())
+        if self.disk_path is not None:
+            fname = self._disk_fname(key)
+            tmp_fname = fname.with_suffix(".tmp")
+            try:
+                result.to_parquet(tmp_fname)
+            except Exception:
+                tmp_fname.unlink(missing_ok=True)
+                return
+            tmp_fname.replace(fname)
+            self._evict_from_disk()
+
+    def _put_to_memory(self, key: str, result: pd.DataFrame, created: float):
+        if key in self._entries:
+            self._remove_from_memory(key)
+        num_bytes = int(result.memory_usage(deep=True).sum())
+        if self.max_bytes is not None and num_bytes > self.max_bytes:
+            return  # Too large for memory tier
+        self._entries[key] = _MemoryEntry(result, num_bytes, created)
+        self._total_bytes += num_bytes
+        while (
+            self.max_entries is not None and len(self._entries) > self.max_entries
+        ) or (self.max_bytes is not None and self._total_bytes > self.max_bytes):
+            self._remove_from_memory(next(iter(self._entries)))
+            self.stats.evictions += 1
+
+    def _remove_from_memory(self, key: str):
+        entry = self._entries.pop(key)
+        self._total_bytes -= entry.num_bytes
+
+    def _evict_from_disk(self):
+        if self.max_disk_bytes is None:
+            return
+        files = [
+            (path.stat(), path) for path in self.disk_path.glob("*.parquet")
+        ]
+        total_bytes = sum(stat.st_size for stat, _ in files)
+        for stat, path in sorted(files, key=lambda x: x[0].st_mtime):
+            if total_bytes <= self.max_disk_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total_bytes -= stat.st_size
+            self.stats.evictions += 1
+
+    def invalidate(
+        self, query: str, engine: Engine, params: dict | None = None
+    ):
+        """
+        Removes the entry for a query from both tiers.
+
+        :param query: SQL query
+        :param engine: Engine the query is run against
+        :param params: Bind parameters for the query (optional)
+        """
+        key = query_cache_key(query, engine, params)
+        with self._lock:
+            if key in self._entries:
+                self._remove_from_memory(key)
+        if self.disk_path is not None:
+            self._disk_fname(key).unlink(missing_ok=True)
+
+    def clear(self):
+        """
+        Removes all entries from both tiers. Statistics are not reset.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+        if self.disk_path is not None:
+            for path in self.disk_path.glob("*.parquet"):
+                path.unlink(missing_ok=True)
@@ -0,0 +1,94 @@
+"""
+Benchmark of chunked reads (see :func:`iter_sql_query_chunks`). Run as:
+
+    python -m script_utils.sql.chunks_benchmark --num_rows 100000 1000000
+
+A wide table is created in a temporary SQLite database (see
+:func:`create_wide_table`). It is then read by :func:`run_sql_query` (full
+result table), and by :func:`iter_sql_query_chunks` for different chunk
+sizes, each in a fresh process, so that peak RSS (resident set size) can be
+compared. Chunks are consumed by computing a simple aggregate, they are not
+kept.
+"""
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, SUPPRESS
+from pathlib import Path
+
+from sqlalchemy import create_engine
+
+from script_utils.sql.benchmark_utils import create_wide_table, peak_rss, QUERY
+from script_utils.sql.queries import run_sql_query, iter_sql_query_chunks
+
+
+def run_worker(url: str, chunksize: int | None) -> dict:
+    engine = create_engine(url)
+    start = time.perf_counter()
+    num_rows = 0
+    total_amount = 0.0
+    if chunksize is None:
+        result_df = run_sql_query(QUERY, engine)
+        num_rows = result_df.shape[0]
+        total_amount = float(result_df["amount0"].sum())
+    else:
+        for chunk_df in iter_sql_query_chunks(QUERY, engine, chunksize=chunksize):
+            num_rows += chunk_df.shape[0]
+            total_amount += float(chunk_df["amount0"].sum())
+    elapsed = time.perf_counter() - start
+    return dict(
+        seconds=elapsed,
+        peak_rss=peak_rss(),
+        num_rows=num_rows,
+        total_amount=total_amount,
+    )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--num_rows", type=int, nargs="+", default=[100000, 500000]
+    )
+    parser.add_argument("--num_groups", type=int, default=5)
+    parser.add_argument(
+        "--chunksize", type=int, nargs="+", default=[1000, 10000, 100000]
+    )
+    # Internal: Run a single measurement in this process
+    parser.add_argument("--worker_url", type=str, help=SUPPRESS)
+    parser.add_argument("--worker_chunksize", type=int, help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker_url is not None:
+        print(json.dumps(run_worker(args.worker_url, args.worker_chunksize)))
+        sys.exit(0)
+
+    for num_rows in args.num_rows:
+        with tempfile.TemporaryDirectory() as tmp_path:
+            url = "sqlite:///" + str(Path(tmp_path) / "chunks_benchmark.db")
+            engine = create_engine(url)
+            create_wide_table(engine, num_rows, args.num_groups)
+            engine.dispose()
+            print(f"num_rows = {num_rows}, num_columns = {8 * args.num_groups + 1}")
+            for chunksize in [None] + args.chunksize:
+                command = [
+                    sys.executable,
+                    "-m",
+                    "script_utils.sql.chunks_benchmark",
+                    "--worker_url",
+                    url,
+                ]
+                if chunksize is not None:
+                    command.extend(["--worker_chunksize", str(chunksize)])
+                result = json.loads(
+                    subprocess.run(
+                        command, capture_output=True, text=True, check=True
+                    ).stdout
+                )
+                assert result["num_rows"] == num_rows
+                name = "full" if chunksize is None else f"chunks of {chunksize}"
+                print(
+                    f"  {name:16s}: {result['seconds']:6.2f} secs, "
+                    f"peak RSS {result['peak_rss'] / 2 ** 20:8.1f} MB"
+                )
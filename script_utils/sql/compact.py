@@ -0,0 +1,399 @@
+import re
+import time
+from dataclasses import dataclass, asdict
+from threading import Lock
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import types as sqltypes
+from sqlalchemy.dialects import mysql
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import text
+
+from script_utils.sql.consts import SQL_DEFAULT_CHUNKSIZE
+from script_utils.sql.instrumentation import QueryRecord, estimate_num_bytes
+from script_utils.sql.metadata import DatabaseMetaData
+
+
+# String columns are converted to `category` if the ratio of distinct values
+# to rows is at most this
+DEFAULT_CATEGORY_MAX_RATIO = 0.5
+
+# Integer column types (most specific first), mapped to numpy dtype names for
+# signed and unsigned variants
+_INTEGER_DTYPES = (
+    (mysql.TINYINT, "int8", "uint8"),
+    (sqltypes.SmallInteger, "int16", "uint16"),
+    (mysql.MEDIUMINT, "int32", "uint32"),
+    (sqltypes.BigInteger, "int64", "uint64"),
+    (sqltypes.Integer, "int32", "uint32"),
+)
+
+
+def _arrow_string_dtype():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return None
+    return pd.StringDtype("pyarrow")
+
+
+def _integer_dtype(column_type: sqltypes.TypeEngine) -> str | None:
+    unsigned = getattr(column_type, "unsigned", False)
+    for type_class, signed_name, unsigned_name in _INTEGER_DTYPES:
+        if isinstance(column_type, type_class):
+            return unsigned_name if unsigned else signed_name
+    return None
+
+
+def _fits(values: pd.Series, dtype_name: str) -> bool:
+    info = np.iinfo(dtype_name)
+    return values.min() >= info.min and values.max() <= info.max
+
+
+def _compact_integers(series: pd.Series, dtype_name: str | None) -> pd.Series:
+    # Integer columns with NULLs arrive as float64
+    non_null = series.dropna()
+    if non_null.empty or not (non_null == np.floor(non_null)).all():
+        return series
+    if dtype_name is None or not _fits(non_null, dtype_name):
+        dtype_name = pd.to_numeric(non_null, downcast="integer").dtype.name
+    if non_null.shape[0] < series.shape[0]:
+        # Nullable integer dtype, such as "Int16"
+        dtype_name = dtype_name[0].upper() + dtype_name[1:]
+    return series.astype(dtype_name)
+
+
+def _compact_strings(
+    series: pd.Series,
+    category_max_ratio: float,
+    categories: list[str] | None = None,
+    categorize: bool = True,
+) -> pd.Series:
+    if categories is not None:
+        # Values not in `categories` would become NaN. This happens for MySQL
+        # `ENUM` columns in non-strict mode (invalid values stored as '')
+        if series.dropna().isin(categories).all():
+            return series.astype(pd.CategoricalDtype(categories=categories))
+        return series.astype("category")
+    num_rows = series.shape[0]
+    if categorize and num_rows > 0 \
+            and series.nunique(dropna=True) <= category_max_ratio * num_rows:
+        return series.astype("category")
+    if series.dtype == object:
+        string_dtype = _arrow_string_dtype()
+        if string_dtype is not None:
+            return series.astype(string_dtype)
+    return series
+
+
+def _is_string_column(series: pd.Series) -> bool:
+    # `is_string_dtype` is true for any object column in pandas 3, which may
+    # also hold bytes (BLOB) or mixed values
+    if isinstance(series.dtype, pd.StringDtype):
+        return True
+    if series.dtype != object:
+        return False
+    return pd.api.types.infer_dtype(series, skipna=True) == "string"
+
+
+def compact_column(
+    series: pd.Series,
+    column_type: sqltypes.TypeEngine | None = None,
+    category_max_ratio: float = DEFAULT_CATEGORY_MAX_RATIO,
+    categorize: bool = True,
+    compact_integers: bool = True,
+) -> pd.Series:
+    """
+    Converts column of a result table to a more compact dtype. If
+    `column_type` (the reflected SQL type of the column) is given, it
+    determines the conversion:
+
+    * Integer types: Smallest dtype covering the range of the type
+      (e.g., `int8` for MySQL `TINYINT`), or a nullable variant (e.g.,
+      `Int8`) if there are NULLs. Falls back to the smallest dtype covering
+      the values, if the type range is violated
+    * Single precision floats (e.g., MySQL `FLOAT`): `float32`
+    * Enum types: `category`, with categories in the order of the enum. If
+      some values are not in the enum (e.g., '' for invalid values in MySQL
+      non-strict mode), categories are determined from the values instead
+    * Date and datetime types: `datetime64`, parsed from strings (e.g.,
+      for SQLite) only here, and left alone if already parsed
+    * String types: `category` if the ratio of distinct values to rows is at
+      most `category_max_ratio`, pyarrow-backed strings otherwise
+
+    Without `column_type`, integer and string columns are converted based on
+    their values only. Object columns holding integers (and NULLs) are
+    converted to numbers first. These arise when chunks of an integer column
+    are concatenated, some of which have only NULLs.
+
+    If `categorize=False`, string columns (other than enums) are not
+    converted to `category`, and if `compact_integers=False`, integer
+    columns are left alone. This is used for chunks of a result table, where
+    the cardinality and the NULLs of the full column are not known.
+
+    :param series: Column of result table
+    :param column_type: Reflected SQL type of column (optional)
+    :param category_max_ratio: See above
+    :param categorize: See above. Defaults to `True`
+    :param compact_integers: See above. Defaults to `True`
+    :return: Converted column (may be `series` itself)
+    """
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        return series
+    if compact_integers and dtype == object and pd.api.types.infer_dtype(
+        series, skipna=True
+    ) in ("integer", "mixed-integer-float"):
+        series = pd.to_numeric(series)
+        dtype = series.dtype
+    if column_type is not None:
+        if isinstance(column_type, sqltypes.Enum):
+            return _compact_strings(
+                series, category_max_ratio, categories=list(column_type.enums)
+            )
+        if isinstance(column_type, (sqltypes.Date, sqltypes.DateTime)):
+            if pd.api.types.is_datetime64_any_dtype(dtype):
+                return series
+            try:
+                return pd.to_datetime(series, format="ISO8601")
+            except (ValueError, TypeError):
+                return series
+        if isinstance(column_type, sqltypes.Integer) \
+                and pd.api.types.is_numeric_dtype(dtype) \
+                and not pd.api.types.is_bool_dtype(dtype):
+            if not compact_integers:
+                return series
+            return _compact_integers(series, _integer_dtype(column_type))
+        if isinstance(column_type, mysql.FLOAT) and dtype == np.float64:
+            return series.astype(np.float32)
+        if isinstance(column_type, sqltypes.String) and _is_string_column(series):
+            return _compact_strings(
+                series, category_max_ratio, categorize=categorize
+            )
+        return series
+    if pd.api.types.is_integer_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype):
+        return _compact_integers(series, None) if compact_integers else series
+    if _is_string_column(series):
+        return _compact_strings(series, category_max_ratio, categorize=categorize)
+    return series
+
+
+@dataclass
+class CompactionRecord:
+    query: str
+    num_rows: int
+    bytes_before: int
+    bytes_after: int
+    seconds: float
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.bytes_before - self.bytes_after
+
+
+class ResultCompactor:
+    """
+    Converts result tables to compact dtypes, see :func:`compact_column`.
+    Pass to :func:`run_sql_queries` (and variants) as `compactor` argument.
+
+    Column types are taken from `metadata` (lazy mode recommended, see
+    :class:`DatabaseMetaData`). A result column is looked up by name in the
+    tables named in the query text, in the order they appear. Columns which
+    are not found (e.g., computed expressions) are converted based on their
+    values only.
+
+    Use :meth:`compact` to convert a result table, or :meth:`read_sql_query`
+    to run a query and convert its result chunk by chunk (lower peak memory).
+    The latter is used by :func:`run_sql_queries`.
+
+    Memory used before and after (as reported by
+    `DataFrame.memory_usage(deep=True)`) is recorded for each query, see
+    :meth:`report`.
+
+    :param metadata: Metadata for the database (optional)
+    :param category_max_ratio: See :func:`compact_column`
+    """
+    def __init__(
+        self,
+        metadata: DatabaseMetaData | None = None,
+        category_max_ratio: float = DEFAULT_CATEGORY_MAX_RATIO,
+    ):
+        self._metadata = metadata
+        self._category_max_ratio = category_max_ratio
+        self._records = []
+        self._lock = Lock()
+        self._table_names = None
+
+    def _column_types(self, query: str) -> dict[str, sqltypes.TypeEngine]:
+        if self._metadata is None:
+            return dict()
+        column_types = dict()
+        # Metadata reflects tables on demand, which must not happen
+        # concurrently
+        with self._lock:
+            if self._table_names is None:
+                self._table_names = set(self._metadata.table_names())
+            for token in re.findall(r"[A-Za-z_][A-Za-z0-9_$]*", query):
+                if token in self._table_names:
+                    for column in self._metadata.table(token).columns:
+                        column_types.setdefault(column.name, column.type)
+        return column_types
+
+    def _compact_frame(
+        self,
+        result_df: pd.DataFrame,
+        column_types: dict[str, sqltypes.TypeEngine],
+        categorize: bool,
+        compact_integers: bool = True,
+    ) -> pd.DataFrame:
+        columns = {
+            name: compact_column(
+                result_df[name],
+                column_types.get(name),
+                self._category_max_ratio,
+                categorize=categorize,
+                compact_integers=compact_integers,
+            )
+            for name in result_df.columns
+        }
+        return pd.DataFrame(columns, index=result_df.index)
+
+    def _record(
+        self,
+        query: str,
+        num_rows: int,
+        bytes_before: int,
+        compact_df: pd.DataFrame,
+        start: float,
+    ):
+        record = CompactionRecord(
+            query=query,
+            num_rows=num_rows,
+            bytes_before=bytes_before,
+            bytes_after=int(compact_df.memory_usage(deep=True).sum()),
+            seconds=time.perf_counter() - start,
+        )
+        with self._lock:
+            self._records.append(record)
+
+    def compact(self, result_df: pd.DataFrame, query: str) -> pd.DataFrame:
+        """
+        :param result_df: Result table for `query`
+        :param query: SQL query
+        :return: Result table with compact dtypes
+        """
+        start = time.perf_counter()
+        bytes_before = int(result_df.memory_usage(deep=True).sum())
+        compact_df = self._compact_frame(
+            result_df, self._column_types(query), categorize=True
+        )
+        self._record(query, result_df.shape[0], bytes_before, compact_df, start)
+        return compact_df
+
+    def read_sql_query(
+        self,
+        query: str,
+        db_conn: Connection,
+        params: dict | None = None,
+        chunksize: int = SQL_DEFAULT_CHUNKSIZE,
+        record: QueryRecord | None = None,
+    ) -> pd.DataFrame:
+        """
+        Runs `query` and returns the result table with compact dtypes. Rows
+        are fetched in chunks of `chunksize` (with a server-side cursor where
+        the dialect supports it), and each chunk is compacted right away, so
+        that the full result table is never held with default dtypes. This
+        reduces peak memory compared to :meth:`compact`. Low cardinality
+        string columns are converted to `category`, and integer columns to
+        the smallest dtype, once all chunks are there.
+
+        `bytes_before` in :meth:`report` is the sum over chunks with default
+        dtypes.
+
+        :param query: SQL query
+        :param db_conn: Connection to run query with
+        :param params: Bind parameters for the query (optional)
+        :param chunksize: Number of rows fetched at once
+        :param record: If given, fetch and frame times (the latter includes
+            compaction), number of rows and bytes are recorded here. Used by
+            :meth:`QueryInstrumentation.read_sql_query`
+        :return: Result table with compact dtypes
+        """
+        start = time.perf_counter()
+        column_types = self._column_types(query)
+        result = db_conn.execute(
+            text(query).execution_options(
+                stream_results=True, max_row_buffer=chunksize
+            ),
+            params or dict(),
+        )
+        columns = list(result.keys())
+        chunks = []
+        bytes_before = 0
+        frame_start = time.perf_counter()
+        fetch_seconds = 0.0
+        num_bytes = 0
+        while True:
+            fetch_start = time.perf_counter()
+            rows = result.fetchmany(chunksize)
+            fetch_seconds += time.perf_counter() - fetch_start
+            if record is not None:
+                num_bytes += estimate_num_bytes(rows)
+            if not rows and chunks:
+                break
+            chunk_df = pd.DataFrame.from_records(
+                rows, columns=columns, coerce_float=True
+            )
+            del rows
+            bytes_before += int(chunk_df.memory_usage(deep=True).sum())
+            chunks.append(
+                self._compact_frame(
+                    chunk_df, column_types, categorize=False, compact_integers=False
+                )
+            )
+            del chunk_df
+            if chunks[-1].shape[0] < chunksize:
+                break
+        compact_df = pd.concat(chunks, ignore_index=True) \
+            if len(chunks) > 1 else chunks[0]
+        del chunks
+        # Now that the full columns are there, convert low cardinality
+        # strings to `category`, and integers to the smallest dtype (a chunk
+        # with NULLs, or with only NULLs, changes the dtype of its column)
+        for name in compact_df.columns:
+            series = compact_df[name]
+            compacted = compact_column(
+                series, column_types.get(name), self._category_max_ratio
+            )
+            if compacted is not series:
+                compact_df[name] = compacted
+        if record is not None:
+            record.fetch_seconds = fetch_seconds
+            record.frame_seconds = time.perf_counter() - frame_start - fetch_seconds
+            record.num_rows = compact_df.shape[0]
+            record.num_bytes = num_bytes
+        self._record(query, compact_df.shape[0], bytes_before, compact_df, start)
+        return compact_df
+
+    def report(self) -> pd.DataFrame:
+        """
+        :return: Dataframe with one row per query compacted, columns query,
+            num_rows, bytes_before, bytes_after, bytes_saved, seconds
+        """
+        with self._lock:
+            rows = [
+                dict(asdict(record), bytes_saved=record.bytes_saved)
+                for record in self._records
+            ]
+        return pd.DataFrame(
+            rows,
+            columns=[
+                "query",
+                "num_rows",
+                "bytes_before",
+                "bytes_after",
+                "bytes_saved",
+                "seconds",
+            ],
+        )
@@ -0,0 +1,85 @@
+"""
+Benchmark of compact result tables (see :class:`ResultCompactor`). Run as:
+
+    python -m script_utils.sql.compact_benchmark --num_rows 100000 1000000
+
+A wide table (integer, low and high cardinality string, datetime and float
+columns) is created in a temporary SQLite database. It is then read by
+:func:`run_sql_query`, with and without compaction, each in a fresh process,
+so that peak RSS (resident set size) can be compared.
+"""
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, SUPPRESS
+from pathlib import Path
+
+from sqlalchemy import create_engine
+
+from script_utils.sql.benchmark_utils import create_wide_table, peak_rss, QUERY
+from script_utils.sql.compact import ResultCompactor
+from script_utils.sql.metadata import DatabaseMetaData
+from script_utils.sql.queries import run_sql_query
+
+
+def run_worker(url: str, compact: bool) -> dict:
+    engine = create_engine(url)
+    start = time.perf_counter()
+    if compact:
+        compactor = ResultCompactor(DatabaseMetaData(engine, lazy=True))
+        result_df = run_sql_query(QUERY, engine, compactor=compactor)
+    else:
+        result_df = run_sql_query(QUERY, engine)
+    elapsed = time.perf_counter() - start
+    return dict(
+        seconds=elapsed,
+        peak_rss=peak_rss(),
+        memory=int(result_df.memory_usage(deep=True).sum()),
+    )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--num_rows", type=int, nargs="+", default=[100000, 500000]
+    )
+    parser.add_argument("--num_groups", type=int, default=5)
+    # Internal: Run a single measurement in this process
+    parser.add_argument("--worker_url", type=str, help=SUPPRESS)
+    parser.add_argument("--worker_compact", action="store_true", help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker_url is not None:
+        print(json.dumps(run_worker(args.worker_url, args.worker_compact)))
+        sys.exit(0)
+
+    for num_rows in args.num_rows:
+        with tempfile.TemporaryDirectory() as tmp_path:
+            url = "sqlite:///" + str(Path(tmp_path) / "compact_benchmark.db")
+            engine = create_engine(url)
+            create_wide_table(engine, num_rows, args.num_groups)
+            engine.dispose()
+            print(f"num_rows = {num_rows}, num_columns = {8 * args.num_groups + 1}")
+            for compact in (False, True):
+                command = [
+                    sys.executable,
+                    "-m",
+                    "script_utils.sql.compact_benchmark",
+                    "--worker_url",
+                    url,
+                ]
+                if compact:
+                    command.append("--worker_compact")
+                result = json.loads(
+                    subprocess.run(
+                        command, capture_output=True, text=True, check=True
+                    ).stdout
+                )
+                name = "compact" if compact else "default"
+                print(
+                    f"  {name:8s}: {result['seconds']:6.2f} secs, "
+                    f"peak RSS {result['peak_rss'] / 2 ** 20:8.1f} MB, "
+                    f"result {result['memory'] / 2 ** 20:8.1f} MB"
+                )
@@ -14,3 +14,9 @@ MYSQL_DOTENV_PASSWORD = "MYSQL_PASSWD"
 MYSQL_DOTENV_PORT = "MYSQL_PORT"
 
 MYSQL_DOTENV_DATABASE = "MYSQL_DATABASE"
+
+SQL_DEFAULT_CHUNKSIZE = 10000
+
+SQL_DEFAULT_MAX_WORKERS = 8
+
+SQL_METADATA_CACHE_PATH = Path.home() / ".cache" / "script_utils" / "sql_metadata"
@@ -1,6 +1,7 @@
-from dataclasses import dataclass
-from dotenv import dotenv_values
-from sqlalchemy import create_engine, URL, Engine
+import os
+from dataclasses import dataclass, astuple
+from threading import Lock
+from typing import TYPE_CHECKING
 
 from script_utils.sql.consts import (
     MYSQL_DEFAULT_PORT,
@@ -12,6 +13,13 @@ from script_utils.sql.consts import (
     MYSQL_DOTENV_DATABASE,
 )
 
+# SQLAlchemy and python-dotenv are imported only when needed, so that
+# importing `ConnectionConfig` is cheap
+if TYPE_CHECKING:
+    from sqlalchemy import URL, Engine
+
+    from script_utils.sql.instrumentation import QueryInstrumentation
+
 
 @dataclass
 class ConnectionConfig:
@@ -19,6 +27,13 @@ class ConnectionConfig:
     password: str  # Is there a better way than storing this here?
     database: str | None = None
     port: int | None = None
+    # Connection pool settings. If `None`, the SQLAlchemy defaults are used
+    pool_size: int | None = None
+    max_overflow: int | None = None
+    pool_recycle: int | None = None  # Seconds
+    pool_pre_ping: bool = False
+    # Allows `LOAD DATA LOCAL INFILE`, used by :func:`bulk_load`
+    local_infile: bool = False
 
     def __post_init__(self):
         if self.database is None:
@@ -36,6 +51,8 @@ class ConnectionConfig:
 
         :return: New :class:`ConnectionConfig` object
         """
+        from dotenv import dotenv_values
+
         config = dotenv_values(dotenv_path=dotenv_path)
         port = config.get(MYSQL_DOTENV_PORT)
         if port is not None:
@@ -47,10 +64,12 @@ class ConnectionConfig:
             port=port,
         )
 
-    def sql_alchemy_url(self) -> URL:
+    def sql_alchemy_url(self) -> "URL":
         """
         @return URL for creating SQLAlchemy engine
         """
+        from sqlalchemy import URL
+
         return URL.create(
             drivername=MYSQL_DRIVERNAME,
             username=self.user,
@@ -58,23 +77,119 @@ class ConnectionConfig:
             host="localhost",
             port=self.port,
             database=self.database,
+            query=dict(local_infile="1") if self.local_infile else dict(),
         )
 
+    def pool_kwargs(self) -> dict:
+        """
+        @return Connection pool arguments for `create_engine`
+        """
+        kwargs = dict(pool_pre_ping=self.pool_pre_ping)
+        for name in ("pool_size", "max_overflow", "pool_recycle"):
+            value = getattr(self, name)
+            if value is not None:
+                kwargs[name] = value
+        return kwargs
+
+    def registry_key(self) -> tuple:
+        """
+        @return Hashable key, used by :func:`get_database_engine`
+        """
+        return astuple(self)
+
+
+# Process-wide registry of engines created by :func:`get_database_engine`, keyed
+# by `(config.registry_key(), echo)`
+_engine_registry: dict[tuple, "Engine"] = dict()
+
+_engine_registry_lock = Lock()
+
+# Config read from `.env` by :func:`get_database_engine`, if no config is passed
+_default_config: ConnectionConfig | None = None
+
 
 def get_database_engine(
     config: ConnectionConfig | None = None,
     echo: bool = False,
-) -> Engine:
+    reuse: bool = True,
+    instrumentation: "QueryInstrumentation | None" = None,
+) -> "Engine":
     """
     Creates `SQLAlchemy` engine object from a connection config `config`. If not
-    provided, the config arguments are read from a `.env` file (preferred).
+    provided, the config arguments are read from a `.env` file (preferred). The
+    `.env` file is read only once per process.
+
+    If `reuse=True`, engines are kept in a process-wide registry, so that calls
+    with equal `config` and `echo` return the same engine (and connection
+    pool). Use :func:`dispose_engines` to clear the registry.
+
+    If `instrumentation` is given, it is attached to the engine returned (see
+    :class:`QueryInstrumentation`). With `reuse=True`, this affects all users
+    of the engine.
 
     TODO: Catch errors!
 
     :param config: See above
     :param echo: Should engine write log messages to `stdout`?
+    :param reuse: See above. Defaults to `True`
+    :param instrumentation: See above (optional)
     :return: :class:`Engine` object
     """
+    global _default_config
+
     if config is None:
-        config = ConnectionConfig.from_dotenv_file()
-    return create_engine(config.sql_alchemy_url(), echo=echo)
+        if _default_config is None:
+            _default_config = ConnectionConfig.from_dotenv_file()
+        config = _default_config
+    if not reuse:
+        engine = _create_engine(config, echo)
+    else:
+        key = (config.registry_key(), echo)
+        with _engine_registry_lock:
+            engine = _engine_registry.get(key)
+            if engine is None:
+                engine = _create_engine(config, echo)
+                _engine_registry[key] = engine
+    if instrumentation is not None:
+        instrumentation.attach(engine)
+    return engine
+
+
+def _create_engine(config: ConnectionConfig, echo: bool) -> "Engine":
+    from sqlalchemy import create_engine
+
+    return create_engine(
+        config.sql_alchemy_url(), echo=echo, **config.pool_kwargs()
+    )
+
+
+def dispose_engines(close: bool = True):
+    """
+    Disposes of the connection pools of all engines in the registry of
+    :func:`get_database_engine`, and clears the registry.
+
+    In a child process after `fork`, use `close=False`. Connections inherited
+    from the parent are then dropped without being closed, which would
+    interfere with the parent using them. This is done automatically for
+    processes created by `os.fork` (e.g., `multiprocessing` with the "fork"
+    start method).
+
+    :param close: See above. Defaults to `True`
+    """
+    with _engine_registry_lock:
+        engines = list(_engine_registry.values())
+        _engine_registry.clear()
+    for engine in engines:
+        engine.dispose(close=close)
+
+
+def _dispose_engines_after_fork():
+    global _engine_registry_lock
+
+    # The lock may have been held by another thread of the parent at fork time
+    _engine_registry_lock = Lock()
+    dispose_engines(close=False)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_dispose_engines_after_fork)
@@ -0,0 +1,107 @@
+"""
+Import-time benchmark for `script_utils.sql`. Run as:
+
+    python -m script_utils.sql.import_benchmark
+
+Each statement in `STATEMENTS` is run `--num_runs` times in a fresh
+interpreter with `python -X importtime`. The import time of the package (sum
+of "self" times over all `script_utils` modules imported) is reported as
+median over the runs. Interpreter startup and imports of other modules are
+not counted, so there is no need to subtract the (noisy) time of a bare
+interpreter. Exits with status 1 if a statement exceeds its threshold, or if
+it imports a module it should not (e.g., pandas for `ConnectionConfig`).
+"""
+import subprocess
+import sys
+from argparse import ArgumentParser
+from dataclasses import dataclass, field
+from statistics import median
+
+
+@dataclass(frozen=True)
+class ImportCase:
+    statement: str
+    threshold_ms: float
+    forbidden_modules: list[str] = field(default_factory=list)
+
+
+PACKAGE_NAME = "script_utils"
+
+HEAVY_MODULES = ["pandas", "sqlalchemy", "dotenv", "pyarrow"]
+
+STATEMENTS = [
+    ImportCase("import script_utils.sql", 5.0, HEAVY_MODULES),
+    ImportCase(
+        "from script_utils.sql import ConnectionConfig", 5.0, HEAVY_MODULES
+    ),
+    ImportCase(
+        "from script_utils.sql import get_database_engine",
+        5.0,
+        HEAVY_MODULES,
+    ),
+]
+
+
+def measure_import_time(statement: str) -> tuple[float, set[str]]:
+    """
+    Runs `statement` in a fresh interpreter with `-X importtime`.
+
+    :param statement: Python statement
+    :return: `(package_ms, modules)`, where `package_ms` is the sum of self
+        times of all `PACKAGE_NAME` modules imported, and `modules` is the set
+        of top-level modules imported
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    package_us = 0
+    modules = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        try:
+            self_us = int(parts[0])
+        except ValueError:
+            continue  # Header line
+        top_level = parts[2].strip().split(".")[0]
+        modules.add(top_level)
+        if top_level == PACKAGE_NAME:
+            package_us += self_us
+    return package_us / 1000, modules
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--num_runs", type=int, default=5)
+    parser.add_argument(
+        "--threshold_factor",
+        type=float,
+        default=1.0,
+        help="Thresholds are multiplied by this factor (e.g., for slow machines)",
+    )
+    args = parser.parse_args()
+
+    failed = False
+    for case in STATEMENTS:
+        timings = []
+        modules = set()
+        for _ in range(args.num_runs):
+            package_ms, modules = measure_import_time(case.statement)
+            timings.append(package_ms)
+        elapsed_ms = median(timings)
+        threshold_ms = case.threshold_ms * args.threshold_factor
+        messages = []
+        if elapsed_ms > threshold_ms:
+            messages.append(f"exceeds threshold {threshold_ms:.1f} ms")
+        forbidden = sorted(modules.intersection(case.forbidden_modules))
+        if forbidden:
+            messages.append(f"imports {', '.join(forbidden)}")
+        status = "FAIL (" + "; ".join(messages) + ")" if messages else "OK"
+        print(f"{case.statement}: {elapsed_ms:.1f} ms [{status}]")
+        failed = failed or bool(messages)
+    if failed:
+        sys.exit(1)
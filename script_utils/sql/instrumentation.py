@@ -0,0 +1,453 @@
+import bisect
+import json
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Iterator
+
+import pandas as pd
+from sqlalchemy import event
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.sql import text
+
+from script_utils.sql.cache import normalize_sql
+
+if TYPE_CHECKING:
+    from script_utils.sql.compact import ResultCompactor
+
+
+PHASES = ("checkout", "execute", "fetch", "frame", "total")
+
+# Upper bucket boundaries (in milliseconds) of :class:`HistogramSink`. The last
+# bucket collects everything larger
+HISTOGRAM_BOUNDARIES_MS = (
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500,
+    1000, 2500, 5000, 10000, 30000, 60000,
+)
+
+# Key in `Connection.info`, stack of start times of cursor executions
+_EXECUTE_START_KEY = "script_utils_execute_start"
+
+
+@dataclass
+class QueryRecord:
+    """
+    Timings and sizes for a single query. Phases are:
+
+    * checkout: Checking out a connection from the pool of the engine
+    * execute: Running the statement on the server (cursor execution)
+    * fetch: Fetching rows from the cursor
+    * frame: Constructing the result dataframe
+
+    Queries run by :func:`run_sql_queries` and :func:`run_sql_queries_parallel`
+    have all phases. For other statements run on an instrumented engine
+    (e.g., streaming queries, metadata reflection), only `execute` is
+    recorded, and `num_rows` is the row count reported by the cursor (if
+    any).
+
+    `num_bytes` is an estimate of the payload fetched: lengths of string and
+    bytes values, 8 bytes for any other non-null value.
+    """
+    statement: str
+    started: float  # Wall clock time, as returned by `time.time`
+    checkout_seconds: float = 0.0
+    execute_seconds: float = 0.0
+    fetch_seconds: float = 0.0
+    frame_seconds: float = 0.0
+    num_rows: int | None = None
+    num_bytes: int | None = None
+    pool_checked_out: int | None = None  # Connections checked out after checkout
+    error: str | None = None
+
+    @property
+    def total_seconds(self) -> float:
+        return (
+            self.checkout_seconds
+            + self.execute_seconds
+            + self.fetch_seconds
+            + self.frame_seconds
+        )
+
+    def phase_seconds(self, phase: str) -> float:
+        return getattr(self, phase + "_seconds")
+
+    def to_dict(self) -> dict:
+        result = asdict(self)
+        result["total_seconds"] = self.total_seconds
+        return result
+
+
+class QuerySink:
+    """
+    Base class of sinks, which receive :class:`QueryRecord` objects from
+    :class:`QueryInstrumentation`. Sinks may be called from several threads,
+    and should not raise exceptions.
+    """
+    def record(self, record: QueryRecord):
+        raise NotImplementedError
+
+
+class CallbackSink(QuerySink):
+    def __init__(self, callback: Callable[[QueryRecord], Any]):
+        self._callback = callback
+
+    def record(self, record: QueryRecord):
+        self._callback(record)
+
+
+class HistogramSink(QuerySink):
+    """
+    Maintains histograms of timings for every phase (see
+    :class:`QueryRecord`), with log-spaced buckets given by
+    `HISTOGRAM_BOUNDARIES_MS`. Also aggregates count and total time per
+    normalized statement, which helps to spot queries worth caching.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            num_buckets = len(HISTOGRAM_BOUNDARIES_MS) + 1
+            self._counts = {phase: [0] * num_buckets for phase in PHASES}
+            self._sums = {phase: 0.0 for phase in PHASES}
+            self._maxima = {phase: 0.0 for phase in PHASES}
+            self._num_records = 0
+            self._num_errors = 0
+            self._num_rows = 0
+            self._num_bytes = 0
+            self._by_statement = dict()
+
+    def record(self, record: QueryRecord):
+        statement = normalize_sql(record.statement)
+        with self._lock:
+            self._num_records += 1
+            if record.error is not None:
+                self._num_errors += 1
+            self._num_rows += record.num_rows or 0
+            self._num_bytes += record.num_bytes or 0
+            for phase in PHASES:
+                value_ms = record.phase_seconds(phase) * 1000
+                pos = bisect.bisect_left(HISTOGRAM_BOUNDARIES_MS, value_ms)
+                self._counts[phase][pos] += 1
+                self._sums[phase] += value_ms
+                self._maxima[phase] = max(self._maxima[phase], value_ms)
+            count, total_ms = self._by_statement.get(statement, (0, 0.0))
+            self._by_statement[statement] = (
+                count + 1, total_ms + record.total_seconds * 1000
+            )
+
+    def _quantile(self, phase: str, q: float) -> float:
+        # Upper boundary of bucket containing the quantile
+        counts = self._counts[phase]
+        target = q * self._num_records
+        cumulative = 0
+        for pos, count in enumerate(counts):
+            cumulative += count
+            if cumulative >= target and count > 0:
+                if pos < len(HISTOGRAM_BOUNDARIES_MS):
+                    return min(HISTOGRAM_BOUNDARIES_MS[pos], self._maxima[phase])
+                break
+        return self._maxima[phase]
+
+    def summary(self) -> pd.DataFrame:
+        """
+        Quantiles are upper bucket boundaries (capped by the maximum), so they
+        overestimate.
+
+        :return: Dataframe with one row per phase, columns count, mean_ms,
+            p50_ms, p90_ms, p99_ms, max_ms
+        """
+        with self._lock:
+            rows = []
+            for phase in PHASES:
+                num = self._num_records
+                rows.append(
+                    dict(
+                        phase=phase,
+                        count=num,
+                        mean_ms=self._sums[phase] / num if num > 0 else 0.0,
+                        p50_ms=self._quantile(phase, 0.5),
+                        p90_ms=self._quantile(phase, 0.9),
+                        p99_ms=self._quantile(phase, 0.99),
+                        max_ms=self._maxima[phase],
+                    )
+                )
+        return pd.DataFrame(rows).set_index("phase")
+
+    def totals(self) -> dict[str, int]:
+        """
+        :return: Number of queries, errors, rows, and bytes recorded
+        """
+        with self._lock:
+            return dict(
+                queries=self._num_records,
+                errors=self._num_errors,
+                rows=self._num_rows,
+                bytes=self._num_bytes,
+            )
+
+    def top_statements(self, num: int = 10) -> pd.DataFrame:
+        """
+        :param num: Number of statements to return
+        :return: Statements with the largest total time, columns count,
+            total_ms, mean_ms
+        """
+        with self._lock:
+            items = sorted(
+                self._by_statement.items(), key=lambda x: x[1][1], reverse=True
+            )[:num]
+        return pd.DataFrame(
+            [
+                dict(
+                    statement=statement,
+                    count=count,
+                    total_ms=total_ms,
+                    mean_ms=total_ms / count,
+                )
+                for statement, (count, total_ms) in items
+            ],
+            columns=["statement", "count", "total_ms", "mean_ms"],
+        )
+
+
+class SlowQueryLog(QuerySink):
+    """
+    Appends queries whose total time is at least `threshold_seconds`, as well
+    as queries which failed, to a JSONL file `fname` (one JSON object per
+    line, see :meth:`QueryRecord.to_dict`).
+    """
+    def __init__(self, fname: str | Path, threshold_seconds: float = 1.0):
+        self._fname = Path(fname)
+        self._threshold_seconds = threshold_seconds
+        self._lock = threading.Lock()
+        self._fname.parent.mkdir(parents=True, exist_ok=True)
+
+    def record(self, record: QueryRecord):
+        if record.error is None and record.total_seconds < self._threshold_seconds:
+            return
+        line = json.dumps(record.to_dict()) + "\n"
+        with self._lock, open(self._fname, "a") as fp:
+            fp.write(line)
+
+
+def estimate_num_bytes(rows: list) -> int:
+    """
+    :param rows: Rows fetched from a cursor
+    :return: Estimate of payload, see :class:`QueryRecord`
+    """
+    num_bytes = 0
+    for row in rows:
+        for value in row:
+            if value is None:
+                continue
+            elif isinstance(value, (str, bytes, bytearray)):
+                num_bytes += len(value)
+            else:
+                num_bytes += 8
+    return num_bytes
+
+
+# Instrumentation attached to engines. Engines which are not instrumented are
+# not in here, and their queries pay for a single lookup only
+_instrumentations: "weakref.WeakKeyDictionary[Engine, QueryInstrumentation]" = \
+    weakref.WeakKeyDictionary()
+
+
+def get_instrumentation(engine: Engine) -> "QueryInstrumentation | None":
+    """
+    :param engine: Engine
+    :return: Instrumentation attached to `engine`, or `None`
+    """
+    return _instrumentations.get(engine)
+
+
+class QueryInstrumentation:
+    """
+    Records timings, row counts, and bytes fetched for queries run on engines
+    it is attached to (see :meth:`attach`, or pass it to
+    :func:`get_database_engine`), and passes a :class:`QueryRecord` for every
+    query to each of `sinks`.
+
+    Server execution time is measured with SQLAlchemy engine events
+    (`before_cursor_execute`, `after_cursor_execute`, `handle_error`), so it
+    is recorded for all statements run on the engine. Connection checkout,
+    fetching, and dataframe construction are measured by
+    :func:`run_sql_queries` and :func:`run_sql_queries_parallel`.
+
+    If no instrumentation is attached to an engine, no event listeners are
+    registered, and the overhead is a single dictionary lookup per call of
+    :func:`run_sql_queries`.
+    """
+    def __init__(self, sinks: list[QuerySink]):
+        self._sinks = list(sinks)
+        self._local = threading.local()
+
+    @property
+    def sinks(self) -> list[QuerySink]:
+        return self._sinks
+
+    def attach(self, engine: Engine):
+        """
+        Attaches instrumentation to `engine`. An instrumentation attached to
+        `engine` before is detached.
+
+        :param engine: Engine
+        """
+        previous = _instrumentations.get(engine)
+        if previous is self:
+            return
+        if previous is not None:
+            previous.detach(engine)
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(engine, "handle_error", self._handle_error)
+        _instrumentations[engine] = self
+
+    def detach(self, engine: Engine):
+        """
+        Removes instrumentation from `engine`.
+
+        :param engine: Engine
+        """
+        if _instrumentations.get(engine) is not self:
+            return
+        event.remove(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.remove(engine, "after_cursor_execute", self._after_cursor_execute)
+        event.remove(engine, "handle_error", self._handle_error)
+        del _instrumentations[engine]
+
+    def emit(self, record: QueryRecord):
+        for sink in self._sinks:
+            sink.record(record)
+
+    def _current_record(self) -> QueryRecord | None:
+        return getattr(self._local, "record", None)
+
+    def _before_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        conn.info.setdefault(_EXECUTE_START_KEY, []).append(time.perf_counter())
+
+    def _after_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        elapsed = time.perf_counter() - conn.info[_EXECUTE_START_KEY].pop()
+        record = self._current_record()
+        if record is not None:
+            record.execute_seconds += elapsed
+        else:
+            rowcount = getattr(cursor, "rowcount", -1)
+            self.emit(
+                QueryRecord(
+                    statement=statement,
+                    started=time.time() - elapsed,
+                    execute_seconds=elapsed,
+                    num_rows=rowcount if rowcount >= 0 else None,
+                )
+            )
+
+    def _handle_error(self, exception_context):
+        conn = exception_context.connection
+        start_times = None if conn is None else conn.info.get(_EXECUTE_START_KEY)
+        elapsed = time.perf_counter() - start_times.pop() if start_times else 0.0
+        error = repr(exception_context.original_exception)
+        record = self._current_record()
+        if record is not None:
+            record.execute_seconds += elapsed
+            record.error = error
+        else:
+            self.emit(
+                QueryRecord(
+                    statement=exception_context.statement or "",
+                    started=time.time() - elapsed,
+                    execute_seconds=elapsed,
+                    error=error,
+                )
+            )
+
+    @contextmanager
+    def track(
+        self,
+        statement: str,
+        checkout_seconds: float = 0.0,
+        pool_checked_out: int | None = None,
+    ) -> Iterator[QueryRecord]:
+        """
+        Context manager. Statements executed in the current thread within the
+        context add their execution time to the record returned, which is
+        passed to the sinks at the end.
+
+        :param statement: SQL query
+        :param checkout_seconds: Time for checking out the connection
+        :param pool_checked_out: Connections checked out from the pool
+        :return: Record for query
+        """
+        record = QueryRecord(
+            statement=statement,
+            started=time.time(),
+            checkout_seconds=checkout_seconds,
+            pool_checked_out=pool_checked_out,
+        )
+        self._local.record = record
+        try:
+            yield record
+        except Exception as ex:
+            if record.error is None:
+                record.error = repr(ex)
+            raise
+        finally:
+            self._local.record = None
+            self.emit(record)
+
+    def read_sql_query(
+        self,
+        query: str,
+        db_conn: Connection,
+        params: dict | None = None,
+        checkout_seconds: float = 0.0,
+        compactor: "ResultCompactor | None" = None,
+    ) -> pd.DataFrame:
+        """
+        Instrumented variant of `pd.read_sql_query`, which times fetching and
+        dataframe construction separately.
+
+        If `compactor` is given, the result is read with
+        :meth:`ResultCompactor.read_sql_query`, which converts it to compact
+        dtypes chunk by chunk. Then, the frame phase includes compaction.
+
+        :param query: SQL query
+        :param db_conn: Connection to run query with
+        :param params: Bind parameters for the query (optional)
+        :param checkout_seconds: Time for checking out `db_conn`, if it was
+            checked out for this query
+        :param compactor: Converts result table to compact dtypes (optional)
+        :return: Result table
+        """
+        pool_checked_out = _pool_checked_out(db_conn.engine)
+        with self.track(query, checkout_seconds, pool_checked_out) as record:
+            if compactor is not None:
+                return compactor.read_sql_query(
+                    query, db_conn, params, record=record
+                )
+            result = db_conn.execute(text(query), params or dict())
+            start = time.perf_counter()
+            rows = result.fetchall()
+            columns = list(result.keys())
+            record.fetch_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            result_df = pd.DataFrame.from_records(
+                rows, columns=columns, coerce_float=True
+            )
+            record.frame_seconds = time.perf_counter() - start
+            record.num_rows = len(rows)
+            record.num_bytes = estimate_num_bytes(rows)
+        return result_df
+
+
+def _pool_checked_out(engine: Engine) -> int | None:
+    checkedout = getattr(engine.pool, "checkedout", None)
+    return checkedout() if checkedout is not None else None
@@ -1,18 +1,146 @@
-from sqlalchemy import MetaData, Engine
+import hashlib
+import pickle
+from pathlib import Path
+
+from sqlalchemy import MetaData, Engine, Table, inspect, text
+
+from script_utils.sql.consts import SQL_METADATA_CACHE_PATH
+
+
+# Queries returning a summary of all tables and columns of the current
+# database, which is cheap to obtain compared to full reflection
+_SCHEMA_SUMMARY_QUERIES = {
+    "mysql": (
+        "SELECT table_name, column_name, column_type, is_nullable, column_key "
+        "FROM information_schema.columns WHERE table_schema = DATABASE() "
+        "ORDER BY table_name, ordinal_position"
+    ),
+    "postgresql": (
+        "SELECT table_name, column_name, data_type, is_nullable "
+        "FROM information_schema.columns WHERE table_schema = current_schema() "
+        "ORDER BY table_name, ordinal_position"
+    ),
+    "sqlite": "SELECT type, name, sql FROM sqlite_master ORDER BY type, name",
+}
+
+
+def schema_fingerprint(engine: Engine) -> str:
+    """
+    Computes a fingerprint of the schema of the database associated with
+    `engine`, which changes whenever tables or columns are added, removed or
+    altered. For dialects not covered in `_SCHEMA_SUMMARY_QUERIES`, only table
+    names are taken into account.
+
+    :param engine: Engine for database
+    :return: Fingerprint (hex digest)
+    """
+    query = _SCHEMA_SUMMARY_QUERIES.get(engine.dialect.name)
+    if query is not None:
+        with engine.connect() as db_conn:
+            rows = [tuple(row) for row in db_conn.execute(text(query))]
+    else:
+        rows = sorted(inspect(engine).get_table_names())
+    return hashlib.sha256(repr(rows).encode("utf-8")).hexdigest()
 
 
 class DatabaseMetaData:
     """
     Represents metadata for the database associated with an engine passed at
     construction.
+
+    If `use_cache=True`, the reflected metadata is stored on disk in
+    `cache_path`, keyed by the database URL. It is loaded from there by later
+    constructions, unless the schema fingerprint (see
+    :func:`schema_fingerprint`) has changed, in which case the database is
+    reflected again.
+
+    If `lazy=True`, nothing is reflected at construction. :meth:`table_names`
+    then only queries table names, and :meth:`table` reflects single tables.
+    Full reflection is done once :attr:`metadata` is accessed.
     """
-    def __init__(self, engine: Engine):
+    def __init__(
+        self,
+        engine: Engine,
+        use_cache: bool = False,
+        cache_path: Path | str | None = None,
+        lazy: bool = False,
+    ):
+        self._engine = engine
         self._metadata = MetaData()
-        self._metadata.reflect(engine)
+        self._fully_reflected = False
+        self._table_names = None
+        self._cache_fname = None
+        self._fingerprint = None
+        if use_cache:
+            if cache_path is None:
+                cache_path = SQL_METADATA_CACHE_PATH
+            url_str = engine.url.render_as_string(hide_password=True)
+            url_hash = hashlib.sha256(url_str.encode("utf-8")).hexdigest()
+            self._cache_fname = Path(cache_path) / f"{url_hash[:32]}.pkl"
+            self._fingerprint = schema_fingerprint(engine)
+            self._load_from_cache()
+        if not (lazy or self._fully_reflected):
+            self._reflect_all()
+
+    def _load_from_cache(self):
+        try:
+            with open(self._cache_fname, "rb") as fp:
+                fingerprint, metadata = pickle.load(fp)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return
+        if fingerprint == self._fingerprint:
+            self._metadata = metadata
+            self._fully_reflected = True
+
+    def _store_to_cache(self):
+        self._cache_fname.parent.mkdir(parents=True, exist_ok=True)
+        # Write to temporary file first, so that concurrent readers never see
+        # a partially written file
+        tmp_fname = self._cache_fname.with_suffix(".tmp")
+        with open(tmp_fname, "wb") as fp:
+            pickle.dump((self._fingerprint, self._metadata), fp)
+        tmp_fname.replace(self._cache_fname)
+
+    def _reflect_all(self):
+        self._metadata.reflect(self._engine)
+        self._fully_reflected = True
+        if self._cache_fname is not None:
+            self._store_to_cache()
+
+    def invalidate_cache(self):
+        """
+        Removes the on-disk cache entry for this database (if any). Metadata is
+        reflected again when it is next needed.
+        """
+        if self._cache_fname is not None:
+            self._cache_fname.unlink(missing_ok=True)
+            self._fingerprint = schema_fingerprint(self._engine)
+        self._metadata = MetaData()
+        self._fully_reflected = False
+        self._table_names = None
 
     @property
     def metadata(self) -> MetaData:
+        if not self._fully_reflected:
+            self._reflect_all()
         return self._metadata
 
     def table_names(self) -> list[str]:
-        return list(self._metadata.tables.keys())
+        if self._fully_reflected:
+            return list(self._metadata.tables.keys())
+        if self._table_names is None:
+            self._table_names = inspect(self._engine).get_table_names()
+        return list(self._table_names)
+
+    def table(self, name: str) -> Table:
+        """
+        Returns metadata for table `name`. If not already present, only this
+        table is reflected (along with tables it refers to by foreign keys).
+
+        :param name: Name of table
+        :return: :class:`Table` object
+        """
+        table = self._metadata.tables.get(name)
+        if table is None:
+            table = Table(name, self._metadata, autoload_with=self._engine)
+        return table
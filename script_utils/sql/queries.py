@@ -1,38 +1,225 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
 import pandas as pd
 from sqlalchemy.sql import text
 from sqlalchemy.engine import Engine
 
+from script_utils.sql.cache import QueryResultCache
+from script_utils.sql.compact import ResultCompactor
+from script_utils.sql.consts import SQL_DEFAULT_CHUNKSIZE, SQL_DEFAULT_MAX_WORKERS
+from script_utils.sql.instrumentation import get_instrumentation
+
 
 def run_sql_queries(
     queries: list[str],
     engine: Engine,
+    params: list[dict | None] | None = None,
+    cache: QueryResultCache | None = None,
+    compactor: ResultCompactor | None = None,
 ) -> list[pd.DataFrame]:
     """
     Runs SQL queries `queries` sequentially, returning the result tables as
     data frames. All queries are run with a connection opened from `engine`
     here. The connection is closed before returning.
 
+    If `cache` is given, result tables are looked up there first, and queries
+    are only run on a cache miss. No connection is opened if all results are
+    found in the cache. Note that cached result tables are shared, they must
+    not be modified in place.
+
+    If a :class:`QueryInstrumentation` is attached to `engine`, timings for
+    connection checkout, execution, fetching, and dataframe construction are
+    recorded for every query run (not for cache hits).
+
+    If `compactor` is given, result tables are converted to compact dtypes
+    chunk by chunk while they are fetched (see :class:`ResultCompactor`),
+    before they are stored in `cache`. Cache hits are returned as stored.
+
     TODO: Deal with errors!
 
     :param queries: List of SQL queries to execute
     :param engine: Engine to open connections from
+    :param params: Bind parameters for each query (optional)
+    :param cache: Query result cache (optional)
+    :param compactor: Converts result tables to compact dtypes (optional)
     :return: List of result tables
     """
-    with engine.connect() as db_conn:
+    if params is None:
+        params = [None] * len(queries)
+    assert len(params) == len(queries), \
+        f"len(params) = {len(params)} != {len(queries)} = len(queries)"
+    if cache is not None:
         results = [
-            pd.read_sql_query(sql=text(query), con=db_conn)
-            for query in queries
+            cache.get(query, engine, query_params)
+            for query, query_params in zip(queries, params)
         ]
+    else:
+        results = [None] * len(queries)
+    missing = [pos for pos, result in enumerate(results) if result is None]
+    if missing:
+        instrumentation = get_instrumentation(engine)
+        start = time.perf_counter()
+        with engine.connect() as db_conn:
+            checkout_seconds = time.perf_counter() - start
+            for pos in missing:
+                if instrumentation is not None:
+                    results[pos] = instrumentation.read_sql_query(
+                        queries[pos],
+                        db_conn,
+                        params[pos],
+                        checkout_seconds,
+                        compactor=compactor,
+                    )
+                    # Connection is checked out once for all queries
+                    checkout_seconds = 0.0
+                elif compactor is not None:
+                    results[pos] = compactor.read_sql_query(
+                        queries[pos], db_conn, params[pos]
+                    )
+                else:
+                    results[pos] = pd.read_sql_query(
+                        sql=text(queries[pos]), con=db_conn, params=params[pos]
+                    )
+                if cache is not None:
+                    cache.put(queries[pos], engine, results[pos], params[pos])
     return results
 
 
-def run_sql_query(query: str, engine: Engine) -> pd.DataFrame:
+def run_sql_query(
+    query: str,
+    engine: Engine,
+    params: dict | None = None,
+    cache: QueryResultCache | None = None,
+    compactor: ResultCompactor | None = None,
+) -> pd.DataFrame:
     """
     Special case of :func:`run_sql_queries` for a single query. A connection is
     opened and closed for this query.
 
     :param query: SQL query
     :param engine: Engine to open connections from
+    :param params: Bind parameters for the query (optional)
+    :param cache: Query result cache (optional)
+    :param compactor: Converts result table to compact dtypes (optional)
     :return: Result table
     """
-    return run_sql_queries([query], engine)[0]
+    return run_sql_queries(
+        [query], engine, params=[params], cache=cache, compactor=compactor
+    )[0]
+
+
+def run_sql_queries_parallel(
+    queries: list[str],
+    engine: Engine,
+    max_workers: int | None = None,
+    return_exceptions: bool = False,
+    compactor: ResultCompactor | None = None,
+) -> list[pd.DataFrame | Exception]:
+    """
+    Parallel variant of :func:`run_sql_queries`. Queries are distributed over a
+    pool of `max_workers` threads. Each query is run with its own connection
+    checked out from the connection pool of `engine`, which is returned to the
+    pool once the query is done. Queries must therefore be independent of each
+    other (no temporary tables, session variables, etc.).
+
+    Results are returned in the same order as `queries`. If
+    `return_exceptions=True`, an exception raised by a query is returned in
+    place of its result table, and the remaining queries are not affected.
+    Otherwise, the first exception (in the order of `queries`) is raised once
+    all queries are done.
+
+    Note that `max_workers` should not be larger than the pool size (plus
+    overflow) of `engine`, otherwise threads block on checking out connections.
+    With a :class:`QueryInstrumentation` attached to `engine`, this shows up
+    in the checkout timings.
+
+    :param queries: List of SQL queries to execute
+    :param engine: Engine to check out connections from
+    :param max_workers: Number of threads. Defaults to `SQL_DEFAULT_MAX_WORKERS`
+    :param return_exceptions: See above. Defaults to `False`
+    :param compactor: Converts result tables to compact dtypes (optional)
+    :return: List of result tables (or exceptions, see above)
+    """
+    if max_workers is None:
+        max_workers = SQL_DEFAULT_MAX_WORKERS
+    max_workers = max(min(max_workers, len(queries)), 1)
+    instrumentation = get_instrumentation(engine)
+
+    def run_single_query(query: str) -> pd.DataFrame | Exception:
+        try:
+            start = time.perf_counter()
+            with engine.connect() as db_conn:
+                if instrumentation is not None:
+                    return instrumentation.read_sql_query(
+                        query,
+                        db_conn,
+                        checkout_seconds=time.perf_counter() - start,
+                        compactor=compactor,
+                    )
+                elif compactor is not None:
+                    return compactor.read_sql_query(query, db_conn)
+                else:
+                    return pd.read_sql_query(sql=text(query), con=db_conn)
+        except Exception as ex:
+            return ex
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(run_single_query, queries))
+    if not return_exceptions:
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+    return results
+
+
+def iter_sql_queries_chunks(
+    queries: list[str],
+    engine: Engine,
+    chunksize: int = SQL_DEFAULT_CHUNKSIZE,
+) -> Iterator[tuple[int, pd.DataFrame]]:
+    """
+    Generator function. Streaming variant of :func:`run_sql_queries`. Result
+    tables are not materialized, but returned in chunks of at most `chunksize`
+    rows each. The connection is opened with `stream_results=True`, so that
+    dialects supporting server-side cursors (MySQL, PostgreSQL) do not buffer
+    the full result on the client side. Only one chunk per query is held in
+    memory at any time, as long as the caller does not keep references.
+
+    All queries are run with a connection opened from `engine` here, which is
+    closed once the generator is exhausted (or closed).
+
+    :param queries: List of SQL queries to execute
+    :param engine: Engine to open connections from
+    :param chunksize: Maximum number of rows per chunk
+    :return: Tuples `(pos, chunk_df)`, where `pos` is the position of the query
+        in `queries`, and `chunk_df` is the next chunk of its result table
+    """
+    assert chunksize > 0, f"chunksize = {chunksize} must be positive"
+    with engine.connect().execution_options(
+        stream_results=True, max_row_buffer=chunksize
+    ) as db_conn:
+        for pos, query in enumerate(queries):
+            for chunk_df in pd.read_sql_query(
+                sql=text(query), con=db_conn, chunksize=chunksize
+            ):
+                yield pos, chunk_df
+
+
+def iter_sql_query_chunks(
+    query: str,
+    engine: Engine,
+    chunksize: int = SQL_DEFAULT_CHUNKSIZE,
+) -> Iterator[pd.DataFrame]:
+    """
+    Generator function. Special case of :func:`iter_sql_queries_chunks` for a
+    single query.
+
+    :param query: SQL query
+    :param engine: Engine to open connections from
+    :param chunksize: Maximum number of rows per chunk
+    :return: Chunks of result table
+    """
+    for _, chunk_df in iter_sql_queries_chunks([query], engine, chunksize):
+        yield chunk_df
@@ -1,16 +1,33 @@
 # Compute effective fixed rate rho for portfolio
 # See performance.txt
+#
+# The solver is in `effective_rate.py`, it can also be used to solve for many
+# portfolios (or valuation dates) at once.
+#
+# If `--events_csv` is given, cash flows and portfolio values are loaded from
+# this file (see `effective_rate_series.py` for the format), and the effective
+# rate is printed for every portfolio value. Otherwise, the hardcoded example
+# below is used.
+
+import sys
+from argparse import ArgumentParser
 
 import numpy as np
-import scipy.optimize as sopt
 
-def logsumexp(x):
-    mx = np.max(x)
-    return np.log(np.sum(np.exp(x - mx))) + mx
+from effective_rate import solve_effective_rates
+from effective_rate_series import load_events_csv, iter_effective_rates
 
-def critfunc(x, data, port_value):
-    arg = np.array([1.0, x]).reshape((2, 1))
-    return logsumexp(np.dot(data, arg)) - np.log(port_value)
+parser = ArgumentParser()
+parser.add_argument(
+    "--events_csv",
+    type=str,
+    help="CSV file with columns date, kind (cash_flow or value), amount",
+)
+args = parser.parse_args()
+if args.events_csv is not None:
+    for day, rho in iter_effective_rates(load_events_csv(args.events_csv)):
+        print(f"{day.isoformat()}: rho = {rho:f}")
+    sys.exit(0)
 
 # NOTE:
 # Since different ETFs are always bought at exactly the same ratio,
@@ -70,10 +87,12 @@ data = np.array(
      [np.log(3000.0),  float(days_start-516)/365]])
 
 data[:, 0] += np.log(frac)
-a = np.log1p(0.0001)  # More than 0.01%
-b = np.log1p(0.3)  # Less than 30%
-log1prho = sopt.brentq(
-    f=lambda x: critfunc(x, data, port_value),
-    a=a, b=b)
+rho = solve_effective_rates(
+    log_amounts=data[:, 0].reshape((1, -1)),
+    years=data[:, 1].reshape((1, -1)),
+    port_values=np.array([port_value]),
+    rho_lower=0.0001,  # More than 0.01%
+    rho_upper=0.3,  # Less than 30%
+)[0]
 
-print('Effective rate: rho = %f\n' % (np.expm1(log1prho),))
+print('Effective rate: rho = %f\n' % (rho,))
@@ -0,0 +1,239 @@
+# Incremental computation of the effective rate rho over a series of
+# valuation dates.
+#
+# Events are cash flows (date, amount) and portfolio values (date, value),
+# ordered by date. With u_i the date of cash flow i (in years since the first
+# cash flow) and t the valuation date, the criterion of `effective_rate.py`
+# becomes
+#
+#   f(x) = x t + G(x) - log(V),   G(x) = logsumexp_i(log(a_i) - x u_i),
+#
+# where G only depends on the cash flows so far. We maintain log-sum-exp
+# accumulators at an anchor point x_ref: with w_i = exp(log(a_i) - x_ref u_i
+# - m) (m the maximum exponent) and a scale U >= max_i u_i (a power of 2),
+# the moments M_k = sum_i w_i (u_i / U)^k for k = 0, ..., K + 1. Since
+#
+#   sum_i a_i exp(-x u_i) = exp(m) sum_k (-(x - x_ref) U)^k / k! M_k,
+#
+# G(x) and G'(x) are evaluated in O(K) from the moments, as long as
+# |x - x_ref| U <= 1, where truncating the series after K terms is exact to
+# machine precision. Adding a cash flow updates the moments in O(K). The root
+# find for a new valuation date is warm-started from the previous solution,
+# and since rho changes little between consecutive dates, Newton steps
+# rarely leave this range. Only then are the moments recomputed at a new
+# anchor point, in O(N K).
+from dataclasses import dataclass
+from datetime import date
+from pathlib import Path
+from typing import Iterable, Iterator
+import csv
+import math
+
+import numpy as np
+
+from effective_rate import DEFAULT_RHO_LOWER, DEFAULT_RHO_UPPER
+
+
+CASH_FLOW = "cash_flow"
+
+PORTFOLIO_VALUE = "value"
+
+DAYS_PER_YEAR = 365
+
+# Number of terms K of the series expansion around the anchor point
+NUM_TERMS = 20
+
+# Series is used for |x - x_ref| U up to this value. The truncation error
+# is below 1 / (K + 1)!
+MAX_SCALED_STEP = 1.0
+
+
+@dataclass(frozen=True)
+class Event:
+    date: date
+    kind: str  # CASH_FLOW or PORTFOLIO_VALUE
+    amount: float
+
+
+def load_events_csv(path: Path | str) -> list[Event]:
+    """
+    Loads events from CSV file with columns "date" (ISO format, e.g.
+    2018-04-30), "kind" ("cash_flow" or "value"), and "amount". Events are
+    sorted by date. For equal dates, cash flows come before values.
+
+    :param path: Path of CSV file
+    :return: List of events
+    """
+    with open(path, newline="") as fp:
+        events = [
+            Event(
+                date=date.fromisoformat(row["date"].strip()),
+                kind=row["kind"].strip(),
+                amount=float(row["amount"]),
+            )
+            for row in csv.DictReader(fp)
+        ]
+    for event in events:
+        assert event.kind in (CASH_FLOW, PORTFOLIO_VALUE), \
+            f"kind = '{event.kind}' not supported, must be in {(CASH_FLOW, PORTFOLIO_VALUE)}"
+    return sorted(events, key=lambda e: (e.date, e.kind != CASH_FLOW))
+
+
+class EffectiveRateTracker:
+    """
+    Maintains the cash flows of a portfolio and computes the effective rate
+    for valuation dates, see above. Valuation dates must not decrease.
+    """
+    def __init__(
+        self,
+        rho_lower: float = DEFAULT_RHO_LOWER,
+        rho_upper: float = DEFAULT_RHO_UPPER,
+        tol: float = 1e-12,
+        ftol: float = 1e-9,
+        max_iter: int = 100,
+    ):
+        self._lower = np.log1p(rho_lower)
+        self._upper = np.log1p(rho_upper)
+        self._tol = tol
+        self._ftol = ftol
+        self._max_iter = max_iter
+        self._origin = None
+        self._log_amounts = []
+        self._years = []
+        # Accumulators at anchor point `x_ref`, see above: Maximum exponent
+        # m, scale U, moments M_0, ..., M_{K+1}
+        self._x_ref = 0.5 * (self._lower + self._upper)
+        self._max_arg = -np.inf
+        self._scale = 1.0
+        self._powers = np.arange(NUM_TERMS + 2)
+        self._moments = np.zeros(NUM_TERMS + 2)
+        self._inv_factorials = np.array(
+            [1 / math.factorial(k) for k in range(NUM_TERMS + 1)]
+        )
+        self._x_last = self._x_ref  # Most recent solution, for warm start
+        self.num_anchors = 0  # Number of O(N) recomputations, for diagnostics
+
+    @property
+    def num_cash_flows(self) -> int:
+        return len(self._years)
+
+    def _to_years(self, day: date) -> float:
+        return (day - self._origin).days / DAYS_PER_YEAR
+
+    def add_cash_flow(self, day: date, amount: float):
+        """
+        :param day: Date of cash flow
+        :param amount: Amount (positive)
+        """
+        assert amount > 0, f"amount = {amount} must be positive"
+        if self._origin is None:
+            self._origin = day
+        log_amount = np.log(amount)
+        u = self._to_years(day)
+        self._log_amounts.append(log_amount)
+        self._years.append(u)
+        while u > self._scale:
+            # Doubling U divides M_k by 2^k
+            self._scale *= 2
+            self._moments /= 2.0 ** self._powers
+        arg = log_amount - self._x_ref * u
+        if arg > self._max_arg:
+            self._moments *= np.exp(self._max_arg - arg)
+            self._max_arg = arg
+        weight = np.exp(arg - self._max_arg)
+        self._moments += weight * (u / self._scale) ** self._powers
+
+    def _anchor(self, x: float):
+        # Recomputes accumulators at new anchor point `x`
+        years = np.array(self._years)
+        args = np.array(self._log_amounts) - x * years
+        self._max_arg = np.max(args)
+        weights = np.exp(args - self._max_arg)
+        scaled_years = years / self._scale
+        for k in range(self._moments.size):
+            self._moments[k] = np.sum(weights)
+            weights = weights * scaled_years
+        self._x_ref = x
+        self.num_anchors += 1
+
+    def _criterion(
+        self, x: float, time: float, log_value: float
+    ) -> tuple[float, float]:
+        # f(x), f'(x) from accumulators, requires |x - x_ref| U <= 1
+        step = (self._x_ref - x) * self._scale
+        coeffs = step ** self._powers[:-1] * self._inv_factorials
+        sum0 = np.dot(coeffs, self._moments[:-1])
+        sum1 = np.dot(coeffs, self._moments[1:])
+        fval = x * time + np.log(sum0) + self._max_arg - log_value
+        fderiv = time - self._scale * sum1 / sum0
+        return fval, fderiv
+
+    def effective_rate(self, day: date, port_value: float) -> float:
+        """
+        Computes effective rate for valuation date `day`, using all cash flows
+        added so far.
+
+        :param day: Valuation date
+        :param port_value: Portfolio value at `day`
+        :return: Effective rate rho, or NaN if not in bracket
+        """
+        if self._origin is None:
+            raise ValueError(
+                f"Valuation date {day} has no cash flows before it"
+            )
+        time = self._to_years(day)
+        if time < self._years[-1]:
+            raise ValueError(
+                f"Valuation date {day} is before the latest cash flow"
+            )
+        log_value = np.log(port_value)
+        lower, upper = self._lower, self._upper
+        # Warm start from previous solution
+        x = self._x_last
+        fval = np.inf
+        for _ in range(self._max_iter):
+            if abs(x - self._x_ref) * self._scale > MAX_SCALED_STEP:
+                self._anchor(x)
+            fval, fderiv = self._criterion(x, time, log_value)
+            if fval == 0:
+                break
+            if fval < 0:
+                lower = x
+            else:
+                upper = x
+            x_new = x - fval / fderiv if fderiv > 0 else np.nan
+            # Safeguard: Bisection if Newton step leaves the bracket
+            if not (lower < x_new < upper):
+                x_new = 0.5 * (lower + upper)
+            if abs(x_new - x) <= self._tol:
+                break
+            x = x_new
+        # If there is no root in the bracket, iterates converge to one of its
+        # end points, where `fval` is not close to zero
+        if abs(fval) > self._ftol:
+            return np.nan
+        self._x_last = x
+        return np.expm1(x)
+
+
+def iter_effective_rates(
+    events: Iterable[Event],
+    rho_lower: float = DEFAULT_RHO_LOWER,
+    rho_upper: float = DEFAULT_RHO_UPPER,
+) -> Iterator[tuple[date, float]]:
+    """
+    Generator function. Consumes events ordered by date, and returns the
+    effective rate for every portfolio value event. Value events before the
+    first cash flow are skipped, since there is no rate for them.
+
+    :param events: Events, ordered by date
+    :param rho_lower: Lower end of bracket for rho
+    :param rho_upper: Upper end of bracket for rho
+    :return: Tuples (date, rho)
+    """
+    tracker = EffectiveRateTracker(rho_lower=rho_lower, rho_upper=rho_upper)
+    for event in events:
+        if event.kind == CASH_FLOW:
+            tracker.add_cash_flow(event.date, event.amount)
+        elif tracker.num_cash_flows > 0:
+            yield event.date, tracker.effective_rate(event.date, event.amount)
@@ -0,0 +1,397 @@
+# Deduplicating storage mode used by `process_image_files.py`.
+#
+# Every distinct file content is stored once, in a content-addressed blob
+# store in the root path of the target folder structure (`.blobs/ab/abcd...`,
+# named by BLAKE2b digest). Files in the month folders are hard links to
+# blobs, so the same picture imported several times (under different names,
+# or with different last modified times) takes up space only once.
+#
+# Finding out whether a new file is stored already must not require hashing
+# every file in full. Blobs are looked up by size first. Only if there are
+# blobs of the same size, a hash of the first `PREFIX_SIZE` bytes is computed,
+# and only if this matches as well, the full content hash. New content is
+# hashed while it is copied into the store, so it is read only once.
+from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from threading import Lock
+from typing import Iterable
+import hashlib
+import os
+import shutil
+import threading
+
+from copy_files import (
+    CopyStatus,
+    HASH_BLOCK_SIZE,
+    PARTIAL_SUFFIX,
+    copy_file_atomic,
+    file_digest,
+    DEFAULT_NUM_WORKERS,
+)
+
+
+BLOB_DIR_NAME = ".blobs"
+
+PREFIX_SIZE = 1 << 16
+
+
+def prefix_digest(path: Path, prefix_size: int = PREFIX_SIZE) -> str:
+    """
+    :param path: File path
+    :param prefix_size: Number of bytes at start of file to be hashed
+    :return: BLAKE2b digest of first ``prefix_size`` bytes of file
+    """
+    with open(path, "rb") as fp:
+        return hashlib.blake2b(fp.read(prefix_size)).hexdigest()
+
+
+@dataclass(frozen=True)
+class BlobEntry:
+    content_hash: str
+    size: int
+    prefix_hash: str
+    blob_path: str
+
+    def as_tuple(self) -> tuple[str, int, str, str]:
+        return self.content_hash, self.size, self.prefix_hash, self.blob_path
+
+
+@dataclass
+class DedupStatistics:
+    blobs_added: int = 0
+    bytes_added: int = 0
+    files_linked: int = 0  # Hard links to blobs stored before
+    bytes_saved: int = 0  # Size of files linked instead of copied
+    prefix_hashes: int = 0
+    full_hashes: int = 0  # Not counting hashes computed while copying
+
+
+@dataclass
+class StoreUsage:
+    num_blobs: int
+    bytes_stored: int  # Size of blobs
+    bytes_linked: int  # Size of all hard links to blobs in the month folders
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.bytes_linked - self.bytes_stored
+
+
+def _same_file(path1: Path, path2: Path) -> bool:
+    try:
+        return os.path.samefile(path1, path2)
+    except FileNotFoundError:
+        return False
+
+
+def _link_atomic(blob_path: Path, trg_path: Path):
+    # Hard link is created under a temporary name first, then renamed, so an
+    # existing target is replaced atomically. If the file system does not
+    # support hard links, the blob is copied instead
+    trg_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = trg_path.parent / (trg_path.name + PARTIAL_SUFFIX)
+    tmp_path.unlink(missing_ok=True)
+    try:
+        os.link(blob_path, tmp_path)
+    except OSError:
+        copy_file_atomic(blob_path, trg_path)
+        return
+    os.replace(tmp_path, trg_path)
+
+
+class BlobStore:
+    """
+    Content-addressed store of blobs in ``pics_root_path / BLOB_DIR_NAME``.
+    ``entries`` are the blobs stored before (see
+    :meth:`ImportIndex.load_blobs`). Blobs added are returned by
+    :meth:`new_entries`, they need to be recorded in the index.
+
+    Methods can be called from several threads.
+    """
+    def __init__(
+        self,
+        pics_root_path: Path,
+        entries: Iterable[tuple[str, int, str, str]] = (),
+    ):
+        self._root_path = pics_root_path / BLOB_DIR_NAME
+        self._lock = Lock()
+        self._by_hash = dict()
+        self._by_size = defaultdict(list)
+        self._new_entries = []
+        self.statistics = DedupStatistics()
+        for entry in entries:
+            self._register(BlobEntry(*entry))
+
+    def _register(self, entry: BlobEntry):
+        self._by_hash[entry.content_hash] = entry
+        self._by_size[entry.size].append(entry)
+
+    def blob_path(self, content_hash: str, suffix: str) -> Path:
+        return self._root_path / content_hash[:2] / (content_hash + suffix.lower())
+
+    def new_entries(self) -> list[tuple[str, int, str, str]]:
+        with self._lock:
+            result = [entry.as_tuple() for entry in self._new_entries]
+            self._new_entries.clear()
+        return result
+
+    def _update_statistics(self, **kwargs):
+        with self._lock:
+            for name, value in kwargs.items():
+                setattr(self.statistics, name, getattr(self.statistics, name) + value)
+
+    def find(
+        self, path: Path, size: int
+    ) -> tuple[BlobEntry | None, str | None, str | None]:
+        """
+        Looks for a blob with the same content as file ``path``, comparing
+        size, then prefix hash, then full content hash. Hashes are only
+        computed if needed.
+
+        :param path: File path
+        :param size: Size of file
+        :return: ``(entry, prefix_hash, content_hash)``, where ``entry`` is
+            the blob found (or ``None``), and the hashes are ``None`` unless
+            they had to be computed
+        """
+        with self._lock:
+            candidates = list(self._by_size.get(size, []))
+        if not candidates:
+            return None, None, None
+        prefix_hash = prefix_digest(path)
+        self._update_statistics(prefix_hashes=1)
+        if not any(entry.prefix_hash == prefix_hash for entry in candidates):
+            return None, prefix_hash, None
+        content_hash = file_digest(path)
+        self._update_statistics(full_hashes=1)
+        with self._lock:
+            entry = self._by_hash.get(content_hash)
+        return entry, prefix_hash, content_hash
+
+    def sizes(self) -> set[int]:
+        with self._lock:
+            return set(self._by_size.keys())
+
+    def sizes_and_prefix_hashes(self) -> set[tuple[int, str]]:
+        with self._lock:
+            return set(
+                (entry.size, entry.prefix_hash) for entry in self._by_hash.values()
+            )
+
+    def _add_blob(
+        self,
+        tmp_path: Path,
+        content_hash: str,
+        size: int,
+        prefix_hash: str,
+        suffix: str,
+        copied: bool,
+    ) -> tuple[BlobEntry, bool]:
+        # Moves ``tmp_path`` into the store, unless the same content has been
+        # added in the meantime (by another thread). A blob file which is not
+        # in the index (left behind by an interrupted run) is used as it is,
+        # so that existing hard links to it remain valid
+        with self._lock:
+            entry = self._by_hash.get(content_hash)
+            if entry is None:
+                blob_path = self.blob_path(content_hash, suffix)
+                blob_path.parent.mkdir(parents=True, exist_ok=True)
+                is_orphan = blob_path.exists() and blob_path.stat().st_size == size
+                if not is_orphan:
+                    os.replace(tmp_path, blob_path)
+                entry = BlobEntry(content_hash, size, prefix_hash, str(blob_path))
+                self._register(entry)
+                self._new_entries.append(entry)
+                if not is_orphan:
+                    self.statistics.blobs_added += 1
+                    if copied:
+                        self.statistics.bytes_added += size
+                    return entry, True
+        tmp_path.unlink(missing_ok=True)
+        return entry, False
+
+    def _copy_into_store(
+        self, src_path: Path, prefix_hash: str | None
+    ) -> tuple[BlobEntry, bool]:
+        # Content is copied and hashed in a single pass
+        self._root_path.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._root_path / (
+            f"{threading.get_ident()}-{src_path.name}{PARTIAL_SUFFIX}"
+        )
+        digest = hashlib.blake2b()
+        prefix = b""
+        size = 0
+        try:
+            with open(src_path, "rb") as src_fp, open(tmp_path, "wb") as trg_fp:
+                while block := src_fp.read(HASH_BLOCK_SIZE):
+                    digest.update(block)
+                    if len(prefix) < PREFIX_SIZE:
+                        prefix += block[:(PREFIX_SIZE - len(prefix))]
+                    trg_fp.write(block)
+                    size += len(block)
+            shutil.copystat(src_path, tmp_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        if prefix_hash is None:
+            prefix_hash = hashlib.blake2b(prefix).hexdigest()
+        return self._add_blob(
+            tmp_path,
+            digest.hexdigest(),
+            size,
+            prefix_hash,
+            src_path.suffix,
+            copied=True,
+        )
+
+    def store_file(self, src_path: Path, trg_path: Path) -> tuple[CopyStatus, str]:
+        """
+        Stores content of ``src_path`` (unless stored already), and makes
+        ``trg_path`` a hard link to the blob.
+
+        :param src_path: Source file path
+        :param trg_path: Target file path
+        :return: ``(status, content_hash)``
+        """
+        size = src_path.stat().st_size
+        entry, prefix_hash, _ = self.find(src_path, size)
+        is_new = False
+        if entry is None:
+            entry, is_new = self._copy_into_store(src_path, prefix_hash)
+        blob_path = Path(entry.blob_path)
+        if _same_file(blob_path, trg_path):
+            return CopyStatus.EXISTS, entry.content_hash
+        # A target of different size is incomplete (e.g., from an interrupted
+        # run without deduplication)
+        try:
+            trg_size = trg_path.stat().st_size
+        except FileNotFoundError:
+            trg_size = None
+        _link_atomic(blob_path, trg_path)
+        if not is_new:
+            self._update_statistics(files_linked=1, bytes_saved=size)
+        if trg_size is not None:
+            status = CopyStatus.REPAIRED if trg_size != size else CopyStatus.EXISTS
+        elif is_new:
+            status = CopyStatus.COPIED
+        else:
+            status = CopyStatus.LINKED
+        return status, entry.content_hash
+
+    def adopt_file(
+        self,
+        path: Path,
+        size: int,
+        prefix_hash: str,
+        content_hash: str,
+    ) -> CopyStatus:
+        """
+        Puts file ``path`` from the month folders into the store. If its
+        content is stored already, it is replaced by a hard link to the blob.
+        Otherwise, the file becomes the blob (by a hard link, without
+        copying).
+
+        :param path: File path
+        :param size: Size of file
+        :param prefix_hash: See :func:`prefix_digest`
+        :param content_hash: See :func:`file_digest`
+        :return: ``LINKED`` if replaced by link, ``EXISTS`` otherwise
+        """
+        with self._lock:
+            entry = self._by_hash.get(content_hash)
+        if entry is None:
+            blob_path = self.blob_path(content_hash, path.suffix)
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = blob_path.parent / (blob_path.name + PARTIAL_SUFFIX)
+            tmp_path.unlink(missing_ok=True)
+            try:
+                os.link(path, tmp_path)
+            except OSError:
+                copy_file_atomic(path, tmp_path)
+            entry, is_new = self._add_blob(
+                tmp_path, content_hash, size, prefix_hash, path.suffix, copied=False
+            )
+            if is_new:
+                return CopyStatus.EXISTS
+        if _same_file(Path(entry.blob_path), path):
+            return CopyStatus.EXISTS
+        _link_atomic(Path(entry.blob_path), path)
+        self._update_statistics(files_linked=1, bytes_saved=size)
+        return CopyStatus.LINKED
+
+    def usage(self) -> StoreUsage:
+        """
+        Sizes are determined from the blob files. The number of hard links of
+        a blob (minus one for the blob itself) tells how many files in the
+        month folders share its content.
+
+        :return: Usage statistics of store
+        """
+        with self._lock:
+            entries = list(self._by_hash.values())
+        num_blobs = 0
+        bytes_stored = 0
+        bytes_linked = 0
+        for entry in entries:
+            try:
+                stat = os.stat(entry.blob_path)
+            except FileNotFoundError:
+                continue
+            num_blobs += 1
+            bytes_stored += stat.st_size
+            bytes_linked += stat.st_size * max(stat.st_nlink - 1, 1)
+        return StoreUsage(num_blobs, bytes_stored, bytes_linked)
+
+
+def deduplicate_tree(
+    store: BlobStore,
+    files: Iterable[tuple[Path, os.stat_result]],
+    num_workers: int = DEFAULT_NUM_WORKERS,
+) -> int:
+    """
+    Deduplicates files in the month folders which are not in the store yet
+    (e.g., imported without deduplication). Files are grouped by size, then
+    by prefix hash, then by content hash, so that only files which may have
+    duplicates (in the folders or the store) are hashed. Hashes are computed
+    by a pool of ``num_workers`` threads. Files with duplicates are put into
+    the store, see :meth:`BlobStore.adopt_file`.
+
+    :param store: Blob store
+    :param files: Tuples ``(path, stat_result)`` of files in month folders
+    :param num_workers: Number of threads
+    :return: Number of files replaced by hard links
+    """
+    by_size = defaultdict(list)
+    for path, stat in files:
+        # Files with several links are in the store already
+        if stat.st_nlink == 1:
+            by_size[stat.st_size].append(path)
+    stored_sizes = store.sizes()
+    candidates = [
+        (path, size)
+        for size, paths in by_size.items()
+        if len(paths) > 1 or size in stored_sizes
+        for path in paths
+    ]
+    with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+        prefix_hashes = list(executor.map(prefix_digest, [p for p, _ in candidates]))
+        store._update_statistics(prefix_hashes=len(prefix_hashes))
+        stored_prefixes = store.sizes_and_prefix_hashes()
+        by_prefix = defaultdict(list)
+        for (path, size), prefix_hash in zip(candidates, prefix_hashes):
+            by_prefix[(size, prefix_hash)].append(path)
+        candidates = [
+            (path, size, prefix_hash)
+            for (size, prefix_hash), paths in by_prefix.items()
+            if len(paths) > 1 or (size, prefix_hash) in stored_prefixes
+            for path in paths
+        ]
+        content_hashes = list(executor.map(file_digest, [c[0] for c in candidates]))
+        store._update_statistics(full_hashes=len(content_hashes))
+    num_linked = 0
+    for (path, size, prefix_hash), content_hash in zip(candidates, content_hashes):
+        status = store.adopt_file(path, size, prefix_hash, content_hash)
+        num_linked += int(status == CopyStatus.LINKED)
+    return num_linked
@@ -0,0 +1,332 @@
+# Capture time resolver used by `process_image_files.py`.
+#
+# The last modified time of a file is changed when it is copied off the phone,
+# so it is not a good proxy for when a picture or video was taken. Here, we
+# read the capture time from the file headers:
+#
+# - JPEG: EXIF DateTimeOriginal (APP1 segment at the start of the file)
+# - HEIC: EXIF DateTimeOriginal (item of type "Exif", located via the "meta"
+#   box)
+# - MOV, MP4: creation time in the "mvhd" box of the "moov" box
+#
+# Only header bytes are read, using small bounded reads and seeks. Video data
+# is skipped over by seeking. If the capture time cannot be determined, the
+# last modified time is used instead.
+from pathlib import Path
+from concurrent.futures import Executor, ProcessPoolExecutor
+import calendar
+import os
+import struct
+import time
+
+
+# Upper bound on the size of any header block we read
+MAX_HEADER_BYTES = 1 << 20
+
+# Seconds between 1904-01-01 (QuickTime epoch) and 1970-01-01
+QUICKTIME_EPOCH_OFFSET = 2082844800
+
+EXIF_TAG_DATETIME = 0x0132
+
+EXIF_TAG_EXIF_IFD = 0x8769
+
+EXIF_TAG_DATETIME_ORIGINAL = 0x9003
+
+DEFAULT_BATCH_SIZE = 128
+
+
+def _parse_exif_datetime(value: str) -> float | None:
+    # Format is "YYYY:MM:DD HH:MM:SS" in local time, without time zone. We
+    # return it as if it was UTC, so that `time.gmtime` recovers the fields
+    try:
+        struct_time = time.strptime(value.strip("\x00 "), "%Y:%m:%d %H:%M:%S")
+    except ValueError:
+        return None
+    return float(calendar.timegm(struct_time))
+
+
+def _read_ifd(tiff: bytes, offset: int, endian: str) -> dict[int, tuple]:
+    entries = dict()
+    if offset + 2 > len(tiff):
+        return entries
+    (num_entries,) = struct.unpack_from(endian + "H", tiff, offset)
+    for pos in range(offset + 2, offset + 2 + 12 * num_entries, 12):
+        if pos + 12 > len(tiff):
+            break
+        tag, typ, count = struct.unpack_from(endian + "HHI", tiff, pos)
+        entries[tag] = (typ, count, pos + 8)
+    return entries
+
+
+def _ifd_ascii(tiff: bytes, entry: tuple, endian: str) -> str | None:
+    typ, count, value_pos = entry
+    if typ != 2:  # ASCII
+        return None
+    if count > 4:
+        (value_pos,) = struct.unpack_from(endian + "I", tiff, value_pos)
+    return tiff[value_pos:value_pos + count].decode("ascii", errors="ignore")
+
+
+def capture_time_from_tiff(tiff: bytes) -> float | None:
+    """
+    :param tiff: EXIF data, starting with TIFF header
+    :return: DateTimeOriginal (or DateTime) as POSIX timestamp, or ``None``
+    """
+    if tiff[:2] == b"II":
+        endian = "<"
+    elif tiff[:2] == b"MM":
+        endian = ">"
+    else:
+        return None
+    try:
+        (ifd0_offset,) = struct.unpack_from(endian + "I", tiff, 4)
+        ifd0 = _read_ifd(tiff, ifd0_offset, endian)
+        candidates = []
+        if EXIF_TAG_EXIF_IFD in ifd0:
+            (exif_offset,) = struct.unpack_from(
+                endian + "I", tiff, ifd0[EXIF_TAG_EXIF_IFD][2]
+            )
+            exif_ifd = _read_ifd(tiff, exif_offset, endian)
+            candidates.append(exif_ifd.get(EXIF_TAG_DATETIME_ORIGINAL))
+        candidates.append(ifd0.get(EXIF_TAG_DATETIME))
+        for entry in candidates:
+            if entry is not None:
+                value = _ifd_ascii(tiff, entry, endian)
+                if value is not None:
+                    result = _parse_exif_datetime(value)
+                    if result is not None:
+                        return result
+    except struct.error:
+        pass
+    return None
+
+
+def capture_time_from_jpeg(fp) -> float | None:
+    """
+    :param fp: JPEG file opened for binary reading
+    :return: Capture time as POSIX timestamp, or ``None``
+    """
+    if fp.read(2) != b"\xff\xd8":
+        return None
+    while True:
+        header = fp.read(4)
+        if len(header) < 4 or header[0] != 0xFF:
+            return None
+        marker = header[1]
+        (length,) = struct.unpack(">H", header[2:])
+        if marker == 0xDA:  # Start of scan: No more metadata
+            return None
+        if marker == 0xE1:
+            data = fp.read(length - 2)
+            if data.startswith(b"Exif\x00\x00"):
+                return capture_time_from_tiff(data[6:])
+        else:
+            fp.seek(length - 2, os.SEEK_CUR)
+
+
+def _iter_boxes(fp, start: int, end: int):
+    # Iterates over ISO base media file format boxes in `[start, end)`, only
+    # reading box headers. Yields `(box_type, payload_start, box_end)`
+    pos = start
+    while pos + 8 <= end:
+        fp.seek(pos)
+        header = fp.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack(">I4s", header)
+        payload_start = pos + 8
+        if size == 1:
+            (size,) = struct.unpack(">Q", fp.read(8))
+            payload_start += 8
+        elif size == 0:
+            size = end - pos
+        if size < payload_start - pos:
+            return
+        yield box_type, payload_start, pos + size
+        pos += size
+
+
+def _find_box(fp, start: int, end: int, box_type: bytes) -> tuple | None:
+    for typ, payload_start, box_end in _iter_boxes(fp, start, end):
+        if typ == box_type:
+            return payload_start, box_end
+    return None
+
+
+def capture_time_from_quicktime(fp, file_size: int) -> float | None:
+    """
+    :param fp: MOV or MP4 file opened for binary reading
+    :param file_size: Size of file
+    :return: Creation time from "mvhd" box as POSIX timestamp, or ``None``
+    """
+    moov = _find_box(fp, 0, file_size, b"moov")
+    if moov is None:
+        return None
+    mvhd = _find_box(fp, *moov, b"mvhd")
+    if mvhd is None:
+        return None
+    fp.seek(mvhd[0])
+    data = fp.read(12)
+    if len(data) < 8:
+        return None
+    if data[0] == 1:
+        (creation_time,) = struct.unpack(">Q", data[4:12])
+    else:
+        (creation_time,) = struct.unpack(">I", data[4:8])
+    if creation_time == 0:
+        return None
+    return float(creation_time - QUICKTIME_EPOCH_OFFSET)
+
+
+def _read_uint(data: bytes, pos: int, num_bytes: int) -> tuple[int, int]:
+    return int.from_bytes(data[pos:pos + num_bytes], "big"), pos + num_bytes
+
+
+def _heic_exif_item_id(iinf: bytes) -> int | None:
+    version = iinf[0]
+    pos = 4 + (2 if version == 0 else 4)
+    while pos + 8 <= len(iinf):
+        size, box_type = struct.unpack_from(">I4s", iinf, pos)
+        if size < 8:
+            return None
+        if box_type == b"infe" and iinf[pos + 8] >= 2:
+            id_size = 2 if iinf[pos + 8] == 2 else 4
+            item_id, item_pos = _read_uint(iinf, pos + 12, id_size)
+            item_type = iinf[item_pos + 2:item_pos + 6]
+            if item_type == b"Exif":
+                return item_id
+        pos += size
+    return None
+
+
+def _heic_item_location(iloc: bytes, item_id: int) -> tuple[int, int] | None:
+    version = iloc[0]
+    offset_size, length_size = iloc[4] >> 4, iloc[4] & 15
+    base_offset_size = iloc[5] >> 4
+    index_size = iloc[5] & 15 if version in (1, 2) else 0
+    item_count, pos = _read_uint(iloc, 6, 2 if version < 2 else 4)
+    for _ in range(item_count):
+        this_id, pos = _read_uint(iloc, pos, 2 if version < 2 else 4)
+        construction_method = 0
+        if version in (1, 2):
+            construction_method, pos = _read_uint(iloc, pos, 2)
+            construction_method &= 15
+        pos += 2  # data_reference_index
+        base_offset, pos = _read_uint(iloc, pos, base_offset_size)
+        extent_count, pos = _read_uint(iloc, pos, 2)
+        extents = []
+        for _ in range(extent_count):
+            pos += index_size
+            extent_offset, pos = _read_uint(iloc, pos, offset_size)
+            extent_length, pos = _read_uint(iloc, pos, length_size)
+            extents.append((base_offset + extent_offset, extent_length))
+        if this_id == item_id:
+            if construction_method != 0 or not extents:
+                return None
+            return extents[0]
+    return None
+
+
+def capture_time_from_heic(fp, file_size: int) -> float | None:
+    """
+    :param fp: HEIC file opened for binary reading
+    :param file_size: Size of file
+    :return: Capture time as POSIX timestamp, or ``None``
+    """
+    meta = _find_box(fp, 0, file_size, b"meta")
+    if meta is None:
+        return None
+    # "meta" is a full box: Skip version and flags
+    children = {
+        box_type: (payload_start, box_end)
+        for box_type, payload_start, box_end in _iter_boxes(fp, meta[0] + 4, meta[1])
+    }
+    boxes = dict()
+    for box_type in (b"iinf", b"iloc"):
+        if box_type not in children:
+            return None
+        payload_start, box_end = children[box_type]
+        fp.seek(payload_start)
+        boxes[box_type] = fp.read(min(box_end - payload_start, MAX_HEADER_BYTES))
+    item_id = _heic_exif_item_id(boxes[b"iinf"])
+    if item_id is None:
+        return None
+    location = _heic_item_location(boxes[b"iloc"], item_id)
+    if location is None:
+        return None
+    offset, length = location
+    fp.seek(offset)
+    data = fp.read(min(length, MAX_HEADER_BYTES))
+    # Exif item starts with offset to TIFF header, relative to end of this field
+    if len(data) < 4:
+        return None
+    (tiff_offset,) = struct.unpack(">I", data[:4])
+    return capture_time_from_tiff(data[4 + tiff_offset:])
+
+
+def capture_time(path: Path, file_size: int | None = None) -> float | None:
+    """
+    Reads capture time from the file headers, see above.
+
+    :param path: File path
+    :param file_size: Size of file, if already known
+    :return: Capture time as POSIX timestamp, or ``None`` if this cannot be
+        determined
+    """
+    suffix = path.suffix.upper()
+    try:
+        with open(path, "rb") as fp:
+            if suffix == ".JPG":
+                return capture_time_from_jpeg(fp)
+            if file_size is None:
+                file_size = os.fstat(fp.fileno()).st_size
+            if suffix == ".HEIC":
+                return capture_time_from_heic(fp, file_size)
+            elif suffix in (".MOV", ".MP4"):
+                return capture_time_from_quicktime(fp, file_size)
+    except (OSError, struct.error, IndexError, ValueError):
+        pass
+    return None
+
+
+def _capture_times_batch(paths: list[Path]) -> list[float | None]:
+    return [capture_time(path) for path in paths]
+
+
+def resolve_capture_times(
+    paths: list[Path],
+    mtimes: list[float],
+    num_workers: int | None = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    executor: Executor | None = None,
+) -> list[float]:
+    """
+    Determines capture times for all ``paths``, falling back to the last
+    modified times ``mtimes`` if this fails. Paths are processed in batches of
+    size ``batch_size`` by a pool of ``num_workers`` processes, or by
+    ``executor`` if this is given (so it can be reused across calls).
+
+    :param paths: List of file paths
+    :param mtimes: List of last modified times, same length as ``paths``
+    :param num_workers: Number of processes. Defaults to number of CPUs
+    :param batch_size: Batch size
+    :param executor: Executor to be used (optional)
+    :return: List of capture times, in the same order as ``paths``
+    """
+    batches = [
+        paths[start:(start + batch_size)]
+        for start in range(0, len(paths), batch_size)
+    ]
+    if len(batches) <= 1:
+        results = [_capture_times_batch(batch) for batch in batches]
+    elif executor is not None:
+        results = list(executor.map(_capture_times_batch, batches))
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(_capture_times_batch, batches))
+    return [
+        mtime if result is None else result
+        for result, mtime in zip(
+            (result for batch in results for result in batch), mtimes
+        )
+    ]
@@ -0,0 +1,198 @@
+# Copy engine used by `process_image_files.py`.
+#
+# Files are copied by a pool of threads. Each file is written to a temporary
+# file next to the target first, which is renamed once complete, so that an
+# interrupted run never leaves a truncated file under the target name. A
+# target which exists already is only skipped if it matches the source (size
+# and last modified time, optionally content hash), otherwise it is copied
+# again. This means that rerunning after an interrupted run resumes cleanly.
+from pathlib import Path
+from enum import Enum
+import hashlib
+import os
+import shutil
+
+
+DEFAULT_NUM_WORKERS = 8
+
+# Tolerance when comparing last modified times. Some file systems (FAT, exFAT)
+# store these with 2 second resolution
+MTIME_TOLERANCE = 2.0
+
+HASH_BLOCK_SIZE = 1 << 20
+
+# Files up to this size are hashed while copying. Larger files (videos) are
+# copied with zero-copy (see `_copy_file_content`) and not hashed, since
+# passing them through user space costs more than the hash is worth
+HASH_WHILE_COPYING_MAX_SIZE = 64 << 20
+
+PARTIAL_SUFFIX = ".partial"
+
+
+class CopyStatus(str, Enum):
+    COPIED = "copied"
+    EXISTS = "exists"
+    REPAIRED = "repaired"
+    LINKED = "linked"  # Hard link to content stored before, see `blob_store.py`
+
+
+def file_digest(path: Path) -> str:
+    """
+    :param path: File path
+    :return: BLAKE2b digest of content of file
+    """
+    digest = hashlib.blake2b()
+    with open(path, "rb") as fp:
+        while block := fp.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def files_match(
+    src_path: Path,
+    trg_path: Path,
+    verify_hash: bool,
+    src_stat: os.stat_result | None = None,
+) -> bool:
+    """
+    Checks whether ``trg_path`` is a complete copy of ``src_path``.
+
+    :param src_path: Source file path
+    :param trg_path: Target file path
+    :param verify_hash: Compare content hashes in addition to size and last
+        modified time?
+    :param src_stat: Result of ``src_path.stat()``, if already known
+    :return: Does ``trg_path`` exist and match ``src_path``?
+    """
+    try:
+        trg_stat = trg_path.stat()
+    except FileNotFoundError:
+        return False
+    if src_stat is None:
+        src_stat = src_path.stat()
+    if trg_stat.st_size != src_stat.st_size:
+        return False
+    if abs(trg_stat.st_mtime - src_stat.st_mtime) > MTIME_TOLERANCE:
+        return False
+    return not verify_hash or file_digest(src_path) == file_digest(trg_path)
+
+
+def _copy_file_content(src_fd: int, trg_fd: int, size: int):
+    # Zero-copy in the kernel if supported by the OS: `copy_file_range`
+    # (Linux), then `sendfile`. Otherwise, we fall back to reading and writing
+    # blocks
+    offset = 0
+    for copy_func in ("copy_file_range", "sendfile"):
+        if not hasattr(os, copy_func):
+            continue
+        try:
+            while offset < size:
+                if copy_func == "copy_file_range":
+                    num_bytes = os.copy_file_range(
+                        src_fd, trg_fd, size - offset, offset, offset
+                    )
+                else:
+                    num_bytes = os.sendfile(
+                        trg_fd, src_fd, offset, size - offset
+                    )
+                if num_bytes == 0:
+                    break
+                offset += num_bytes
+            if offset >= size:
+                return
+        except OSError:
+            pass  # Not supported for these files, try next option
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(trg_fd, offset, os.SEEK_SET)
+    while block := os.read(src_fd, HASH_BLOCK_SIZE):
+        # `os.write` may write fewer bytes than given
+        view = memoryview(block)
+        while view:
+            view = view[os.write(trg_fd, view):]
+
+
+def _copy_and_hash_file_content(src_fd: int, trg_fd: int) -> str:
+    # Content passes through user space, so that it can be hashed on the way
+    digest = hashlib.blake2b()
+    while block := os.read(src_fd, HASH_BLOCK_SIZE):
+        digest.update(block)
+        view = memoryview(block)
+        while view:
+            view = view[os.write(trg_fd, view):]
+    return digest.hexdigest()
+
+
+def copy_file_atomic(
+    src_path: Path, trg_path: Path, compute_hash: bool = False
+) -> str | None:
+    """
+    Copies ``src_path`` to ``trg_path``, including metadata, such as last
+    modified time (like ``shutil.copy2``). Content is written to a temporary
+    file first, which is then renamed to ``trg_path``.
+
+    If ``compute_hash=True``, the content hash (see :func:`file_digest`) is
+    computed while copying, so the source is read only once. Zero-copy is not
+    used in this case.
+
+    :param src_path: Source file path
+    :param trg_path: Target file path
+    :param compute_hash: See above. Defaults to ``False``
+    :return: Content hash if ``compute_hash=True``, otherwise ``None``
+    """
+    trg_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = trg_path.parent / (trg_path.name + PARTIAL_SUFFIX)
+    content_hash = None
+    try:
+        with open(src_path, "rb") as src_fp, open(tmp_path, "wb") as trg_fp:
+            if compute_hash:
+                content_hash = _copy_and_hash_file_content(
+                    src_fp.fileno(), trg_fp.fileno()
+                )
+            else:
+                size = os.fstat(src_fp.fileno()).st_size
+                _copy_file_content(src_fp.fileno(), trg_fp.fileno(), size)
+        shutil.copystat(src_path, tmp_path)
+        os.replace(tmp_path, trg_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return content_hash
+
+
+def copy_file_if_needed(
+    src_path: Path,
+    trg_path: Path,
+    verify_hash: bool = False,
+    hash_max_size: int = HASH_WHILE_COPYING_MAX_SIZE,
+) -> tuple[CopyStatus, str | None]:
+    """
+    Copies ``src_path`` to ``trg_path``, unless the latter exists and matches
+    the former (see :func:`files_match`). An existing target which does not
+    match (e.g., truncated copy from an earlier run) is replaced.
+
+    The content hash of the source is computed while copying if its size is
+    at most ``hash_max_size``. Larger files are copied with zero-copy and
+    not hashed, unless ``verify_hash=True``. With ``verify_hash=True``, the
+    hash is also computed while comparing with an existing target. A target
+    which exists and matches by size and last modified time is not read
+    otherwise.
+
+    :param src_path: Source file path
+    :param trg_path: Target file path
+    :param verify_hash: See :func:`files_match`
+    :param hash_max_size: See above
+    :return: ``(status, content_hash)``, where ``content_hash`` is ``None``
+        if the source has not been hashed
+    """
+    src_stat = src_path.stat()
+    if files_match(src_path, trg_path, verify_hash=False, src_stat=src_stat):
+        if not verify_hash:
+            return CopyStatus.EXISTS, None
+        content_hash = file_digest(src_path)
+        if content_hash == file_digest(trg_path):
+            return CopyStatus.EXISTS, content_hash
+    status = CopyStatus.REPAIRED if trg_path.exists() else CopyStatus.COPIED
+    compute_hash = verify_hash or src_stat.st_size <= hash_max_size
+    content_hash = copy_file_atomic(src_path, trg_path, compute_hash=compute_hash)
+    return status, content_hash
+
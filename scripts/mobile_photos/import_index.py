@@ -0,0 +1,182 @@
+# Persistent import index used by `process_image_files.py`.
+#
+# For every source file imported, the index records source path, size, last
+# modified time, content hash, and the target path it has been copied to. It
+# is stored as SQLite database under the root path of the target folder
+# structure. On a rerun, source files whose size and last modified time match
+# their index entry are skipped without touching the target folder structure.
+# Content hashes allow to detect duplicates across month folders.
+#
+# The index also caches capture times read from file headers (see
+# `capture_date.py`), keyed by source path, size and last modified time, and
+# lists the blobs of the deduplicating store (see `blob_store.py`).
+from pathlib import Path
+from dataclasses import dataclass
+import sqlite3
+
+
+INDEX_FNAME = ".import_index.sqlite"
+
+# Content hash recorded for files which have not been hashed, because the
+# target existed already, or because they were copied with zero-copy (see
+# `copy_files.py`)
+UNKNOWN_HASH = ""
+
+
+@dataclass(frozen=True)
+class IndexEntry:
+    source_path: str
+    size: int
+    mtime_ns: int
+    content_hash: str  # `UNKNOWN_HASH` if not known
+    target_path: str
+
+    def matches(self, size: int, mtime_ns: int) -> bool:
+        """
+        :param size: Size of source file
+        :param mtime_ns: Last modified time of source file (in nanoseconds)
+        :return: Source file unchanged since entry was recorded?
+        """
+        return self.size == size and self.mtime_ns == mtime_ns
+
+
+class ImportIndex:
+    """
+    Persistent index of imported files, stored in ``pics_root_path``. Use as
+    context manager, or call :meth:`close` when done.
+    """
+    def __init__(self, pics_root_path: Path):
+        pics_root_path.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(pics_root_path / INDEX_FNAME))
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS imports ("
+            "source_path TEXT PRIMARY KEY, "
+            "size INTEGER NOT NULL, "
+            "mtime_ns INTEGER NOT NULL, "
+            "content_hash TEXT NOT NULL, "
+            "target_path TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS imports_content_hash "
+            "ON imports (content_hash)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS capture_times ("
+            "source_path TEXT PRIMARY KEY, "
+            "size INTEGER NOT NULL, "
+            "mtime_ns INTEGER NOT NULL, "
+            "capture_time REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            "content_hash TEXT PRIMARY KEY, "
+            "size INTEGER NOT NULL, "
+            "prefix_hash TEXT NOT NULL, "
+            "blob_path TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    def __enter__(self) -> "ImportIndex":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def load_entries(self) -> dict[str, IndexEntry]:
+        """
+        Loading all entries with a single query is much faster than one query
+        per source file.
+
+        :return: Dictionary of all entries, keyed by source path
+        """
+        rows = self._conn.execute(
+            "SELECT source_path, size, mtime_ns, content_hash, target_path "
+            "FROM imports"
+        )
+        return {row[0]: IndexEntry(*row) for row in rows}
+
+    def record(self, entries: list[IndexEntry]):
+        """
+        Adds or replaces entries, in a single transaction.
+
+        :param entries: Entries to record
+        """
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO imports "
+                "(source_path, size, mtime_ns, content_hash, target_path) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (e.source_path, e.size, e.mtime_ns, e.content_hash, e.target_path)
+                    for e in entries
+                ],
+            )
+
+    def load_capture_times(self) -> dict[tuple[str, int, int], float]:
+        """
+        :return: Dictionary of cached capture times, keyed by
+            ``(source_path, size, mtime_ns)``
+        """
+        rows = self._conn.execute(
+            "SELECT source_path, size, mtime_ns, capture_time FROM capture_times"
+        )
+        return {tuple(row[:3]): row[3] for row in rows}
+
+    def record_capture_times(self, entries: list[tuple[str, int, int, float]]):
+        """
+        Adds or replaces cached capture times, in a single transaction.
+
+        :param entries: List of ``(source_path, size, mtime_ns, capture_time)``
+        """
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO capture_times "
+                "(source_path, size, mtime_ns, capture_time) VALUES (?, ?, ?, ?)",
+                entries,
+            )
+
+    def load_blobs(self) -> list[tuple[str, int, str, str]]:
+        """
+        :return: List of ``(content_hash, size, prefix_hash, blob_path)`` for
+            all blobs in the deduplicating store
+        """
+        return self._conn.execute(
+            "SELECT content_hash, size, prefix_hash, blob_path FROM blobs"
+        ).fetchall()
+
+    def record_blobs(self, entries: list[tuple[str, int, str, str]]):
+        """
+        Adds blobs, in a single transaction.
+
+        :param entries: List of ``(content_hash, size, prefix_hash, blob_path)``
+        """
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO blobs "
+                "(content_hash, size, prefix_hash, blob_path) VALUES (?, ?, ?, ?)",
+                entries,
+            )
+
+    def duplicates(self) -> list[list[str]]:
+        """
+        Entries with unknown content hash are not considered.
+
+        :return: Groups of distinct target paths with equal content
+        """
+        rows = self._conn.execute(
+            "SELECT content_hash, target_path FROM imports WHERE content_hash IN "
+            "(SELECT content_hash FROM imports WHERE content_hash != ? "
+            "GROUP BY content_hash HAVING COUNT(DISTINCT target_path) > 1) "
+            "ORDER BY content_hash, target_path",
+            (UNKNOWN_HASH,),
+        )
+        groups = dict()
+        for content_hash, target_path in rows:
+            group = groups.setdefault(content_hash, [])
+            if target_path not in group:
+                group.append(target_path)
+        return list(groups.values())
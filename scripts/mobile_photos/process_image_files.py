@@ -1,10 +1,24 @@
 from pathlib import Path
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from dataclasses import dataclass
+from typing import Iterable, Iterator, TypeVar
 import time
-import shutil
 from argparse import ArgumentParser
 
+from copy_files import (
+    CopyStatus,
+    copy_file_if_needed,
+    DEFAULT_NUM_WORKERS,
+)
+from import_index import ImportIndex, IndexEntry, UNKNOWN_HASH
+from blob_store import BlobStore, deduplicate_tree
+from capture_date import resolve_capture_times
+from scan_files import scan_source_files, iter_batches
+
+
+T = TypeVar("T")
+
 
 DEFAULT_PICS_ROOT_PATH = Path.home() / "matthias_mobile_photos"
 
@@ -18,6 +32,10 @@ VIDEO_DIR_PREFIX = "videos"
 
 VIDEO_SUFFIXES = [".MOV", ".MP4", ".mp4"]
 
+# Source files are processed in blocks of this size: index lookup, capture
+# time resolution, then submission to the copy workers
+SCAN_BLOCK_SIZE = 1024
+
 
 def get_directory_prefix(path: Path) -> str | None:
     suffix = path.suffix
@@ -40,19 +58,24 @@ class MonthAndYear:
     def from_path(
         path: Path,
         pics_root_path: Path,
+        timestamp: float | None = None,
     ) -> "MonthAndYear":
         """
-        Creates object from ``path``. Month and year are taken from the last
-        modified time of the file, ``directory_prefix`` is determined from the
-        suffix.
+        Creates object from ``path``. Month and year are taken from
+        ``timestamp`` (typically the capture time, see ``capture_date.py``),
+        or from the last modified time of the file if this is not given.
+        ``directory_prefix`` is determined from the suffix.
 
         :param path: File path
         :param pics_root_path: Member value
+        :param timestamp: See above
         :return: New :class:`MonthAndYear` object
         """
         directory_prefix = get_directory_prefix(path)
         assert directory_prefix is not None, f"{path} has unsupported suffix, must be in {PIC_SUFFIXES + VIDEO_SUFFIXES}"
-        gmtime = time.gmtime(path.stat().st_mtime)
+        if timestamp is None:
+            timestamp = path.stat().st_mtime
+        gmtime = time.gmtime(timestamp)
         return MonthAndYear(
             month=gmtime.tm_mon,
             year=gmtime.tm_year,
@@ -92,44 +115,301 @@ def filter_live_mode_videos(paths: list[Path]) -> list[Path]:
     return [path for path in paths if path not in unwanted_paths]
 
 
+def filter_live_mode_videos_stream(
+    items: Iterable[tuple[Path, T]],
+) -> Iterator[tuple[Path, T]]:
+    """
+    Generator function. Streaming variant of :func:`filter_live_mode_videos`,
+    for items ``(path, value)``. A video which may be a live mode video is held
+    back until its picture is seen, or until items from a different directory
+    arrive. Items are assumed to be grouped by directory (as returned by
+    ``scan_source_files``).
+
+    :param items: Items ``(path, value)``
+    :return: Items without live mode video files
+    """
+    picture_stems = set()
+    held_videos = dict()
+    current_parent = None
+    for path, value in items:
+        if path.parent != current_parent:
+            yield from held_videos.values()
+            picture_stems.clear()
+            held_videos.clear()
+            current_parent = path.parent
+        if live_mode_video_path(path) is not None:
+            picture_stems.add(path.stem)
+            held_videos.pop(path.stem, None)
+            yield path, value
+        elif path.suffix == ".MOV":
+            if path.stem not in picture_stems:
+                held_videos[path.stem] = (path, value)
+        else:
+            yield path, value
+    yield from held_videos.values()
+
+
+def counter_key(trg_prefix: Path) -> str:
+    skip_prefix = len(str(trg_prefix.parents[1])) + 1
+    return str(trg_prefix)[skip_prefix:]
+
+
+def disambiguated_name(src_path: Path, source_path: Path) -> str:
+    """
+    Files from different subdirectories of the source path may have the same
+    name (e.g., ``DCIM/100APPLE/IMG_0001.HEIC`` and
+    ``DCIM/101APPLE/IMG_0001.HEIC``). If they end up in the same month
+    folder, the second one is given a name which includes the directory
+    relative to ``source_path``, such as ``DCIM_101APPLE_IMG_0001.HEIC``.
+
+    :param src_path: Source file path
+    :param source_path: Source path scanned
+    :return: Name for target file
+    """
+    try:
+        parts = src_path.parent.relative_to(source_path).parts
+    except ValueError:
+        parts = ()
+    if not parts:
+        parts = (src_path.parent.name,)
+    return "_".join(parts + (src_path.name,))
+
+
+class TargetNames:
+    """
+    Assigns target paths to source files, so that distinct source files are
+    never copied to the same target path. A target path is claimed by the
+    first source file assigned to it, in this run or in an earlier one (as
+    recorded in the import index). Further source files get a name from
+    :func:`disambiguated_name` instead.
+
+    :param source_path: Source path scanned
+    :param entries: Entries of import index
+    """
+    def __init__(self, source_path: Path, entries: Iterable[IndexEntry]):
+        self._source_path = source_path
+        self._owners = {entry.target_path: entry.source_path for entry in entries}
+
+    def _claim(self, trg_path: Path, src_path: Path) -> bool:
+        owner = self._owners.setdefault(str(trg_path), str(src_path))
+        return owner == str(src_path)
+
+    def target_path(self, src_path: Path, path_prefix: Path) -> Path:
+        """
+        :param src_path: Source file path
+        :param path_prefix: Month folder, see :meth:`MonthAndYear.path_prefix`
+        :return: Target path for ``src_path``
+        """
+        trg_path = path_prefix / src_path.name
+        if self._claim(trg_path, src_path):
+            return trg_path
+        name = disambiguated_name(src_path, self._source_path)
+        trg_path = path_prefix / name
+        count = 1
+        while not self._claim(trg_path, src_path):
+            count += 1
+            trg_path = path_prefix / f"{Path(name).stem}_{count}{src_path.suffix}"
+        return trg_path
+
+
+def format_bytes(num_bytes: int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f} {unit}" if unit != "B" else f"{num_bytes} B"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TB"
+
+
 def main(
     source_path: Path,
     pics_root_path: Path,
     skip_live_mode_videos: bool,
+    num_workers: int = DEFAULT_NUM_WORKERS,
+    verify_hash: bool = False,
+    use_index: bool = True,
+    use_capture_time: bool = True,
+    recursive: bool = True,
+    dedup: bool = False,
+    dedup_existing: bool = False,
 ):
     allowed_suffixes = set(PIC_SUFFIXES + VIDEO_SUFFIXES)
-    paths = [
-        path for path in source_path.glob("*")
-        if path.is_file() and path.suffix in allowed_suffixes
-    ]
+    # Files are processed as they are found by the scanner
+    source_files = scan_source_files(
+        source_path.absolute(),
+        allowed_suffixes=allowed_suffixes,
+        recursive=recursive,
+        exclude_paths=[pics_root_path.absolute()],
+    )
     # Filter out live mode videos (optional)
     if skip_live_mode_videos:
-        paths = filter_live_mode_videos(paths)
-
-    counter_copied = Counter()
-    counter_exist = Counter()
-    for src_path in paths:
-        month_year = MonthAndYear.from_path(src_path, pics_root_path=pics_root_path)
-        trg_prefix = month_year.path_prefix()
-        trg_path = trg_prefix / src_path.name
-        skip_prefix = len(str(trg_prefix.parents[1])) + 1
-        key_counter = str(trg_prefix)[skip_prefix:]
-        if trg_path.exists():
-            # File already exists. Do not overwrite
-            counter_exist.update([key_counter])
-        else:
-            # Copy file
-            trg_path.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy2(str(src_path), str(trg_path))
-            counter_copied.update([key_counter])
+        source_files = filter_live_mode_videos_stream(source_files)
+
+    store = None
+
+    def copy_and_hash(
+        src_path: Path, trg_path: Path
+    ) -> tuple[CopyStatus, str | None]:
+        # Content is hashed while copied, except for large files, which are
+        # copied with zero-copy (see `copy_file_if_needed`). Targets which
+        # exist already are only read with `verify_hash`, or in dedup mode if
+        # a blob of the same size is stored
+        if store is not None:
+            return store.store_file(src_path, trg_path)
+        return copy_file_if_needed(src_path, trg_path, verify_hash=verify_hash)
+
+    counters = {status: Counter() for status in CopyStatus}
+    num_dedup_existing = 0
+    with (
+        ImportIndex(pics_root_path) as index,
+        ThreadPoolExecutor(max_workers=max(num_workers, 1)) as copy_executor,
+        ProcessPoolExecutor() as capture_time_executor,
+    ):
+        if dedup:
+            store = BlobStore(pics_root_path, index.load_blobs())
+            if dedup_existing:
+                # Files imported without deduplication are put into the store
+                num_dedup_existing = deduplicate_tree(
+                    store,
+                    scan_source_files(
+                        pics_root_path.absolute(), allowed_suffixes=allowed_suffixes
+                    ),
+                    num_workers=num_workers,
+                )
+                index.record_blobs(store.new_entries())
+        all_entries = index.load_entries()
+        entries = all_entries if use_index else dict()
+        target_names = TargetNames(source_path.absolute(), all_entries.values())
+        cached_times = index.load_capture_times() if use_capture_time else dict()
+        jobs = []
+        for block in iter_batches(source_files, SCAN_BLOCK_SIZE):
+            pending = []
+            for src_path, src_stat in block:
+                entry = entries.get(str(src_path))
+                if entry is not None and entry.matches(
+                    src_stat.st_size, src_stat.st_mtime_ns
+                ):
+                    # Imported before and unchanged since: No need to look at
+                    # the target folder structure
+                    key = counter_key(Path(entry.target_path).parent)
+                    counters[CopyStatus.EXISTS].update([key])
+                else:
+                    pending.append((src_path, src_stat))
+            # Determine capture times of files to be copied. Results are cached
+            # in the index
+            timestamps = [src_stat.st_mtime for _, src_stat in pending]
+            if use_capture_time:
+                cache_keys = [
+                    (str(src_path), src_stat.st_size, src_stat.st_mtime_ns)
+                    for src_path, src_stat in pending
+                ]
+                to_resolve = [
+                    pos for pos, cache_key in enumerate(cache_keys)
+                    if cache_key not in cached_times
+                ]
+                resolved_times = resolve_capture_times(
+                    [pending[pos][0] for pos in to_resolve],
+                    mtimes=[timestamps[pos] for pos in to_resolve],
+                    executor=capture_time_executor,
+                )
+                new_times = [
+                    cache_keys[pos] + (capture_time,)
+                    for pos, capture_time in zip(to_resolve, resolved_times)
+                ]
+                index.record_capture_times(new_times)
+                cached_times.update((entry[:3], entry[3]) for entry in new_times)
+                timestamps = [cached_times[cache_key] for cache_key in cache_keys]
+            # Submit copy jobs. Files which already exist are not overwritten,
+            # unless they do not match the source (e.g., truncated by earlier
+            # run). Source files with the same name get distinct target names
+            for (src_path, src_stat), timestamp in zip(pending, timestamps):
+                month_year = MonthAndYear.from_path(
+                    src_path, pics_root_path=pics_root_path, timestamp=timestamp
+                )
+                trg_path = target_names.target_path(
+                    src_path, month_year.path_prefix()
+                )
+                future = copy_executor.submit(copy_and_hash, src_path, trg_path)
+                jobs.append((src_path, src_stat, trg_path, future))
+        # Collect results and record new or changed files in the index. A
+        # file which fails does not prevent the others from being recorded
+        new_entries = []
+        failures = []
+        for src_path, src_stat, trg_path, future in jobs:
+            try:
+                status, content_hash = future.result()
+            except Exception as ex:
+                failures.append((src_path, ex))
+                continue
+            if content_hash is None:
+                # Source has not been hashed (target existed, or large file
+                # copied with zero-copy). Keep the hash from the index if the
+                # source is unchanged
+                entry = all_entries.get(str(src_path))
+                if entry is not None and entry.target_path == str(trg_path) \
+                        and entry.matches(src_stat.st_size, src_stat.st_mtime_ns):
+                    content_hash = entry.content_hash
+            counters[status].update([counter_key(trg_path.parent)])
+            new_entries.append(
+                IndexEntry(
+                    source_path=str(src_path),
+                    size=src_stat.st_size,
+                    mtime_ns=src_stat.st_mtime_ns,
+                    content_hash=content_hash or UNKNOWN_HASH,
+                    target_path=str(trg_path),
+                )
+            )
+        index.record(new_entries)
+        if store is not None:
+            index.record_blobs(store.new_entries())
+            usage = store.usage()
+        duplicates = index.duplicates()
 
     print("Files copied (or already exist):")
     maxlen = max(len(PIC_DIR_PREFIX), len(VIDEO_DIR_PREFIX)) + 10
-    for key in sorted(set(counter_copied).union(counter_exist)):
+    counter_copied = counters[CopyStatus.COPIED]
+    counter_exist = counters[CopyStatus.EXISTS]
+    counter_repaired = counters[CopyStatus.REPAIRED]
+    counter_linked = counters[CopyStatus.LINKED]
+    for key in sorted(set().union(*counters.values())):
         num_copied = counter_copied.get(key, 0)
         num_exist = counter_exist.get(key, 0)
+        num_repaired = counter_repaired.get(key, 0)
+        num_linked = counter_linked.get(key, 0)
         postfix = f" ({num_exist} already exist)" if num_exist > 0 else ""
+        if num_repaired > 0:
+            postfix += f" ({num_repaired} incomplete, copied again)"
+        if num_linked > 0:
+            postfix += f" ({num_linked} linked to content stored before)"
         print(f"{key:{maxlen}}: {num_copied}" + postfix)
+    if store is not None:
+        statistics = store.statistics
+        print(
+            f"\nDeduplicating store: {usage.num_blobs} distinct files, "
+            f"{format_bytes(usage.bytes_stored)} stored for "
+            f"{format_bytes(usage.bytes_linked)} in the target folders "
+            f"({format_bytes(usage.bytes_saved)} saved)"
+        )
+        print(
+            f"This run: {statistics.blobs_added} new contents "
+            f"({format_bytes(statistics.bytes_added)} copied), "
+            f"{statistics.files_linked} files linked "
+            f"({format_bytes(statistics.bytes_saved)} saved), "
+            f"{statistics.prefix_hashes} prefix hashes, "
+            f"{statistics.full_hashes} full hashes"
+        )
+        if dedup_existing:
+            print(
+                f"Existing files in the target folders replaced by links: "
+                f"{num_dedup_existing}"
+            )
+    elif duplicates:
+        print(f"\nFiles with equal content in the target folders: {len(duplicates)}")
+        for group in duplicates:
+            print("  " + ", ".join(group))
+    if failures:
+        print(f"\nFiles which could not be copied: {len(failures)}")
+        for src_path, ex in failures:
+            print(f"  {src_path}: {ex}")
 
 
 def path_or_default(path_str: str | None, def_path: Path) -> Path:
@@ -162,6 +442,55 @@ if __name__ == "__main__":
         help="By default, XYZ.MOV (live mode video) is skipped if XYZ.HEIC "
              "(picture) is given. If set, live mode videos are copied as well"
     )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=DEFAULT_NUM_WORKERS,
+        help="Number of threads used for copying files",
+    )
+    parser.add_argument(
+        "--verify_hash",
+        action="store_true",
+        help="By default, a target file is considered complete if size and "
+             "last modified time match the source. If set, content hashes "
+             "are compared as well",
+    )
+    parser.add_argument(
+        "--no_index",
+        action="store_true",
+        help="By default, source files recorded in the import index (stored "
+             "in the target root) with unchanged size and last modified time "
+             "are skipped. If set, all source files are checked against the "
+             "target folders",
+    )
+    parser.add_argument(
+        "--use_mtime",
+        action="store_true",
+        help="By default, files are assigned to month folders by capture time "
+             "read from EXIF or QuickTime headers, falling back to last "
+             "modified time. If set, last modified time is always used",
+    )
+    parser.add_argument(
+        "--no_recursive",
+        action="store_true",
+        help="By default, subdirectories of the source path are scanned as "
+             "well. If set, only files directly in the source path are copied",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="If set, every distinct file content is stored once in a blob "
+             "store in the target root, and files in the target folders are "
+             "hard links to it. Files are first compared by size, then by "
+             "hash of their start, so most are not hashed in full",
+    )
+    parser.add_argument(
+        "--dedup_existing",
+        action="store_true",
+        help="Implies --dedup. If set, files in the target folders imported "
+             "without deduplication are replaced by hard links to the blob "
+             "store where their content is stored more than once",
+    )
     args = parser.parse_args()
     source_path = path_or_default(args.src_path, DEFAULT_SOURCE_PATH)
     pics_root_path = path_or_default(args.trg_root, DEFAULT_PICS_ROOT_PATH)
@@ -169,4 +498,11 @@ if __name__ == "__main__":
         source_path=source_path,
         pics_root_path=pics_root_path,
         skip_live_mode_videos=not args.keep_live_mode_videos,
+        num_workers=args.num_workers,
+        verify_hash=args.verify_hash,
+        use_index=not args.no_index,
+        use_capture_time=not args.use_mtime,
+        recursive=not args.no_recursive,
+        dedup=args.dedup or args.dedup_existing,
+        dedup_existing=args.dedup_existing,
     )
@@ -0,0 +1,67 @@
+# Streaming directory scanner used by `process_image_files.py`.
+#
+# Files are found with `os.scandir`, and returned as they are found, together
+# with their stat results (obtained from the `DirEntry`, which avoids extra
+# system calls on some platforms, and at most one `stat` per file on others).
+# All files of a directory are returned before any of its subdirectories are
+# entered.
+from pathlib import Path
+from typing import Iterable, Iterator, TypeVar
+import os
+
+
+T = TypeVar("T")
+
+
+def scan_source_files(
+    source_path: Path,
+    allowed_suffixes: set[str],
+    recursive: bool = True,
+    exclude_paths: Iterable[Path] = (),
+) -> Iterator[tuple[Path, os.stat_result]]:
+    """
+    Generator function. Scans ``source_path`` for files with suffix in
+    ``allowed_suffixes``. Hidden files and directories (name starting with
+    ".") are skipped, as are directories in ``exclude_paths``.
+
+    :param source_path: Directory to scan
+    :param allowed_suffixes: Set of suffixes of files to return
+    :param recursive: Scan subdirectories as well?
+    :param exclude_paths: Directories not to be scanned (e.g., the target
+        folder if it is inside ``source_path``)
+    :return: Tuples ``(path, stat_result)``
+    """
+    excluded = set(str(path) for path in exclude_paths)
+    directories = [str(source_path)]
+    while directories:
+        directory = directories.pop()
+        subdirectories = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_file():
+                    if os.path.splitext(entry.name)[1] in allowed_suffixes:
+                        yield Path(entry.path), entry.stat()
+                elif recursive and entry.is_dir() and entry.path not in excluded:
+                    subdirectories.append(entry.path)
+        directories.extend(sorted(subdirectories, reverse=True))
+
+
+def iter_batches(iterable: Iterable[T], batch_size: int) -> Iterator[list[T]]:
+    """
+    Generator function. Groups ``iterable`` into lists of size ``batch_size``
+    (the final one may be smaller).
+
+    :param iterable: Items to be grouped
+    :param batch_size: Batch size
+    :return: Batches of items
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,124 @@
+# Benchmark of the streaming directory scanner (see `scan_files.py`). Run as:
+#
+#     python scan_files_benchmark.py --num_files 100000
+#
+# A synthetic tree of ``num_files`` empty files (pictures, live mode videos,
+# other videos, and files with unsupported suffix) is created in a temporary
+# directory, with ``files_per_dir`` files per directory. It is then listed in
+# two ways, including removal of live mode videos:
+#
+# - glob: Full listing with ``Path.rglob``, then ``is_file`` and ``stat`` per
+#   file, then ``filter_live_mode_videos`` (the approach before `scan_files.py`)
+# - scandir: ``scan_source_files`` and ``filter_live_mode_videos_stream``
+#
+# Time until the first file is available (when copying could start) and total
+# time are reported. Both runs see a warm file system cache, since the tree
+# has just been created.
+from pathlib import Path
+from argparse import ArgumentParser
+import tempfile
+import time
+
+from process_image_files import (
+    PIC_SUFFIXES,
+    VIDEO_SUFFIXES,
+    filter_live_mode_videos,
+    filter_live_mode_videos_stream,
+)
+from scan_files import scan_source_files
+
+
+def create_tree(root_path: Path, num_files: int, files_per_dir: int):
+    names_cycle = (
+        "IMG_{:05d}.HEIC",
+        "IMG_{:05d}.MOV",
+        "IMG_{:05d}.JPG",
+        "VID_{:05d}.MP4",
+        "IMG_{:05d}.AAE",
+    )
+    num_dirs = (num_files + files_per_dir - 1) // files_per_dir
+    pos = 0
+    for dir_pos in range(num_dirs):
+        directory = root_path / "DCIM" / f"{100 + dir_pos}APPLE"
+        directory.mkdir(parents=True)
+        for _ in range(min(files_per_dir, num_files - pos)):
+            name = names_cycle[pos % len(names_cycle)].format(pos // 2)
+            (directory / name).touch()
+            pos += 1
+
+
+def list_with_glob(
+    source_path: Path, allowed_suffixes: set[str]
+) -> tuple[float, float, int]:
+    start = time.perf_counter()
+    paths = [
+        path for path in source_path.rglob("*")
+        if path.is_file() and path.suffix in allowed_suffixes
+    ]
+    paths = filter_live_mode_videos(paths)
+    stats = [path.stat() for path in paths]
+    elapsed = time.perf_counter() - start
+    return elapsed, elapsed, len(stats)
+
+
+def list_with_scandir(
+    source_path: Path, allowed_suffixes: set[str]
+) -> tuple[float, float, int]:
+    start = time.perf_counter()
+    time_to_first = None
+    num_files = 0
+    for _ in filter_live_mode_videos_stream(
+        scan_source_files(source_path, allowed_suffixes=allowed_suffixes)
+    ):
+        if time_to_first is None:
+            time_to_first = time.perf_counter() - start
+        num_files += 1
+    return time_to_first, time.perf_counter() - start, num_files
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Benchmark of streaming directory scanner against full listing"
+    )
+    parser.add_argument(
+        "--num_files",
+        type=int,
+        default=100000,
+        help="Number of files in synthetic tree",
+    )
+    parser.add_argument(
+        "--files_per_dir",
+        type=int,
+        default=1000,
+        help="Number of files per directory",
+    )
+    parser.add_argument(
+        "--num_repeats",
+        type=int,
+        default=3,
+        help="Number of repetitions, the best time is reported",
+    )
+    args = parser.parse_args()
+    allowed_suffixes = set(PIC_SUFFIXES + VIDEO_SUFFIXES)
+    with tempfile.TemporaryDirectory() as tmp_path:
+        source_path = Path(tmp_path)
+        start = time.perf_counter()
+        create_tree(source_path, args.num_files, args.files_per_dir)
+        print(
+            f"Created {args.num_files} files in "
+            f"{time.perf_counter() - start:.1f} secs"
+        )
+        for name, list_func in (
+            ("glob", list_with_glob), ("scandir", list_with_scandir)
+        ):
+            results = [
+                list_func(source_path, allowed_suffixes)
+                for _ in range(args.num_repeats)
+            ]
+            time_to_first = min(result[0] for result in results)
+            total_time = min(result[1] for result in results)
+            num_files = results[0][2]
+            print(
+                f"{name:8s}: first file after {time_to_first:7.3f} secs, "
+                f"total {total_time:7.3f} secs, {num_files} files"
+            )